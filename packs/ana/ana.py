@@ -1,7 +1,7 @@
 import numpy as np
 import os
 from packs.core.io import read_config_file
-from packs.ana.analysis_utils import average_waveforms, window_overlap_check
+from packs.ana.analysis_utils import average_waveforms, waveform_statistics, window_overlap_check
 from packs.core.core_utils import check_test
 from packs.proc.processing_utils import check_save_path
 import h5py
@@ -23,15 +23,25 @@ def ana(config_file : str) -> (np.ndarray):
     if isinstance(conf_args["files"], list):
         print("Averaging waveform....")
 
-        avgwf = average_waveforms(**conf_args)
-    
         checked_save_path = check_save_path(
             save_path,
             overwrite
         )
-
-        with h5py.File(checked_save_path, 'w') as f:     # Save as a h5
-            f.create_dataset('Average_waveform', data=avgwf)
+        h5py.File(checked_save_path, 'w').close() # start a fresh file, the selection is written to it while averaging
+
+        # the spread and quantiles add work on every sample, only accumulate them when asked for
+        if conf_args.pop('variance', False) or conf_args.get('quantiles'):
+            statistics = waveform_statistics(**conf_args, selection_path=checked_save_path)
+        else:
+            conf_args.pop('quantiles', None)
+            conf_args.pop('quantile_range', None)
+            statistics = {'Average_waveform' : average_waveforms(**conf_args, selection_path=checked_save_path)}
+
+        with h5py.File(checked_save_path, 'a') as f:     # Save as a h5
+            for name, data in statistics.items():
+                f.create_dataset(name, data=data)
+            if 'Quantile_waveforms' in statistics:
+                f['Quantile_waveforms'].attrs['quantiles'] = conf_args['quantiles']
 
         print(f"Saved to: {checked_save_path}")
 
@@ -1,9 +1,16 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import os
-from packs.core.waveform_utils    import collect_index , subtract_baseline
+import h5py
+import tempfile
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from packs.core.waveform_utils    import collect_index , subtract_baseline, filter_block, shift_block
+from packs.proc.pulse_utils       import timing_block
 from packs.core import io
+from packs.types import types
 from typing import Optional
+from typing import NamedTuple
 
 """
 Analysis utilities
@@ -11,67 +18,179 @@ Analysis utilities
 This file holds all the relevant functions for analysing data from h5 files.
 """
 
+def suppress_baseline(wf_data : np.ndarray,
+                        threshold : int) -> (np.ndarray):
+    '''
+    Suppresses baseline values, anything below the threshold (including negatives from undershoot) gets set to zero
+
+    Params:
+    wf_data (array)                 :                   waveform data
+    threshold (int)                 :                   upper cutoff for zero supression
+    
+    Returns:
+    wf_data (array)                 :                   waveform data with suppressed baseline
+    '''
+    wf_data[wf_data < threshold] = 0
+    return wf_data
+
+def cook_time(samples : int,
+                bin_size : int) -> (np.ndarray):
+    '''
+    Time axis of a chunk of waveforms, as used by cook_data
+
+    Params:
+    samples (int)                   :                   number of samples per waveform
+    bin_size (int)                  :                   time spacing between bins in ns
+
+    Returns:
+    time (array)                    :                   time of each sample
+    '''
+    return np.linspace(0, samples, num=samples, dtype=int) * bin_size
+
+
+def reject_secondaries(wf_data : np.ndarray,
+                        threshold : int,
+                        time : np.ndarray,
+                        WINDOW_END: int) -> (np.ndarray):
+    '''
+    Flags the waveforms of a block with large secondary peaks.
+    Any waveforms with peaks after the first signal (defined by WINDOW_END) that are larger than the threshold are flagged.
+
+    Params:
+    wf_data (array)                 :                   (N, samples) block of waveforms
+    threshold (int)                 :                   amplitude cutoff for second peak rejection
+    time (array)                    :                   the x axis / time data for the waveforms
+    WINDOW_END (float)              :                   end of the first signal
+
+    Returns:
+    rejected (array)                :                   boolean mask of the rejected waveforms
+    '''
+    start = collect_index(time, WINDOW_END)
+    if start >= wf_data.shape[1]:
+        return np.zeros(len(wf_data), dtype=bool)
+    return np.max(wf_data[:, start:], axis=1) > threshold
+
+
 def remove_secondaries(wf_data : np.ndarray,
                         threshold : int,
                         time : np.ndarray,
-                        event_number : int, 
-                        verbose: int, 
+                        event_number : int,
+                        verbose: int,
                         WINDOW_END: int) -> (np.ndarray):
     '''
-    Removes events with large secondary peaks.
-    Any waveforms with peaks after the first signal (defined by WINDOW_END) that are larger than the threshold are identified and removed.
-    These removed waveforms can be plotted using verbose = 2.
+    Removes a single waveform with a large secondary peak, see reject_secondaries().
+    Rejections aren't printed or plotted per event, cook_data() summarises them per chunk and ANA/selection
+      records them. event_number and verbose are only kept so existing callers still work.
 
     Params:
     threshold (int)                 :                   amplitude cutoff for second peak rejection
     wf_data (array)                 :                   data of waveform
     time (array)                    :                   the x axis / time data for the waveform
-    event_number (int)              :                   counter passed through to track events
-    verbose (str)                   :                   0 for no info, 1 for ommitted event number, 2 for plots of rejected event
+    event_number (int)              :                   counter passed through to track events (unused)
+    verbose (str)                   :                   amount of info wanted (unused)
     WINDOW_END (float)              :                   end of the first signal
-    
+
     Returns:
-    wf_data (array)                 :                   none rejected waveform
-    '''
-    after_window_wf = wf_data[collect_index(time, WINDOW_END) : len(wf_data)] # Making an array of the data after WINDOW_END so we can look for peaks there
-    if len(after_window_wf) == 0:
-        return wf_data
-    if after_window_wf is not None:   
-        second_peak = np.max(after_window_wf)
-        if second_peak > threshold:
-            if verbose > 1: 
-                plt.plot(time, wf_data)
-                plt.xlabel('Time (ns)')
-                plt.ylabel('ADCs')
-                plt.yscale('log')
-                plt.axhline(second_peak, 0, 2e5, c = 'r', ls = '--')
-                plt.axvline(WINDOW_END, c = 'r', ls = '--')
-                plt.title(f'Event {event_number} subtracted waveform')
-                plt.show()
-            if verbose > 0:
-                print(f'Event {event_number} excluded due to large secondary peak')
-            return None
-        else:
-            return wf_data
-    else:
-        print(f'Window_End input {WINDOW_END} is outside of waveform range')
-        return wf_data
-    
+    wf_data (array)                 :                   none rejected waveform, None if rejected
+    '''
+    if reject_secondaries(wf_data[np.newaxis, :], threshold, time, WINDOW_END)[0]:
+        return None
+    return wf_data
 
-def suppress_baseline(wf_data : np.ndarray,
-                        threshold : int) -> (np.ndarray):
+
+def _cook(data : np.ndarray,
+            bin_size : int,
+            window_args : dict,
+            negative : Optional[bool] = False,
+            baseline_mode : Optional[str] = 'median',
+            peak_threshold : Optional[int] = 1000,
+            suppression_threshold : Optional[int] = 10,
+            filters : Optional[tuple] = None) -> (tuple):
     '''
-    Suppresses baseline values, anything below the threshold (including negatives from undershoot) gets set to zero
+    Flips, baseline subtracts, filters and suppresses a block of waveforms at once,
+    giving the reason each waveform is kept or rejected (see types.selection_reasons).
+    Shared by cook_data, cook_block and partial_average.
 
-    Params:
-    wf_data (array)                 :                   waveform data
-    threshold (int)                 :                   upper cutoff for zero supression
-    
     Returns:
-    wf_data (array)                 :                   waveform data with suppressed baseline
+        (sup_data, reasons, time) : processed block, reason code of each waveform and the time axis.
+                                    A block not matching the window arguments is returned unprocessed
     '''
-    wf_data[wf_data < threshold] = 0
-    return wf_data
+    data = np.asarray(data)
+    if data.dtype == object: # waveforms loaded through pandas are an array of arrays
+        data = np.stack(data)
+
+    time = cook_time(data.shape[1], bin_size)
+
+    # Check that window args agree with the waveforms, which share a length
+    if not window_wf_check(data[0], window_args):
+        return data.astype(np.float64), np.full(len(data), types.WINDOW_MISMATCH, dtype=np.uint8), time
+
+    if negative:
+        data = -data # Negative flip
+
+    # Collect the baseline region data (sidebands), the same for every waveform of the block
+    bl_range_1 = [collect_index(time, window_args['BASELINE_POINT_1'] - window_args['BASELINE_RANGE_1']),
+                  collect_index(time, window_args['BASELINE_POINT_1'] + window_args['BASELINE_RANGE_1'])]
+    bl_range_2 = [collect_index(time, window_args['BASELINE_POINT_2'] - window_args['BASELINE_RANGE_2']),
+                  collect_index(time, window_args['BASELINE_POINT_2'] + window_args['BASELINE_RANGE_2'])]
+    sidebands  = np.r_[bl_range_1[0]:bl_range_1[1], bl_range_2[0]:bl_range_2[1]]
+
+    # Subtract the baseline value from the waveforms, contiguous rows give the same values as single waveforms
+    y_sideband = np.ascontiguousarray(data[:, sidebands])
+    match baseline_mode:
+        case 'mean':
+            sub_data = data - np.mean(y_sideband, axis=1)[:, np.newaxis]
+        case 'median':
+            sub_data = data - np.median(y_sideband, axis=1)[:, np.newaxis]
+        case _:
+            sub_data = data - subtract_baseline(y_sideband, sub_type=baseline_mode)
+
+    # Filter the subtracted waveforms
+    if filters:
+        sub_data = filter_block(sub_data, filters, bin_size)
+
+    # Suppress baseline
+    sup_data = suppress_baseline(sub_data, suppression_threshold)
+
+    # Flag secondary alphas
+    rejected = reject_secondaries(sup_data, peak_threshold, time, window_args['WINDOW_END'])
+    reasons  = np.where(rejected, types.SECONDARY_PEAK, types.ACCEPTED).astype(np.uint8)
+
+    return sup_data, reasons, time
+
+
+def cook_block(data : np.ndarray,
+                bin_size : int,
+                window_args : dict,
+                negative : Optional[bool] = False,
+                baseline_mode : Optional[str] = 'median',
+                peak_threshold : Optional[int] = 1000,
+                suppression_threshold : Optional[int] = 10,
+                filters : Optional[tuple] = None) -> (tuple):
+    '''
+    Processes a whole (N, samples) block of waveforms at once, giving identical waveforms to cook_data:
+    sideband baselines along the sample axis, broadcast subtraction, masked suppression and a secondary peak rejection mask.
+
+    Args:
+        data          (array)         :       (N, samples) waveform data
+        bin_size      (int)           :       Size of time bins within data
+        window_args   (dict)          :       Dictionary of window values for use in processing
+        negative      (bool)          :       Is the waveform negative?
+        baseline_mode (string)        :       Mode of the baseline subtraction (median, mean or none)
+        peak_threshold (int)          :       Threshold for removing peaks in ADCs
+        suppression_threshold (int)   :       Amplitude below which is set to zero
+        filters       (tuple)         :       Filters applied after baseline subtraction, see filter_block()
+
+    Returns:
+        results(
+            accepted   (array)        :       Processed waveforms that were not rejected
+            rejected   (array)        :       Row numbers of the rejected waveforms within the block
+        )
+    '''
+    sup_data, reasons, _ = _cook(data, bin_size, window_args, negative, baseline_mode,
+                                 peak_threshold, suppression_threshold, filters)
+    return sup_data[reasons == types.ACCEPTED], np.flatnonzero(reasons)
+
 
 def cook_data(data : np.ndarray,
                 bin_size : int,
@@ -82,9 +201,12 @@ def cook_data(data : np.ndarray,
                 baseline_mode : Optional[str] = 'median',
                 verbose : Optional[int] = 1,
                 peak_threshold : Optional[int] = 1000,
-                suppression_threshold : Optional[int] = 10) -> (np.ndarray):
+                suppression_threshold : Optional[int] = 10,
+                filters : Optional[tuple] = None) -> (np.ndarray):
     '''
     Takes in waveform data and outputs baseline subtracted, baseline suppressed, processed waveforms.
+    The whole chunk is processed at once by the same steps as cook_block. Rejected waveforms are no longer
+    reported one by one, a single summary of the chunk is printed instead (see selection_summary()).
 
     Args:
         data          (array)      :       Waveform data
@@ -94,140 +216,664 @@ def cook_data(data : np.ndarray,
         chunk_number  (int)           :       Number passed through to track iterations, acts as a label for the chunk
         negative      (bool)          :       Is the waveform negative?
         baseline_mode (string)        :       Mode of the baseline subtraction (median, mode, mean, etc.)
-        verbose       (int)           :       Print info: 0 is nothing, 1 is text only (e.g. rejected waveform numbers), 2 includes plots
+        verbose       (int)           :       Print info: 0 is nothing, 1 or more prints a summary of the chunk's rejected waveforms
         peak_threshold (int)        :       Threshold for removing peaks in ADCs
+        filters       (tuple)         :       Filters applied after baseline subtraction, see filter_block()
 
     Returns:
         results(
             sub_data   (array)        :       Baseline subtracted waveforms
         )
     '''
-    
-    # Unpack window arguments
-    WINDOW_START     = window_args['WINDOW_START']
-    WINDOW_END       = window_args['WINDOW_END']
-    BASELINE_POINT_1 = window_args['BASELINE_POINT_1']
-    BASELINE_POINT_2 = window_args['BASELINE_POINT_2']
-    BASELINE_RANGE_1 = window_args['BASELINE_RANGE_1']
-    BASELINE_RANGE_2 = window_args['BASELINE_RANGE_2']
 
-    # Define the time array
-    time = np.linspace(0, len(data[0]), num=len(data[0]), dtype=int) * bin_size
+    # Process the whole chunk at once
+    sup_data, reasons, _ = _cook(data, bin_size, window_args, negative, baseline_mode,
+                                 peak_threshold, suppression_threshold, filters)
 
-    wf_data = [] # Empty array for the waveform data to be put in
-    
-    for i, wf in enumerate(data):  # Process each waveform in the chunk individually
-        event_number = i + chunk_size * chunk_number # track the waveform number and the chunk number to keep track of the event number
-        if negative:
-            wf = -wf # Negative flip
-        # Check that window args agree with wf
-        if window_wf_check(wf, window_args):
-            # ### Baseline subtraction ###
-            # Collect the baselisune region data (sidebands)
-            bl_range_1 = [collect_index(time, BASELINE_POINT_1 - BASELINE_RANGE_1), collect_index(time, BASELINE_POINT_1 + BASELINE_RANGE_1)]
-            bl_range_2 = [collect_index(time, BASELINE_POINT_2 - BASELINE_RANGE_2), collect_index(time, BASELINE_POINT_2 + BASELINE_RANGE_2)]
-            y_sideband = wf[bl_range_1[0]:bl_range_1[1]]
-            y_sideband = list(y_sideband) + list(wf[bl_range_2[0]:bl_range_2[1]])
-
-            # Subtract the baseline value from the waveform
-            sub_wf = wf - subtract_baseline(y_sideband, sub_type=baseline_mode)
-        
-            # Suppress baseline
-            sup_wf = suppress_baseline(sub_wf, suppression_threshold)
-        
-            # Remove secondary alphas
-            final_wf = remove_secondaries(sup_wf, peak_threshold, time, event_number, verbose, WINDOW_END)
-            if final_wf is None:
+    # Summarise the rejected waveforms of the chunk
+    if verbose > 0 and reasons.any():
+        first = chunk_size * chunk_number # track the waveform number and the chunk number to keep track of the event number
+        print(f"Waveforms {first} to {first + len(reasons) - 1}: " + selection_summary(reason_counts(reasons)))
+
+    # Return subtracted waveforms
+    return list(sup_data[reasons == types.ACCEPTED])
+
+
+def reason_counts(reasons : np.ndarray) -> (np.ndarray):
+    '''
+    Counts the waveforms with each reason code (see types.selection_reasons)
+    '''
+    return np.bincount(reasons, minlength=len(types.selection_reasons)).astype(np.uint64)
+
+
+def selection_summary(counts : np.ndarray) -> (str):
+    '''
+    Summarises the number of waveforms with each reason code (see types.selection_reasons)
+
+    Params:
+    counts (array)                      :                   number of waveforms with each reason, from reason_counts()
+
+    Returns:
+    summary (str)                       :                   eg: '100 waveforms, 97 accepted, 3 secondary_peak'
+    '''
+    return ', '.join([f'{int(np.sum(counts))} waveforms'] +
+                     [f'{count} {name}' for name, count in zip(types.selection_reasons, counts) if count > 0])
+
+
+def budget_chunk_size(filepath : str,
+                       memory_budget : int,
+                       session : Optional[io.Session] = None) -> (int):
+    '''
+    Chooses how many waveforms to read and cook at once so that a chunk fits in the memory budget.
+    Each waveform costs its raw row plus the float64 copies made while cooking it
+    (flipped, subtracted, filtered and the stacked output), estimated as 4 copies of its samples.
+
+    Params:
+    filepath (str)                      :                   h5 file containing /RAW/rwf (or a legacy rwf group)
+    memory_budget (int)                 :                   bytes available for one chunk
+    session (io.Session)                :                   session to borrow the open file from
+
+    Returns:
+    chunk_size (int)                    :                   number of waveforms per chunk, at least 1
+    '''
+    rows = io.block_reader(filepath, 'RAW', 'rwf', 1, session=session)
+    try:
+        _, row = next(rows)
+    except StopIteration:
+        return 1
+    finally:
+        rows.close()
+    row_bytes = row.nbytes + 4 * row['rwf'][0].size * np.dtype(np.float64).itemsize
+    return max(1, int(memory_budget // row_bytes))
+
+
+def reference_samples(wf_data : np.ndarray,
+                       align : dict) -> (np.ndarray):
+    '''
+    Finds the reference time of each waveform of a block, in (fractional) samples:
+        peak - the highest sample, refined by a parabola through it and its neighbours
+        cfd  - where the rising edge of the highest peak crosses align['fraction'] (default 0.2) of its height
+
+    Params:
+    wf_data (array)                     :                   (N, samples) block of cooked waveforms
+    align (dict)                        :                   alignment options, see align_block()
+
+    Returns:
+    reference (array)                   :                   reference sample of each waveform, NaN where none is found
+    '''
+    samples = wf_data.shape[1]
+    match align.get('method', 'peak'):
+        case 'peak':
+            peak = np.argmax(wf_data, axis=1)
+            rows = np.arange(len(wf_data))
+            left, centre, right = (wf_data[rows, np.clip(peak + k, 0, samples - 1)] for k in (-1, 0, 1))
+            curve = left - 2 * centre + right
+            with np.errstate(divide='ignore', invalid='ignore'):
+                offset = np.where((peak > 0) & (peak < samples - 1) & (curve < 0), 0.5 * (left - right) / curve, 0)
+            return peak + offset
+        case 'cfd':
+            return timing_block(wf_data, np.arange(samples, dtype=np.float64), align.get('fraction', 0.2))[0]
+        case other:
+            raise ValueError(f"Invalid alignment method '{other}'. Expected 'peak' or 'cfd'.")
+
+
+def align_block(wf_data : np.ndarray,
+                 bin_size : int,
+                 align : dict) -> (tuple):
+    '''
+    Aligns a block of waveforms, shifting each by a fractional number of samples so that its
+    reference time (peak or CFD) lands on a common reference time, all in one batched step.
+
+    Params:
+    wf_data (array)                     :                   (N, samples) block of cooked waveforms
+    bin_size (int)                      :                   time spacing between bins in ns
+    align (dict)                        :                   alignment options:
+                                                                reference (float)  :  time (ns) the waveforms are aligned to
+                                                                method (str)       :  reference of each waveform, peak (default) or cfd
+                                                                fraction (float)   :  fraction of the peak height for cfd
+                                                                shift (str)        :  fft (default) phase shift or linear interpolation
+
+    Returns:
+        results(
+            aligned   (array)         :       Aligned waveforms
+            found     (array)         :       Boolean mask of the waveforms with a reference time, the others aren't shifted
+        )
+    '''
+    reference = reference_samples(wf_data, align)
+    found     = np.isfinite(reference)
+    shifts    = np.where(found, align['reference'] / bin_size - reference, 0)
+    return shift_block(wf_data, shifts, align.get('shift', 'fft')), found
+
+
+class PartialAverage(NamedTuple):
+    '''
+    Mergeable partial result of averaging waveforms: the running sum of the accepted waveforms,
+    their count and the files they came from, optionally with the sum of squared deviations
+    from the mean (m2, for the variance) and per sample histograms over hist_range (for quantiles).
+    reasons counts the waveforms read with each reason code (see types.selection_reasons), and examples
+    holds a few rejected (file, row, reason, waveform), file indexing files, for plotting.
+    Partials of different files or row ranges are combined with merge_partials().
+    '''
+    count      : int
+    sum        : Optional[np.ndarray]
+    m2         : Optional[np.ndarray]
+    hist       : Optional[np.ndarray]
+    hist_range : Optional[tuple]
+    files      : tuple
+    reasons    : Optional[np.ndarray] = None
+    examples   : tuple = ()
+
+
+def combine_moments(count_a : int,
+                     sum_a : np.ndarray,
+                     m2_a : np.ndarray,
+                     count_b : int,
+                     sum_b : np.ndarray,
+                     m2_b : np.ndarray) -> (np.ndarray):
+    '''
+    Combines the sums of squared deviations of two sets of waveforms (Chan et al., the batched form of Welford's update),
+    which stays accurate where the sum of squares would cancel.
+
+    Returns:
+    m2 (array)                          :                   sum of squared deviations from the mean of both sets
+    '''
+    if count_a == 0:
+        return m2_b
+    delta = sum_b / count_b - sum_a / count_a
+    return m2_a + m2_b + delta**2 * (count_a * count_b / (count_a + count_b))
+
+
+def sample_histograms(wf_data : np.ndarray,
+                       hist_range : tuple) -> (np.ndarray):
+    '''
+    Histograms every sample of a block of waveforms at once, with fixed bins.
+
+    Params:
+    wf_data (array)                     :                   (N, samples) block of waveforms
+    hist_range (tuple)                  :                   (low, high, bins) of the histograms
+
+    Returns:
+    hist (array)                        :                   (samples, bins + 2) counts, the first and last columns
+                                                            holding the under and overflow
+    '''
+    low, high, bins = hist_range
+    samples = wf_data.shape[1]
+    index   = np.floor((wf_data - low) * (bins / (high - low)))
+    index   = np.clip(np.nan_to_num(index, nan=-1), -1, bins).astype(np.intp) + 1
+    flat    = index + np.arange(samples) * (bins + 2)
+    return np.bincount(flat.ravel(), minlength=samples * (bins + 2)).reshape(samples, bins + 2).astype(np.uint64)
+
+
+def histogram_quantiles(hist : np.ndarray,
+                         hist_range : tuple,
+                         quantiles : tuple) -> (np.ndarray):
+    '''
+    Approximates per sample quantiles from per sample histograms, interpolating linearly within the bin
+    holding each quantile. Quantiles are accurate to a bin width, and clipped to the histogram range.
+
+    Params:
+    hist (array)                        :                   (samples, bins + 2) histograms from sample_histograms()
+    hist_range (tuple)                  :                   (low, high, bins) of the histograms
+    quantiles (tuple)                   :                   quantiles to find, between 0 and 1
+
+    Returns:
+    quantile_waveforms (array)          :                   (quantiles, samples) waveform of each quantile
+    '''
+    low, high, bins = hist_range
+    width  = (high - low) / bins
+    counts = hist.astype(np.float64)
+    cum    = np.cumsum(counts, axis=1)
+    rows   = np.arange(len(hist))
+
+    quantile_waveforms = np.empty((len(quantiles), len(hist)))
+    for i, q in enumerate(quantiles):
+        target = q * cum[:, -1]
+        column = np.minimum(np.sum(cum < target[:, np.newaxis], axis=1), bins + 1)
+        inside = np.clip(column, 1, bins)
+        below  = cum[rows, inside - 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.clip(np.nan_to_num((target - below) / counts[rows, inside]), 0, 1)
+        values = low + (inside - 1 + fraction) * width
+        quantile_waveforms[i] = np.where(column == 0, low, np.where(column == bins + 1, high, values))
+    return quantile_waveforms
+
+
+def partial_average(filepath : str,
+                     cook_args : dict,
+                     ranges : Optional[list] = None,
+                     chunk_size : Optional[int] = None,
+                     memory_budget : Optional[int] = 256 * 1024**2,
+                     variance : Optional[bool] = False,
+                     hist_range : Optional[tuple] = None,
+                     align : Optional[dict] = None,
+                     plot_sample : Optional[int] = 0,
+                     selection_path : Optional[str] = None) -> (PartialAverage):
+    '''
+    Streams the waveforms of one file (or row ranges of it) in chunks through the steps of cook_data,
+    keeping only the running sum and count, and optionally the sum of squared deviations
+    and per sample histograms, all filled in the same pass. The reason each waveform is kept or
+    rejected is counted rather than printed, and written chunk by chunk to selection_path if given.
+
+    Params:
+    filepath (str)                      :                   h5 file containing /RAW/rwf (or a legacy rwf group)
+    cook_args (dict)                    :                   keyword arguments of cook_data (bin_size, window_args, negative, ...)
+    ranges (list)                       :                   (start, stop) rows to average, the whole file if not given
+    chunk_size (int)                    :                   number of waveforms read and processed at once, chosen from memory_budget if not given
+    memory_budget (int)                 :                   bytes a chunk may use when chunk_size isn't given, see budget_chunk_size()
+    variance (bool)                     :                   also keep the sum of squared deviations from the mean
+    hist_range (tuple)                  :                   (low, high, bins) of per sample histograms to fill, none if not given
+    align (dict)                        :                   options for aligning the waveforms before accumulating them, see align_block().
+                                                            Waveforms without a reference time are left out
+    plot_sample (int)                   :                   number of rejected waveforms to keep as examples for plotting
+    selection_path (str)                :                   h5 file to write the selection rows (types.selection_type) of the file to,
+                                                            under ANA/selection with file 0, see write_selection()
+
+    Returns:
+    partial (PartialAverage)            :                   partial result for the file
+    '''
+    cook_args = {key: value for key, value in cook_args.items() if key != 'verbose'}
+    waveform_sum, waveform_m2, hist, num_waveforms = None, None, None, 0
+    counts, examples = reason_counts(np.zeros(0, dtype=np.uint8)), ()
+    selection = nullcontext() if selection_path is None else io.writer(selection_path, 'ANA', overwrite=True)
+    with io.Session() as session, selection as scribe:
+        chunk_size = chunk_size or budget_chunk_size(filepath, memory_budget, session)
+        if scribe is not None: # the table is written even if no rows are read
+            scribe('selection', np.zeros(0, dtype=types.selection_type))
+
+        for start_idx, chunk in io.block_reader(filepath, 'RAW', 'rwf', chunk_size, ranges=ranges, session=session):
+
+            # Process the chunk, flagging the waveforms to reject
+            sup_data, reasons, _ = _cook(chunk['rwf'], **cook_args)
+            sub_wf_chunk = np.asarray(sup_data[reasons == types.ACCEPTED], dtype=np.float64)
+
+            # Align the chunk to the common reference time
+            if align is not None and len(sub_wf_chunk) > 0:
+                sub_wf_chunk, found = align_block(sub_wf_chunk, cook_args['bin_size'], align)
+                reasons[np.flatnonzero(reasons == types.ACCEPTED)[~found]] = types.NO_REFERENCE
+                sub_wf_chunk = sub_wf_chunk[found]
+
+            # Record the selection, rows are the row numbers within the file
+            counts += reason_counts(reasons)
+            if scribe is not None:
+                chunk_selection = np.zeros(len(reasons), dtype=types.selection_type)
+                chunk_selection['row']    = start_idx + np.arange(len(reasons))
+                chunk_selection['reason'] = reasons
+                scribe('selection', chunk_selection)
+
+            # Keep the first rejected waveforms as examples
+            if len(examples) < plot_sample:
+                rejected = np.flatnonzero(reasons)[:plot_sample - len(examples)]
+                examples += tuple((0, start_idx + i, reasons[i], sup_data[i]) for i in rejected)
+
+            # Add the chunk of waveforms to the running sum unless its nowt (nowt means nothing)
+            if len(sub_wf_chunk) == 0:
                 continue
+            chunk_sum    = np.sum(sub_wf_chunk, axis=0)
+
+            # Initialise the waveform sums
+            if waveform_sum is None:
+                waveform_sum = np.zeros(sub_wf_chunk.shape[1], dtype=np.float64)
+                waveform_m2  = np.zeros(sub_wf_chunk.shape[1], dtype=np.float64) if variance else None
+                hist         = 0 if hist_range is not None else None
+
+            if variance:
+                chunk_m2    = np.sum((sub_wf_chunk - chunk_sum / len(sub_wf_chunk))**2, axis=0)
+                waveform_m2 = combine_moments(num_waveforms, waveform_sum, waveform_m2, len(sub_wf_chunk), chunk_sum, chunk_m2)
+            if hist_range is not None:
+                hist = hist + sample_histograms(sub_wf_chunk, hist_range)
+
+            waveform_sum += chunk_sum
+
+            # Update the number of waveforms processed
+            num_waveforms += len(sub_wf_chunk)
+
+    return PartialAverage(num_waveforms, waveform_sum, waveform_m2, hist,
+                          None if hist_range is None else tuple(hist_range), (os.path.abspath(filepath),),
+                          counts, examples)
+
+
+def merge_partials(partials : list) -> (PartialAverage):
+    '''
+    Reduces partial averages into one, summing their counts, sums and histograms and combining their
+    sums of squared deviations. Variances and histograms are only kept if every partial has them
+    (over the same range). Files are listed once, in the order first seen, the reason counts are summed
+    and the examples concatenated with their file numbers renumbered to match.
+
+    Params:
+    partials (list of PartialAverage)   :                   partial results to merge
+
+    Returns:
+    partial (PartialAverage)            :                   merged result, empty if no partials were given
+    '''
+    filled   = [partial for partial in partials if partial.count > 0]
+    variance = all(partial.m2 is not None for partial in filled)
+    ranges   = {partial.hist_range for partial in filled}
+    hist_range = ranges.pop() if len(ranges) == 1 and all(partial.hist is not None for partial in filled) else None
+
+    count, total, m2, hist, files = 0, None, None, None, ()
+    counts, examples = reason_counts(np.zeros(0, dtype=np.uint8)), ()
+    for partial in partials:
+        files += tuple(file for file in partial.files if file not in files)
+        if partial.reasons is not None:
+            counts = counts + partial.reasons
+        examples += tuple((files.index(partial.files[file]), row, reason, wf) for file, row, reason, wf in partial.examples)
+    for partial in filled:
+        if total is None:
+            total = np.zeros_like(partial.sum, dtype=np.float64)
+            m2    = np.zeros_like(partial.sum, dtype=np.float64) if variance else None
+            hist  = 0 if hist_range is not None else None
+        if total.shape != partial.sum.shape:
+            raise ValueError(f"Partial averages of {total.shape[0]} and {partial.sum.shape[0]} samples can't be merged.")
+        if variance:
+            m2 = combine_moments(count, total, m2, partial.count, partial.sum, partial.m2)
+        if hist_range is not None:
+            hist = hist + partial.hist
+        count += partial.count
+        total += partial.sum
+    return PartialAverage(count, total, m2, hist, hist_range, files, counts, examples)
+
+
+def save_partial(partial : PartialAverage,
+                  save_path : str) -> None:
+    '''
+    Saves a partial average to an h5 file, so later averages can reuse it (see load_partial())
+
+    Params:
+    partial (PartialAverage)            :                   partial result to save
+    save_path (str)                     :                   path of the h5 file, overwritten if it exists
+    '''
+    with h5py.File(save_path, 'w') as f:
+        gr = f.create_group('partial_average')
+        gr.attrs['count'] = partial.count
+        gr.attrs['files'] = list(partial.files)
+        for name in ('sum', 'm2', 'hist', 'reasons'):
+            if getattr(partial, name) is not None:
+                gr.create_dataset(name, data=getattr(partial, name))
+        if partial.hist_range is not None:
+            gr.attrs['hist_range'] = partial.hist_range
+
+
+def load_partial(path : str) -> (PartialAverage):
+    '''
+    Loads a partial average saved by save_partial()
+
+    Params:
+    path (str)                          :                   path of the h5 file
+
+    Returns:
+    partial (PartialAverage)            :                   saved partial result
+    '''
+    with h5py.File(path, 'r') as f:
+        gr = f['partial_average']
+        hist_range = gr.attrs.get('hist_range')
+        return PartialAverage(int(gr.attrs['count']),
+                              gr['sum'][:] if 'sum' in gr else None,
+                              gr['m2'][:] if 'm2' in gr else None,
+                              gr['hist'][:] if 'hist' in gr else None,
+                              None if hist_range is None else (hist_range[0], hist_range[1], int(hist_range[2])),
+                              tuple(str(file) for file in gr.attrs['files']),
+                              gr['reasons'][:] if 'reasons' in gr else None)
+
+
+def write_selection(selections : list,
+                     files : tuple,
+                     save_path : str,
+                     block_size : Optional[int] = 2**20) -> None:
+    '''
+    Writes the selection of an analysis to ANA/selection of an h5 file, one row per waveform read
+    with its file (indexing the `files` attribute of ANA), row in /RAW/rwf and reason code
+    (indexing the `reasons` attribute of ANA, see types.selection_reasons). The selections
+    written by partial_average() for each unit of work are copied across in blocks.
+
+    Params:
+    selections (list)                   :                   (file averaged, h5 file holding its selection) of each unit of work, in order
+    files (tuple)                       :                   paths of the files the selection rows refer to
+    save_path (str)                     :                   path of the h5 file, any earlier ANA group is replaced
+    block_size (int)                    :                   number of selection rows copied at once
+    '''
+    attrs = {'files' : list(files), 'reasons' : list(types.selection_reasons)}
+    with io.writer(save_path, 'ANA', overwrite=True, metadata=attrs) as scribe:
+        # the table is written even if no waveforms were read
+        scribe('selection', np.zeros(0, dtype=types.selection_type))
+        for filepath, unit_path in selections:
+            for _, block in io.block_reader(unit_path, 'ANA', 'selection', block_size):
+                block['file'] = files.index(os.path.abspath(filepath))
+                scribe('selection', block)
+
+
+def plot_rejections(examples : tuple,
+                     files : tuple,
+                     bin_size : int,
+                     WINDOW_END : float,
+                     save_path : str) -> None:
+    '''
+    Plots example rejected waveforms on a grid of panels saved to a file, in place of plotting every
+    rejected waveform as it is found.
+
+    Params:
+    examples (tuple)                    :                   (file, row, reason, waveform) of each rejected waveform to plot
+    files (tuple)                       :                   paths of the files the examples refer to
+    bin_size (int)                      :                   time spacing between bins in ns
+    WINDOW_END (float)                  :                   end of the first signal, marked on each panel
+    save_path (str)                     :                   path of the figure, its extension sets the format
+    '''
+    columns = min(len(examples), 4) or 1
+    rows    = -(-len(examples) // columns) or 1
+    fig, axes = plt.subplots(rows, columns, figsize=(4 * columns, 3 * rows), squeeze=False)
+    for ax, (file, row, reason, wf) in zip(axes.flat, examples):
+        ax.plot(cook_time(len(wf), bin_size), wf)
+        ax.axvline(WINDOW_END, c = 'r', ls = '--')
+        ax.set_title(f'{os.path.basename(files[file])} row {row}: {types.selection_reasons[reason]}', fontsize=8)
+        ax.set_xlabel('Time (ns)')
+        ax.set_ylabel('ADCs')
+    for ax in axes.flat[len(examples):]:
+        ax.set_visible(False)
+    fig.tight_layout()
+    fig.savefig(save_path)
+    plt.close(fig)
+
+
+def split_rows(num_rows : int,
+                pieces : int) -> (list):
+    '''
+    Splits the rows of a file into at most `pieces` contiguous (start, stop) ranges of similar size
+    '''
+    bounds = np.linspace(0, num_rows, num=min(pieces, max(num_rows, 1)) + 1, dtype=int)
+    return [[(int(start), int(stop))] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def accumulate_waveforms(files : list,
+                          cook_args : dict,
+                          chunk_size : Optional[int] = None,
+                          memory_budget : Optional[int] = 256 * 1024**2,
+                          workers : Optional[int] = 1,
+                          partials : Optional[list] = None,
+                          save_partial_path : Optional[str] = None,
+                          variance : Optional[bool] = False,
+                          hist_range : Optional[tuple] = None,
+                          align : Optional[dict] = None,
+                          rejection_plots : Optional[str] = None,
+                          plot_sample : Optional[int] = 20,
+                          selection_path : Optional[str] = None) -> (PartialAverage):
+    '''
+    Streams every file through cook_data once, accumulating the partial averages of each file (split into
+      row ranges when there are more workers than files) across a pool of processes if workers > 1, then merges them.
+      Partials saved from earlier runs can be passed in, files they already include are skipped, and the merged
+      partial can be saved to extend it later. A summary of the selection is printed at the end (if verbose),
+      example rejected waveforms are plotted to rejection_plots and the selection rows of the files processed
+      are written to ANA/selection of selection_path. See average_waveforms() for the parameters.
+
+    Returns:
+    partial (PartialAverage)            :                   merged partial average of every file
+    '''
+    # Reuse earlier work, skipping the files it already covers
+    previous = merge_partials([load_partial(path) for path in partials or []])
+    if previous.count > 0:
+        print(f"Reusing {previous.count} waveforms from {len(previous.files)} files")
+
+    # Split the remaining files into units of work, a file or a row range of it
+    units = []
+    pieces = -(-(workers or 1) // max(len(files), 1))
+    for filepath in files:
+        if not os.path.exists(filepath):
+            print(f"File not found: {filepath}")
+        elif os.path.abspath(filepath) in previous.files:
+            print(f"Already averaged: {filepath}")
         else:
-            print(f"Waveform {event_number} didn't match window arguments, hence not included")
-            continue
-        wf_data.append(final_wf)
+            print(f"Processing file: {filepath}")
+            ranges = [None] if pieces == 1 else split_rows(io.check_rows(filepath, 'RAW', 'rwf'), pieces)
+            units += [(filepath, cook_args, file_ranges, chunk_size, memory_budget, variance, hist_range, align,
+                       plot_sample if rejection_plots else 0) for file_ranges in ranges]
+
+    with tempfile.TemporaryDirectory() as selection_dir:
+        # Each unit streams its selection to a file of its own, copied into selection_path in order
+        if selection_path is not None:
+            units = [unit + (os.path.join(selection_dir, f'selection_{i}.h5'),) for i, unit in enumerate(units)]
+
+        if workers is None or workers <= 1:
+            results = [partial_average(*unit) for unit in units]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(partial_average, *zip(*units))) if units else []
+
+        # Reduce in a fixed order, so the result doesn't depend on which worker finished first
+        merged = merge_partials([previous] + results)
+        if selection_path is not None:
+            write_selection([(unit[0], unit[-1]) for unit in units], merged.files, selection_path)
+    if save_partial_path is not None:
+        save_partial(merged, save_partial_path)
+
+    # Report the rejected waveforms once, for the whole selection
+    if cook_args.get('verbose', 1) > 0:
+        print("Selection: " + selection_summary(merged.reasons))
+    if rejection_plots is not None:
+        plot_rejections(merged.examples[:plot_sample], merged.files, cook_args['bin_size'],
+                        cook_args['window_args']['WINDOW_END'], rejection_plots)
+
+    if merged.count == 0: #Check that we have some waveforms
+        raise ValueError("No valid waveforms after processing")
+    return merged
 
-    # Return subtracted waveforms
-    return wf_data
 
 def average_waveforms(files : list,
                        bin_size : int,
                        window_args : dict,
-                       chunk_size : Optional[int] = 5,
+                       chunk_size : Optional[int] = None,
                        negative : Optional[bool] = True, 
                        baseline_mode: Optional[str] = 'median', 
                        verbose : Optional[int] = 1, 
                        peak_threshold: Optional[int] = 1000,
-                       suppression_threshold: Optional[int] = 10) -> (np.ndarray):
+                       suppression_threshold: Optional[int] = 10,
+                       filters: Optional[tuple] = None,
+                       memory_budget: Optional[int] = 256 * 1024**2,
+                       workers: Optional[int] = 1,
+                       partials: Optional[list] = None,
+                       save_partial_path: Optional[str] = None,
+                       align: Optional[dict] = None,
+                       rejection_plots: Optional[str] = None,
+                       plot_sample: Optional[int] = 20,
+                       selection_path: Optional[str] = None) -> (np.ndarray):
     '''
-    Averages waveforms. Takes in multiple h5 files, splits the data into chunks for processing ease and analyses them. The chunks are passed into cook_data,
-      which flips polarity, subtracts baseline, removes events with large secondary peaks and suppresses baseline. This function then averages this data to form a single
-      average waveform.
+    Averages waveforms. Takes in multiple h5 files, streams the waveforms of /RAW/rwf (or the rwf group of older files) in chunks
+      and analyses them. The chunks are passed into cook_data, which flips polarity, subtracts baseline, removes events with large
+      secondary peaks and suppresses baseline. Only a running sum and count are kept, so the memory used doesn't grow with the files.
+      This function then averages this data to form a single average waveform.
+
+    Each file (split into row ranges when there are more workers than files) gives a partial average, computed across a pool of
+      processes if workers > 1, which are then merged. Partials saved from earlier averages can be passed in, files they already
+      include are skipped, and the merged partial can be saved to extend the average later.
 
     Params:
     files (list of str)                 :                   list of h5 files contsaining waveform data
     bin_size (int)                      :                   time spacing between bins in ns
     window_args (array)                 :                   array of the 'windows' aka band for signal and baseline sidebands
-    chunk_size (int)                    :                   size of data chunks for ease of processing
+    chunk_size (int)                    :                   number of waveforms read and processed at once, chosen from memory_budget if not given
     negative (bool)                     :                   is the waveform negative in amplitude?
     baseline_mode (str)                 :                   method of baseline subtraction
-    verbose (int)                       :                   amount of live infor wanted, 0 for none, 1 for words, 2 for plots
+    verbose (int)                       :                   amount of info wanted, 0 for none, 1 or more for a summary of the rejected waveforms
     peak_threshold (int)                :                   amplitude of secondary peaks rejected
     suppression_threshold (int)         :                   amplitude below which is set to zero for baseline suppression
+    filters (tuple of dict)             :                   filters applied after baseline subtraction, see filter_block()
+    memory_budget (int)                 :                   bytes a chunk may use when chunk_size isn't given, see budget_chunk_size()
+    workers (int)                       :                   number of processes averaging files (or row ranges) in parallel
+    partials (list of str)              :                   partial averages saved by earlier runs to include, see save_partial()
+    save_partial_path (str)             :                   path to save the merged partial average to, for reuse
+    align (dict)                        :                   align each waveform's peak or CFD time to a common reference
+                                                            by a sub-sample shift before averaging, see align_block()
+    rejection_plots (str)               :                   path of a figure of example rejected waveforms, none if not given
+    plot_sample (int)                   :                   number of rejected waveforms plotted to rejection_plots
+    selection_path (str)                :                   h5 file to write the selection of the waveforms read to, see write_selection()
 
     Returns:
     average_waveform (array)            :                   data for final average waveform
     '''
-
-    # Variables to accumulate sum and count
-    waveform_sum = None
-    num_waveforms = 0
-    chunk_number = 0
-    # Loop through each file and process the waveforms in chunks
-    for filepath in files:
-        if os.path.exists(filepath):
-            print(f"Processing file: {filepath}")
-
-            x = io.load_rwf_info(filepath, samples=2)
-            waveforms = x.rwf.values
-
-            # Get the total number of waveforms in the current file
-            total_waveforms = waveforms.shape[0]
-
-            # Process the data in chunks to avoid memory overload, cooks data in chunks also
-            for start_idx in range(0, total_waveforms, chunk_size):
-                end_idx = min(start_idx + chunk_size, total_waveforms)
-                waveform_chunk = waveforms[start_idx:end_idx]
-
-                # Process the chunk, passing the event_number
-                sub_wf_chunk = cook_data(
-                    waveform_chunk, bin_size, window_args, chunk_size, chunk_number, negative, 
-                    baseline_mode, verbose, peak_threshold, suppression_threshold
-                )
-
-                # Add the chunk of waveforms to the running sum unless its nowt (nowt means nothing)
-                if len(sub_wf_chunk) == 0:
-                    continue
-
-                # Initialise the waveform sum
-                if waveform_sum is None:
-                    waveform_sum = np.zeros_like(sub_wf_chunk[0], dtype=np.float64)
-
-                waveform_sum += np.sum(sub_wf_chunk, axis=0)
-            
-                # Update the number of waveforms processed
-                num_waveforms += len(sub_wf_chunk)
-            
-                chunk_number +=1
-                
-        else:
-            print(f"File not found: {filepath}")
-  
-    if num_waveforms == 0: #Check that we have some waveforms
-        raise ValueError("No valid waveforms after processing")
+    cook_args = dict(bin_size=bin_size, window_args=window_args, negative=negative, baseline_mode=baseline_mode, verbose=verbose,
+                     peak_threshold=peak_threshold, suppression_threshold=suppression_threshold, filters=filters)
+    merged = accumulate_waveforms(files, cook_args, chunk_size, memory_budget, workers, partials, save_partial_path, align=align,
+                                  rejection_plots=rejection_plots, plot_sample=plot_sample, selection_path=selection_path)
 
     # Average the waveforms
-    average_waveform = waveform_sum / num_waveforms
-    del x
+    average_waveform = merged.sum / merged.count
     return average_waveform
 
+
+def waveform_statistics(files : list,
+                         bin_size : int,
+                         window_args : dict,
+                         chunk_size : Optional[int] = None,
+                         negative : Optional[bool] = True,
+                         baseline_mode: Optional[str] = 'median',
+                         verbose : Optional[int] = 1,
+                         peak_threshold: Optional[int] = 1000,
+                         suppression_threshold: Optional[int] = 10,
+                         filters: Optional[tuple] = None,
+                         memory_budget: Optional[int] = 256 * 1024**2,
+                         workers: Optional[int] = 1,
+                         partials: Optional[list] = None,
+                         save_partial_path: Optional[str] = None,
+                         quantiles: Optional[tuple] = None,
+                         quantile_range: Optional[tuple] = None,
+                         align: Optional[dict] = None,
+                         rejection_plots: Optional[str] = None,
+                         plot_sample: Optional[int] = 20,
+                         selection_path: Optional[str] = None) -> (dict):
+    '''
+    Computes the average waveform alongside the per sample standard deviation, RMS envelope and (approximate)
+      quantile waveforms, in the same single streaming pass as average_waveforms(). The variance is accumulated
+      with Welford's method (combined across chunks and files), the quantiles from fixed bin histograms of every sample.
+
+    Params:
+    (as average_waveforms(), with)
+    quantiles (tuple)                   :                   quantiles to find, between 0 and 1 (eg: (0.16, 0.5, 0.84))
+    quantile_range (tuple)              :                   (low, high, bins) of the per sample histograms the quantiles
+                                                            are found from, quantiles are accurate to a bin width
+
+    Returns:
+    statistics (dict)                   :                   Average_waveform, Std_waveform and RMS_waveform arrays,
+                                                            and Quantile_waveforms (quantiles, samples) if quantiles were given
+    '''
+    if quantiles and quantile_range is None:
+        raise ValueError("quantile_range (low, high, bins) is needed to find quantiles")
+
+    cook_args = dict(bin_size=bin_size, window_args=window_args, negative=negative, baseline_mode=baseline_mode, verbose=verbose,
+                     peak_threshold=peak_threshold, suppression_threshold=suppression_threshold, filters=filters)
+    merged = accumulate_waveforms(files, cook_args, chunk_size, memory_budget, workers, partials, save_partial_path,
+                                  variance=True, hist_range=quantile_range if quantiles else None, align=align,
+                                  rejection_plots=rejection_plots, plot_sample=plot_sample, selection_path=selection_path)
+    if merged.m2 is None:
+        raise ValueError("The partial averages provided don't hold the variance, they can only be used by average_waveforms()")
+
+    average  = merged.sum / merged.count
+    variance = merged.m2 / merged.count
+    statistics = {'Average_waveform' : average,
+                  'Std_waveform'     : np.sqrt(variance),
+                  'RMS_waveform'     : np.sqrt(variance + average**2)}
+    if quantiles:
+        if merged.hist is None:
+            raise ValueError("The partial averages provided don't hold histograms over quantile_range")
+        statistics['Quantile_waveforms'] = histogram_quantiles(merged.hist, merged.hist_range, quantiles)
+    return statistics
+
 def window_overlap_check(window_args: dict):
     '''
     Checks that window args dont overlap with one another
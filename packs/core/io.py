@@ -5,87 +5,542 @@ import numpy  as np
 
 import h5py
 import ast
+import time
+import tempfile
 import configparser
+import warnings
 
 from contextlib import contextmanager
+from contextlib import ExitStack
 
 from typing import Optional
 from typing import Generator
 from typing import Union
 from typing import Tuple
+from typing import List
 
 from packs.types import types
 
 
-def load_evt_info(file_path, merge = False):
+class Session:
+    '''
+    Pool of open h5 files shared between the readers, writers and loaders of a
+    pipeline, so that each file is opened once rather than by every function call.
+    Particularly useful on network filesystems, where each open is expensive.
+
+    Files are opened on first request and kept open until the session is closed.
+    A read request is served by any open handle, a write request ('r+', 'a', 'w')
+    needs a writable one. If a file opened read-only is later requested for writing,
+    it is reopened with 'a', invalidating any handles already taken from it, so
+    declare the access mode of files that are both read and written up front
+    with `modes`. A file already open in the session is never truncated.
+    The `legacy_view()` of an older chunked file is likewise built once per session.
+
+    The HDF5 chunk cache can be tuned for the whole session with `rdcc_nbytes`
+    (cache size in bytes per dataset) and `rdcc_nslots` (number of hash slots,
+    ideally a prime ~100 times the number of chunks that fit in the cache).
+
+    Example:
+
+    >> with Session(modes = {'run.h5' : 'a'}, rdcc_nbytes = 64 * 1024**2) as session:
+    >>     for row in reader('run.h5', 'RAW', 'rwf', session = session):
+    >>         ...
+    '''
+
+    def __init__(self,
+                 modes        :  Optional[dict] = None,
+                 rdcc_nbytes  :  Optional[int]  = None,
+                 rdcc_nslots  :  Optional[int]  = None):
+        self.modes      = {os.path.abspath(path) : mode for path, mode in (modes or {}).items()}
+        self.cache      = {key : value for key, value in [('rdcc_nbytes', rdcc_nbytes),
+                                                          ('rdcc_nslots', rdcc_nslots)] if value is not None}
+        self.handles    = {}
+        self.views      = {}
+        self.stack      = ExitStack()
+
+    def open(self,
+             path  :  str,
+             mode  :  Optional[str] = 'r') -> h5py.File:
+        '''
+        Returns an open handle to the file with at least the requested access
+        '''
+        path     = os.path.abspath(path)
+        writable = mode != 'r'
+        h5f      = self.handles.get(path)
+        if h5f is not None and h5f.id.valid:
+            if not writable or h5f.mode == 'r+':
+                return h5f
+            # upgrade a read-only handle
+            h5f.close()
+
+        mode = self.modes.get(path, mode)
+        if (h5f is not None) and mode in ('w', 'w-', 'x'):
+            mode = 'a'
+        self.handles[path] = h5py.File(path, mode, **self.cache)
+        return self.handles[path]
+
+    def view(self,
+             path  :  str) -> h5py.File:
+        '''
+        Returns the `legacy_view()` of an older chunked file, built on first request
+        and kept until the session is closed
+        '''
+        path = os.path.abspath(path)
+        if path not in self.views:
+            self.views[path] = self.stack.enter_context(legacy_view(path))
+        return self.views[path]
+
+    def flush(self):
+        for h5f in self.handles.values():
+            if h5f.id.valid and h5f.mode == 'r+':
+                h5f.flush()
+
+    def close(self):
+        self.stack.close()
+        self.views = {}
+        for h5f in self.handles.values():
+            if h5f.id.valid:
+                h5f.close()
+        self.handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextmanager
+def _open(path     :  str,
+          mode     :  Optional[str]     = 'r',
+          session  :  Optional[Session] = None) -> Generator:
+    '''
+    Opens an h5 file for the duration of the context, or borrows it from the session
+    (in which case it stays open afterwards).
+    '''
+    if session is None:
+        with h5py.File(path, mode) as h5f:
+            yield h5f
+    else:
+        yield session.open(path, mode)
+
+
+# legacy chunked groups and the /RAW datasets they map onto
+legacy_groups = {'event_information' : 'event_info',
+                 'rwf'               : 'rwf'}
+
+
+def _block_order(key  :  str) -> Tuple:
+    '''
+    Sorts legacy blocks (ei_N, rwf_N or N) by the event number they start at,
+    rather than alphabetically where rwf_100 would precede rwf_20.
+    '''
+    try:
+        return (0, int(key.rsplit('_', 1)[-1]))
+    except ValueError:
+        return (1, key)
+
+
+def _legacy_layouts(h5f     :  h5py.File,
+                    source  :  str) -> dict:
+    '''
+    Builds virtual layouts concatenating the blocks of each legacy group of an open
+    file, in event order. `source` is the file name the layouts point at
+    ('.' for the file itself).
+    '''
+    layouts = {}
+    for legacy, dataset in legacy_groups.items():
+        if legacy not in h5f:
+            continue
+        blocks = [h5f[legacy][key] for key in sorted(h5f[legacy].keys(), key = _block_order)]
+        if len(set(block.dtype for block in blocks)) > 1:
+            raise ValueError(f"Blocks of /{legacy} don't share a data-type, they can't be viewed as one dataset.")
+        if len(blocks) == 0:
+            continue
+
+        layout = h5py.VirtualLayout(shape = (sum(block.shape[0] for block in blocks),), dtype = blocks[0].dtype)
+        start  = 0
+        for block in blocks:
+            length = block.shape[0]
+            layout[start:start + length] = h5py.VirtualSource(source, block.name, shape = (length,), dtype = block.dtype)
+            start += length
+        layouts[dataset] = layout
+
+    return layouts
+
+
+def migrate_legacy(file_path  :  str,
+                   save_path  :  Optional[str]  = None,
+                   overwrite  :  Optional[bool] = False) -> None:
+    '''
+    Migrates an older chunked file (/event_information/ei_N and /rwf/rwf_N blocks,
+    as written by `save_data()`) to the current layout, exposing the blocks as a single
+    /RAW/event_info and /RAW/rwf through HDF5 virtual datasets. No data is copied.
+
+    Rows keep their per row run constants, so the result reads as schema 1.
+
+    Parameters
+    ----------
+
+    file_path (str)   :  Path to the legacy file
+    save_path (str)   :  Path to write the /RAW group to, by default the legacy file itself.
+                         A separate file must keep pointing at the legacy file's path.
+    overwrite (bool)  :  Replace a /RAW group that already exists
+    '''
+    in_place = (save_path is None) or (os.path.abspath(save_path) == os.path.abspath(file_path))
+    with h5py.File(file_path, 'a' if in_place else 'r') as h5f:
+        layouts = _legacy_layouts(h5f, '.' if in_place else os.path.abspath(file_path))
+
+    if len(layouts) == 0:
+        raise ValueError(f'{file_path} has no legacy chunked groups to migrate.')
+
+    with h5py.File(file_path if in_place else save_path, 'a') as h5f:
+        if 'RAW' in h5f:
+            if not overwrite:
+                raise ValueError(f"/RAW already exists in {h5f.filename}, set overwrite to replace it.")
+            del h5f['RAW']
+        gr = h5f.create_group('RAW')
+        gr.attrs['migrated_from'] = os.path.abspath(file_path)
+        for dataset, layout in layouts.items():
+            gr.create_virtual_dataset(dataset, layout)
+
+
+@contextmanager
+def legacy_view(file_path  :  str) -> Generator:
+    '''
+    Read-time shim for older chunked files, providing the /RAW layout without modifying
+    the file. The virtual datasets are held in a temporary file for the duration of the context.
+
+    Parameters
+    ----------
+
+    file_path (str)  :  Path to the legacy file
+
+    Returns
+    -------
+
+    (h5py.File)      :  Read-only file holding /RAW/event_info and /RAW/rwf
+    '''
+    fd, view_path = tempfile.mkstemp(suffix = '.h5')
+    os.close(fd)
+    try:
+        with h5py.File(file_path, 'r') as h5f:
+            layouts = _legacy_layouts(h5f, os.path.abspath(file_path))
+        with h5py.File(view_path, 'w') as view:
+            gr = view.create_group('RAW')
+            for dataset, layout in layouts.items():
+                gr.create_virtual_dataset(dataset, layout)
+        with h5py.File(view_path, 'r') as view:
+            yield view
+    finally:
+        os.remove(view_path)
+
+
+@contextmanager
+def _open_group(path     :  str,
+                group    :  str,
+                mode     :  Optional[str]     = 'r',
+                session  :  Optional[Session] = None) -> Generator:
+    '''
+    Opens a group of an h5 file for the duration of the context. Requests for /RAW
+    on older chunked files are served through `legacy_view()`, so that old and new
+    files are read the same way. Within a session the view is reused.
+    '''
+    with _open(path, mode, session) as h5f:
+        if group == 'RAW' and 'RAW' not in h5f and any(legacy in h5f for legacy in legacy_groups):
+            if session is not None:
+                yield session.view(path)['RAW']
+            else:
+                with legacy_view(path) as view:
+                    yield view['RAW']
+        else:
+            yield h5f[group]
+
+
+def load_evt_info(file_path, merge = None, session = None):
     '''
     Loads in a processed WD .h5 file as pandas DataFrame, extracting event information tables.
     This function allows the processed WD .h5 file to be chunked or unchunked.
     Chunked is the older file format where the h5 structure is of the form /event_information/block$NUM_values.
     Unchunked is of the form /RAW/event_info without any block$NUM_values.
+    Chunked files are read through a virtual /RAW/event_info, see `legacy_view()`.
+
+    For schema 2 files the run constants (samples, sampling_period, channels) are
+    stored once on the RAW group, and are broadcast back into each row here so the
+    output matches that of older files.
 
     Parameters
     ----------
 
-    file_path (str)   :  Path to saved data
-    merge     (bool)  :  Flag for merging chunked data
+    file_path (str)      :  Path to saved data
+    merge     (bool)     :  Deprecated and ignored, chunked data is always merged
+    session   (Session)  :  Session to borrow the open file from (OPTIONAL)
 
     Returns
     -------
 
     (pd.DataFrame)  :  Dataframe of event information
     '''
-    h5_data = []
-    with h5py.File(file_path) as f:
-        # extract event info
-        if list(f.keys())[0] == 'RAW': # case for unchunked data
-            evt_info = f.get('RAW/event_info')
-            h5_data = evt_info[:]
-        else:
-            evt_info = f.get('event_information') # case for chunked data
-            for i in evt_info.keys():
-                q = evt_info.get(str(i))
-                for j in q:
-                    h5_data.append(j)
+    if merge is not None:
+        warnings.warn("load_evt_info() 'merge' is deprecated and ignored, chunked files are always merged.",
+                      DeprecationWarning, stacklevel = 2)
+    with _open_group(file_path, 'RAW', 'r', session) as raw:
+        h5_data = raw['event_info'][:]
+        if raw.attrs.get('schema_version', 1) >= 2:
+            h5_data = widen_event_info(h5_data, _attrs_to_dict(raw.attrs))
 
     return pd.DataFrame(map(list, h5_data), columns = (types.event_info_type).names)
 
 def load_rwf_info(file_path  :  str,
-                  samples    :  int) -> list:
+                  samples    :  int,
+                  session    :  Optional[Session] = None) -> list:
     '''
     Loads in a processed WD .h5 file as pandas dataframe, extracting raw waveform tables.
     Samples must be provided, and can be found using `load_evt_info()`.
     This function allows the processed WD .h5 file to be chunked or unchunked.
     Chunked is the older file format where the h5 structure is of the form /rwf/block$NUM_values.
     Unchunked is of the form /RAW/rwf without any block$NUM_values.
+    Chunked files are read through a virtual /RAW/rwf, see `legacy_view()`.
+    Compact files are widened to the default data-type of their decoder.
 
     Parameters
     ----------
 
-    file_path (str)  :  Path to saved data
-    samples   (int)  :  Number of samples in each raw waveform
+    file_path (str)      :  Path to saved data
+    samples   (int)      :  Number of samples in each raw waveform
+    session   (Session)  :  Session to borrow the open file from (OPTIONAL)
 
     Returns
     -------
 
     (pd.DataFrame)  :  Dataframe of raw waveform information
     '''
-    h5_data = []
-    with h5py.File(file_path) as f:
-        if list(f.keys())[0] == 'RAW':
-            rwf_info = f.get('RAW/rwf')
-            h5_data = rwf_info[:]
-        else:
-            rwf_info = f.get('rwf')
-            for i in rwf_info.keys():
-                q = rwf_info.get(str(i))
-                for j in q:
-                    h5_data.append(j)
+    with _open_group(file_path, 'RAW', 'r', session) as raw:
+        h5_data = widen_rwf(raw['rwf'][:], _attrs_to_dict(raw.attrs))
 
     return pd.DataFrame(map(list, h5_data), columns = (types.rwf_type(samples)).names)
 
 
-def check_chunking(file  :  str) -> Tuple[bool, list, int, list]:
+def load_constants(source   :  Union[str, np.ndarray],
+                   session  :  Optional[Session] = None) -> np.ndarray:
+    '''
+    Loads calibration constants of `types.gain_constants_type`, as written by `fit_gain()`.
+
+    Parameters
+    ----------
+
+    source   (str | ndarray)  :  Path to a .npy file of constants, or to an .h5 file holding
+                                 /CALI/gain/constants. Arrays of constants are passed through.
+    session  (Session)        :  Session to borrow the open file from (OPTIONAL)
+
+    Returns
+    -------
+
+    (np.ndarray)              :  Constants, one row per channel
+    '''
+    if isinstance(source, np.ndarray):
+        return source
+    if str(source).endswith('.npy'):
+        return np.load(source)
+    with _open(source, 'r', session) as h5f:
+        if 'CALI/gain/constants' not in h5f:
+            raise ValueError(f'{source} holds no calibration constants, run fit_gain on it first.')
+        return h5f['CALI/gain/constants'][:]
+
+
+def to_photoelectrons(Q          :  np.ndarray,
+                      channels   :  np.ndarray,
+                      constants  :  np.ndarray) -> np.ndarray:
+    '''
+    Converts charges to photoelectrons, subtracting each channel's pedestal and dividing
+    by its gain through a lookup table indexed by channel. Channels without constants
+    are given NaN.
+
+    Parameters
+    ----------
+
+    Q          (np.ndarray)  :  Integrated charges
+    channels   (np.ndarray)  :  Channel of each charge
+    constants  (np.ndarray)  :  Constants of `types.gain_constants_type`
+
+    Returns
+    -------
+
+    (np.ndarray)             :  Charges in photoelectrons
+    '''
+    channels = np.asarray(channels, dtype = np.intp)
+    size     = max(np.max(constants['channels'], initial = 0), np.max(channels, initial = 0)) + 1
+    gain     = np.full(size, np.nan)
+    pedestal = np.full(size, np.nan)
+    gain[constants['channels']]     = constants['gain']
+    pedestal[constants['channels']] = constants['pedestal']
+
+    return (Q - pedestal[channels]) / gain[channels]
+
+
+def load_cali_info(file_path  :  str,
+                   constants  :  Optional[Union[str, np.ndarray]] = None,
+                   session    :  Optional[Session]               = None) -> pd.DataFrame:
+    '''
+    Loads in a calibrated .h5 file as pandas DataFrame, extracting the charge and height of
+    each waveform from /CALI/wf_info.
+
+    Charges in photoelectrons are added from /CALI/pe/wf_info when written by `apply_gain()`.
+    Providing constants converts the charges as they are read instead, so the file never needs
+    to be rewritten when the constants are updated.
+
+    Parameters
+    ----------
+
+    file_path (str)            :  Path to saved data
+    constants (str | ndarray)  :  Constants to convert charges with on read, see `load_constants()` (OPTIONAL)
+    session   (Session)        :  Session to borrow the open file from (OPTIONAL)
+
+    Returns
+    -------
+
+    (pd.DataFrame)  :  Dataframe of calibrated waveform information
+    '''
+    with _open(file_path, 'r', session) as h5f:
+        cali = pd.DataFrame(h5f['CALI/wf_info'][:])
+        if (constants is None) and ('CALI/pe/wf_info' in h5f):
+            cali['integrated_PE'] = h5f['CALI/pe/wf_info'].fields('integrated_PE')[:]
+
+    if constants is not None:
+        constants = load_constants(constants, session)
+        cali['integrated_PE'] = to_photoelectrons(cali['integrated_Q'].to_numpy(), cali['channels'].to_numpy(), constants)
+
+    return cali
+
+
+def _attrs_to_dict(attrs) -> dict:
+    '''
+    Converts h5 attributes to a dictionary of native python types
+    '''
+    return {key : (value.item() if isinstance(value, np.generic) else value)
+            for key, value in attrs.items()}
+
+
+def load_metadata(file_path  :  str,
+                  session    :  Optional[Session] = None) -> dict:
+    '''
+    Collects the run constants of a processed .h5 file without reading any datasets.
+
+    Schema 2 files hold these as attributes on the RAW group. Older files (unchunked
+    /RAW/event_info, or chunked /event_information/ei_N) repeat them in every event row,
+    in which case the first row is read and the schema version is reported as 1.
+
+    Parameters
+    ----------
+
+    file_path (str)      :  Path to saved data
+    session   (Session)  :  Session to borrow the open file from (OPTIONAL)
+
+    Returns
+    -------
+
+    metadata (dict)  :  Dictionary containing at least schema_version, samples,
+                        sampling_period and channels (`types.metadata_keys`)
+
+    Raises
+    ------
+
+    ValueError       :  If a schema 2 file is missing any of `types.metadata_keys`
+    '''
+    with _open_group(file_path, 'RAW', 'r', session) as raw:
+        if 'schema_version' in raw.attrs:
+            missing = [key for key in types.metadata_keys if key not in raw.attrs]
+            if missing:
+                raise ValueError(f'{file_path} RAW group is missing the run constants {missing}.')
+            return _attrs_to_dict(raw.attrs)
+
+        # older files, scout the first row for the run constants
+        row = raw['event_info'][0]
+
+    return {'schema_version'  : 1,
+            'samples'         : int(row['samples']),
+            'sampling_period' : row['sampling_period'].item(),
+            'channels'        : int(row['channels'])}
+
+
+def widen_event_info(rows      :  np.ndarray,
+                     metadata  :  dict) -> np.ndarray:
+    '''
+    Broadcasts the run constants of a schema 2 file back into its event rows,
+    producing the full `event_info_type` table of older files.
+    Compact files have their timestamps rebuilt from the stored deltas.
+
+    Parameters
+    ----------
+
+    rows     (ndarray)  :  Event rows as stored in /RAW/event_info
+    metadata (dict)     :  Run constants, as returned by `load_metadata()`
+
+    Returns
+    -------
+
+    evt_info (ndarray)  :  Event information in the `event_info_type` format
+    '''
+    evt_info = np.empty(len(rows), dtype = types.event_info_type)
+    evt_info['event_number']    = rows['event_number']
+    if metadata.get('compact', False):
+        evt_info['timestamp']   = _undelta(rows['timestamp_delta'], metadata)
+    else:
+        evt_info['timestamp']   = rows['timestamp']
+    evt_info['samples']         = metadata['samples']
+    evt_info['sampling_period'] = metadata['sampling_period']
+    evt_info['channels']        = metadata['channels']
+
+    return evt_info
+
+
+def _undelta(deltas    :  np.ndarray,
+             metadata  :  dict) -> np.ndarray:
+    '''
+    Rebuilds compact timestamps from their deltas. Run sets concatenate several
+    files, each restarting its deltas from its own origin at `segment_starts`.
+    uint64 arithmetic wraps, so the per segment offsets are exact. Counters with
+    a `timestamp_wrap` are wrapped again, giving the stored counter values.
+    '''
+    timestamps = np.cumsum(deltas, dtype = np.uint64)
+    if len(timestamps) == 0:
+        return timestamps
+    origins = np.atleast_1d(np.asarray(metadata['timestamp_origin'], dtype = np.uint64))
+    starts  = np.atleast_1d(np.asarray(metadata.get('segment_starts', 0), dtype = np.int64))
+    before  = np.where(starts > 0, timestamps[np.maximum(starts - 1, 0)], np.uint64(0))
+    lengths = np.diff(np.append(starts, len(timestamps)))
+    timestamps = timestamps + np.repeat(origins - before, lengths)
+    if 'timestamp_wrap' in metadata:
+        timestamps %= np.uint64(metadata['timestamp_wrap'])
+    return timestamps
+
+
+def widen_rwf(rows      :  np.ndarray,
+              metadata  :  dict) -> np.ndarray:
+    '''
+    Casts compact raw waveform rows back to the default data-type of their decoder,
+    non-compact rows are returned untouched.
+
+    Parameters
+    ----------
+
+    rows     (ndarray)  :  Raw waveform rows as stored in /RAW/rwf
+    metadata (dict)     :  Run constants, as returned by `load_metadata()`
+
+    Returns
+    -------
+
+    (ndarray)           :  Raw waveform rows in the default format
+    '''
+    if not metadata.get('compact', False):
+        return rows
+    if metadata['decoder'] == 'WD1':
+        return rows.astype(types.rwf_type_WD1(metadata['samples']))
+    return rows.astype(types.rwf_type(metadata['samples']))
+
+
+def check_chunking(file     :  str,
+                   session  :  Optional[Session] = None) -> Tuple[bool, list, int, list]:
     '''
     quantifies the chunking within the dataset for processing purposes
     CHUNKING IS OBSOLETE AT THIS POINT DUE TO THE LAZY PROCESSING,
@@ -95,7 +550,8 @@ def check_chunking(file  :  str) -> Tuple[bool, list, int, list]:
     Parameters
     ----------
 
-    file (str)  :  Path to data to check
+    file    (str)      :  Path to data to check
+    session (Session)  :  Session to borrow the open file from (OPTIONAL)
 
     Returns
     -------
@@ -108,7 +564,7 @@ def check_chunking(file  :  str) -> Tuple[bool, list, int, list]:
 
     '''
 
-    with h5py.File(file, 'r') as h5f:
+    with _open(file, 'r', session) as h5f:
         gr     = h5f['rwf']
         e      = h5f['event_information']
         keys   = list(gr.keys())
@@ -122,30 +578,344 @@ def check_chunking(file  :  str) -> Tuple[bool, list, int, list]:
 
 def check_rows(file_path  :  str,
                group      :  str,
-               node       :  str) -> int:
+               node       :  str,
+               session    :  Optional[Session] = None) -> int:
     '''
     check the number of rows in the df
 
     Parameters
     ----------
 
-    file_path (str)  :  File path
-    group     (str)  :  h5 group
-    node      (str)  :  h5 node
+    file_path (str)      :  File path
+    group     (str)      :  h5 group
+    node      (str)      :  h5 node
+    session   (Session)  :  Session to borrow the open file from (OPTIONAL)
 
     Returns
     -------
 
-    (str)            :  Number of rows
+    (str)                :  Number of rows
 
     '''
-    with h5py.File(file_path, 'r') as f:
-        dset = f[f'{group}/{node}']
+    with _open_group(file_path, group, 'r', session) as gr:
+        dset = gr[node]
         num_rows = dset.shape[0]
 
     return num_rows
 
 
+def write_index(file_path  :  str,
+                group      :  Optional[str] = 'RAW') -> None:
+    '''
+    Writes sorted lookup indices over the event_info rows of a processed file,
+    allowing range queries on timestamp or event number without loading the
+    full table (see `query_rows()`).
+    Indices are stored as GROUP/timestamp_index and GROUP/event_number_index,
+    each holding (key, row) pairs sorted by key.
+
+    Parameters
+    ----------
+
+    file_path (str)  :  Path to processed file
+    group     (str)  :  Group holding event_info
+    '''
+    with h5py.File(file_path, 'a') as f:
+        gr   = f[group]
+        if 'event_info' not in gr:
+            return
+        rows = widen_event_info(gr['event_info'][:], _attrs_to_dict(gr.attrs))
+        for key in ['timestamp', 'event_number']:
+            index = _build_index(rows[key])
+            if f'{key}_index' in gr:
+                del gr[f'{key}_index']
+            gr.create_dataset(f'{key}_index', data = index, chunks = True)
+
+
+def _build_index(keys  :  np.ndarray) -> np.ndarray:
+    '''
+    Sorts the keys (stably, so tied keys keep their row order) alongside their row numbers
+    '''
+    order         = np.argsort(keys, kind = 'stable')
+    index         = np.empty(len(keys), dtype = types.index_type(keys.dtype))
+    index['key']  = keys[order]
+    index['row']  = order
+
+    return index
+
+
+def _bisect(keys   :  h5py.Dataset,
+            value  :  (int | float),
+            side   :  str) -> int:
+    '''
+    Binary search over a sorted on-disk column, reading a single element per step.
+    Equivalent to np.searchsorted(keys, value, side) without loading the column.
+    '''
+    lo, hi = 0, len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if (keys[mid] < value) or (side == 'right' and keys[mid] == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def rows_to_ranges(rows  :  np.ndarray) -> List[Tuple[int, int]]:
+    '''
+    Coalesces row numbers into sorted, contiguous (start, stop) ranges
+
+    eg: [4, 0, 1, 2, 7] -> [(0, 3), (4, 5), (7, 8)]
+
+    Parameters
+    ----------
+
+    rows (ndarray)  :  Row numbers
+
+    Returns
+    -------
+
+    (list)          :  List of half-open (start, stop) ranges
+    '''
+    if len(rows) == 0:
+        return []
+    rows   = np.unique(rows)
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = rows[np.r_[0, breaks]]
+    stops  = rows[np.r_[breaks - 1, len(rows) - 1]] + 1
+    return [(int(a), int(b)) for a, b in zip(starts, stops)]
+
+
+def query_rows(file_path  :  str,
+               key        :  str,
+               low        :  (int | float),
+               high       :  (int | float),
+               group      :  Optional[str]     = 'RAW',
+               session    :  Optional[Session] = None) -> List[Tuple[int, int]]:
+    '''
+    Finds the event_info rows with low <= key < high, such as the events between two
+    timestamps or a range of event numbers, by binary searching the sorted index
+    written by `write_index()`. Only the matching part of the index is read.
+    Files without an index fall back to sorting the column in memory.
+
+    Parameters
+    ----------
+
+    file_path (str)          :  Path to processed file
+    key       (str)          :  Column to query, 'timestamp' or 'event_number'
+    low       (int | float)  :  Lower bound (inclusive)
+    high      (int | float)  :  Upper bound (exclusive)
+    group     (str)          :  Group holding event_info
+    session   (Session)      :  Session to borrow the open file from (OPTIONAL)
+
+    Returns
+    -------
+
+    (list)                   :  Sorted, contiguous (start, stop) row ranges of event_info.
+                                Use `event_to_rwf_ranges()` for the matching raw waveform rows.
+    '''
+    if key not in ('timestamp', 'event_number'):
+        raise ValueError(f"Cannot query on '{key}', expected 'timestamp' or 'event_number'.")
+
+    with _open(file_path, 'r', session) as f:
+        gr = f[group]
+        if f'{key}_index' in gr:
+            index = gr[f'{key}_index']
+            keys  = index.fields('key')
+            start = _bisect(keys, low, 'left')
+            stop  = _bisect(keys, high, 'left')
+            rows  = index.fields('row')[start:stop]
+        else:
+            rows  = widen_event_info(gr['event_info'][:], _attrs_to_dict(gr.attrs))[key]
+            rows  = np.flatnonzero((rows >= low) & (rows < high))
+
+    return rows_to_ranges(rows)
+
+
+def sorted_timestamps(file_path   :  str,
+                      block_size  :  Optional[int]     = 100000,
+                      session     :  Optional[Session] = None) -> Generator:
+    '''
+    Streams the (timestamp, row) pairs of a file's /RAW/event_info in time order.
+    Files with a timestamp index (see `write_index()`) are read from the index block by block,
+    otherwise the timestamp column is loaded and sorted (stably) in memory.
+
+    Parameters
+    ----------
+
+    file_path   (str)      :  Path to processed file
+    block_size  (int)      :  Number of index rows read at once
+    session     (Session)  :  Session to borrow the open file from (OPTIONAL)
+
+    Returns
+    -------
+
+    (generator)            :  Generator returning (timestamp, event_info row) in time order
+    '''
+    with _open_group(file_path, 'RAW', 'r', session) as raw:
+        indexed = 'timestamp_index' in raw
+        if not indexed:
+            timestamps = widen_event_info(raw['event_info'][:], _attrs_to_dict(raw.attrs))['timestamp']
+
+    if indexed:
+        for _, block in block_reader(file_path, 'RAW', 'timestamp_index', block_size, session = session):
+            yield from zip(block['key'].tolist(), block['row'].tolist())
+    else:
+        order = np.argsort(timestamps, kind = 'stable')
+        for i in range(0, len(order), block_size):
+            rows = order[i:i + block_size]
+            yield from zip(timestamps[rows].tolist(), rows.tolist())
+
+
+def event_to_rwf_ranges(ranges    :  List[Tuple[int, int]],
+                        channels  :  int) -> List[Tuple[int, int]]:
+    '''
+    Converts event_info row ranges to raw waveform row ranges, as each event
+    holds one raw waveform row per channel.
+
+    Parameters
+    ----------
+
+    ranges   (list)  :  (start, stop) event_info row ranges
+    channels (int)   :  Number of channels in the data
+
+    Returns
+    -------
+
+    (list)           :  (start, stop) raw waveform row ranges
+    '''
+    return [(start * channels, stop * channels) for start, stop in ranges]
+
+
+def block_reader(path        :  str,
+                 group       :  str,
+                 dataset     :  str,
+                 block_size  :  int,
+                 ranges      :  Optional[List[Tuple[int, int]]] = None,
+                 session     :  Optional[Session]               = None) -> Generator:
+    '''
+    A lazy h5 reader that reads blocks of rows rather than single rows, with the formatting:
+
+    FILE.H5 -> GROUP/DATASET
+
+    Parameters
+    ----------
+    path       (str)   :  File path
+    group      (str)   :  Group name within the h5 file
+    dataset    (str)   :  Dataset name within the group
+    block_size (int)   :  Maximum number of rows read at once
+    ranges     (list)  :  (start, stop) row ranges to read, such as those from `query_rows()`.
+                          Defaults to the whole dataset.
+    session (Session)  :  Session to borrow the open file from (OPTIONAL)
+    Returns
+    -------
+    (generator)        :  Generator returning (first row number, block of rows)
+    '''
+    with _open_group(path, group, 'r', session) as gr:
+        dset = gr[dataset]
+        if ranges is None:
+            ranges = [(0, dset.shape[0])]
+        for start, stop in ranges:
+            for i in range(start, min(stop, dset.shape[0]), block_size):
+                yield i, dset[i:min(i + block_size, stop)]
+
+
+def build_run_set(files      :  List[str],
+                  save_path  :  str) -> None:
+    '''
+    Builds a run set: a single .h5 file whose /RAW/event_info and /RAW/rwf are
+    virtual datasets over those of many decoded files, with no waveform data copied.
+    Rows are numbered globally in the order the files are provided, and the run set
+    can be used with any of the readers and loaders as if it were one file.
+
+    The member files and their row ranges are stored in /RAW/files, use
+    `run_set_ranges()` for block reads that don't cross file boundaries.
+    A sorted index is written for range queries over the whole run.
+
+    The member files must share their data-types and run constants, and must stay
+    at the same (absolute) path, otherwise the virtual datasets read as zeros.
+
+    Parameters
+    ----------
+
+    files     (list)  :  Paths to decoded files of the same run
+    save_path (str)   :  Path to the run set file
+    '''
+    if len(files) == 0:
+        raise ValueError('No files provided to build_run_set().')
+
+    files    = [os.path.abspath(file) for file in files]
+    metadata = [load_metadata(file) for file in files]
+    shapes, dtypes = [], []
+    for file in files:
+        with h5py.File(file, 'r') as f:
+            if 'RAW' not in f:
+                raise ValueError(f'{file} has no /RAW group, only decoded files can form a run set.')
+            shapes.append((f['RAW/event_info'].shape[0], f['RAW/rwf'].shape[0]))
+            dtypes.append((f['RAW/event_info'].dtype, f['RAW/rwf'].dtype))
+
+    for key in ['samples', 'sampling_period', 'channels', 'compact', 'timestamp_wrap']:
+        if len(set(m.get(key) for m in metadata)) > 1:
+            raise ValueError(f"Files in a run set must share the same '{key}'.")
+    if len(set(dtypes)) > 1:
+        raise ValueError('Files in a run set must share the same data-types.')
+
+    n_evt, n_rwf = np.array(shapes, dtype = np.uint64).T
+    table                = np.empty(len(files), dtype = types.run_set_file_type)
+    table['path']        = files
+    table['event_stop']  = np.cumsum(n_evt)
+    table['event_start'] = table['event_stop'] - n_evt
+    table['rwf_stop']    = np.cumsum(n_rwf)
+    table['rwf_start']   = table['rwf_stop'] - n_rwf
+
+    run_metadata = dict(metadata[0])
+    run_metadata.pop('source_file', None)
+    run_metadata['run_set'] = True
+    if run_metadata.get('compact', False):
+        run_metadata['timestamp_origin'] = [m['timestamp_origin'] for m in metadata]
+        run_metadata['segment_starts']   = table['event_start']
+
+    with h5py.File(save_path, 'w') as f:
+        gr = f.create_group('RAW')
+        gr.attrs.update(run_metadata)
+        for dataset, (start, stop), dtype in [('event_info', ('event_start', 'event_stop'), dtypes[0][0]),
+                                             ('rwf',        ('rwf_start', 'rwf_stop'),     dtypes[0][1])]:
+            layout = h5py.VirtualLayout(shape = (int(table[stop][-1]),), dtype = dtype)
+            for row in table:
+                length = int(row[stop] - row[start])
+                layout[int(row[start]):int(row[stop])] = h5py.VirtualSource(row['path'], f'RAW/{dataset}',
+                                                                             shape = (length,), dtype = dtype)
+            gr.create_virtual_dataset(dataset, layout)
+        gr.create_dataset('files', data = table)
+
+    write_index(save_path)
+
+
+def run_set_ranges(path     :  str,
+                   dataset  :  Optional[str] = 'rwf') -> List[Tuple[int, int]]:
+    '''
+    Global (start, stop) row ranges of each member file of a run set. Passing these
+    to `block_reader()` gives blocks that never cross a file boundary.
+    Ordinary files are treated as a run set of one.
+
+    Parameters
+    ----------
+
+    path    (str)  :  Path to the run set file
+    dataset (str)  :  'rwf' or 'event_info'
+
+    Returns
+    -------
+
+    (list)         :  (start, stop) row ranges, one per member file
+    '''
+    prefix = 'event' if dataset == 'event_info' else 'rwf'
+    with h5py.File(path, 'r') as f:
+        if 'files' not in f['RAW']:
+            return [(0, f[f'RAW/{dataset}'].shape[0])]
+        table = f['RAW/files'][:]
+    return [(int(a), int(b)) for a, b in zip(table[f'{prefix}_start'], table[f'{prefix}_stop'])]
+
+
 def read_config_file(file_path  :  str) -> dict:
     '''
     Read config file passed in via 'mule' and extract relevant information for pack.
@@ -189,7 +959,11 @@ def read_config_file(file_path  :  str) -> dict:
 @contextmanager
 def writer(path        :  str,
            group       :  str,
-           overwrite   :  Optional[bool] = True) -> Generator:
+           overwrite   :  Optional[bool]    = True,
+           metadata    :  Optional[dict]    = None,
+           session     :  Optional[Session] = None,
+           swmr        :  Optional[bool]    = False,
+           flush_every :  Optional[int]     = 1000) -> Generator:
     '''
     Outer function for a lazy h5 writer that will iteratively write to a dataset, with the formatting:
     FILE.h5 -> GROUP/DATASET
@@ -199,6 +973,13 @@ def writer(path        :  str,
     path (str)       :  File path
     group (str)      :  Group within the h5 file
     overwrite(bool)  :  Boolean for overwriting previous dataset (OPTIONAL)
+    metadata (dict)  :  Attributes written once to the group, such as the run
+                        constants of a decoded file (OPTIONAL)
+    session (Session):  Session to borrow the open file from, it is left open
+                        (and flushed) on exit rather than closed (OPTIONAL)
+    swmr (bool)      :  Single-writer/multiple-reader mode, allowing `swmr_reader()`
+                        to follow the file while it is being written (OPTIONAL)
+    flush_every (int):  Number of writes between flushes in SWMR mode (OPTIONAL)
 
     Returns
     -------
@@ -207,18 +988,37 @@ def writer(path        :  str,
 
     Fixed size is for when you know the size of the output file, so you set the size
     of the df beforehand, saving precious IO operation. The input then becomes a tuple
-    of (True, DF_SIZE, INDEX), otherwise its false.
+    of (True, DF_SIZE, INDEX), otherwise its false. Datasets created with a fixed size
+    are trimmed on exit to the highest row written, so a short source doesn't leave
+    zero-filled rows behind.
+
+    In SWMR mode datasets aren't preallocated, instead they grow as rows are written so
+    that readers never see unwritten rows. SWMR is switched on at the first flush, and no
+    new datasets can be created after it, so every dataset must be written to within
+    the first `flush_every` writes (as is the case for the decoders).
     '''
 
 
     # open file if exists, create group or overwrite it
-    h5f = h5py.File(path, 'a')
+    if swmr:
+        if session is not None:
+            raise ValueError('SWMR writing needs its own file handle, and cannot be used with a session.')
+        h5f = h5py.File(path, 'a', libver = 'latest')
+    elif session is None:
+        h5f = h5py.File(path, 'a')
+    else:
+        h5f = session.open(path, 'a')
+    writes = 0
+    # rows written to each fixed size dataset created here, for trimming on exit
+    written = {}
     try:
         if overwrite:
             if group in h5f:
                 del h5f[group]
 
         gr  = h5f.require_group(group)
+        if metadata is not None:
+            gr.attrs.update(metadata)
 
         def write(dataset     :  str,
                   data        :  np.ndarray,
@@ -239,20 +1039,44 @@ def writer(path        :  str,
                                      True  (enabled)  -> Requires Tuple containing
                                                             (True, number of events, index to write to)
                                    This method is best seen in action in `process_bin_WD1()`.
-            * Data should be in a numpy structured array format, as can be seen in WD1 and WD2 processing
+            * Data should be in a numpy structured array format, as can be seen in WD1 and WD2 processing.
+              A 1D structured array is written as a block of rows, starting at the index for fixed size.
             '''
-            if not fixed_size:
+            nonlocal writes
+            # a single row, or a block of rows written at once
+            rows = 1 if data.ndim == 0 else data.shape[0]
+            if swmr:
+                if dataset not in gr:
+                    if h5f.swmr_mode:
+                        raise RuntimeError(f"Can't create dataset '{dataset}' once SWMR is active, all datasets must be written within the first {flush_every} writes.")
+                    gr.create_dataset(dataset, shape = (0,), maxshape = (None,),
+                                      dtype = data.dtype, chunks = True)
+                dset  = gr[dataset]
+                index = fixed_size[2] if fixed_size else dset.shape[0]
+                if fixed_size and index + rows > fixed_size[1]:
+                    raise IndexError(f'Index {index + rows - 1} is out of range for a dataset of size {fixed_size[1]}')
+                # grow with the written rows, so readers only ever see real data
+                if index + rows > dset.shape[0]:
+                    dset.resize((index + rows,))
+                dset[index:index + rows] = data
+
+                writes += 1
+                if writes % flush_every == 0:
+                    if not h5f.swmr_mode:
+                        h5f.swmr_mode = True
+                    h5f.flush()
+            elif not fixed_size:
                 # create dataset if doesnt exist, if does make larger
                 if dataset in gr:
                     dset = gr[dataset]
-                    dset.resize((dset.shape[0] + 1,))
-                    dset[-1] = data
+                    dset.resize((dset.shape[0] + rows,))
+                    dset[-rows:] = data
                 else:
                     max_shape = (None,) + data.shape
-                    dset = gr.require_dataset(dataset, shape = (1,),
+                    dset = gr.require_dataset(dataset, shape = (rows,),
                                               maxshape = (None,), dtype = data.dtype,
                                               chunks = True)
-                    dset[0] = data
+                    dset[:] = data
             else:
                 index = fixed_size[2]
                 # dataset of fixed size
@@ -262,18 +1086,87 @@ def writer(path        :  str,
                     dset = gr.require_dataset(dataset, shape = (fixed_size[1],) + (),
                                               maxshape = fixed_size[1], dtype = data.dtype,
                                               chunks = True)
-                dset[index] = data
+                    written[dataset] = 0
+                if index + rows > dset.shape[0]:
+                    raise IndexError(f'Index {index + rows - 1} is out of range for a dataset of size {dset.shape[0]}')
+                dset[index:index + rows] = data
+                if dataset in written:
+                    written[dataset] = max(written[dataset], index + rows)
 
         yield write
 
     finally:
-        h5f.close()
+        # drop the preallocated rows that were never written
+        if h5f.id.valid:
+            for dataset, rows in written.items():
+                if rows < gr[dataset].shape[0]:
+                    gr[dataset].resize((rows,))
+        if session is None:
+            h5f.close()
+        elif h5f.id.valid:
+            h5f.flush()
+
+
+def swmr_reader(path           :  str,
+                group          :  str,
+                dataset        :  str,
+                timeout        :  Optional[float] = 30,
+                poll_interval  :  Optional[float] = 0.5) -> Generator:
+    '''
+    A lazy h5 reader that follows a dataset while it is being written by a
+    `writer()` in SWMR mode, such as a decode in progress, with the formatting:
+
+    FILE.H5 -> GROUP/DATASET
+
+    The dataset extent is refreshed as rows are yielded, and the reader stops once
+    no new rows have appeared for `timeout` seconds. It will also wait up to `timeout`
+    seconds for the writer to switch on SWMR before the file can be opened.
+
+    Parameters
+    ----------
+    path          (str)    :  File path
+    group         (str)    :  Group name within the h5 file
+    dataset       (str)    :  Dataset name within the group
+    timeout       (float)  :  Seconds without new rows before finishing
+    poll_interval (float)  :  Seconds between checks for new rows
+    Returns
+    -------
+    row (generator)  :  Generator object that returns the next row from the dataset upon being called.
+    '''
+    start = time.monotonic()
+    while True:
+        try:
+            h5f = h5py.File(path, 'r', libver = 'latest', swmr = True)
+            break
+        except OSError:
+            # file missing, or still locked by a writer that hasn't switched on SWMR
+            if time.monotonic() - start > timeout:
+                raise
+            time.sleep(poll_interval)
+
+    with h5f:
+        dset        = h5f[group][dataset]
+        position    = 0
+        last_growth = time.monotonic()
+        while True:
+            dset.refresh()
+            rows = dset.shape[0]
+            if rows > position:
+                for row in dset[position:rows]:
+                    yield row
+                position    = rows
+                last_growth = time.monotonic()
+            elif time.monotonic() - last_growth > timeout:
+                return
+            else:
+                time.sleep(poll_interval)
 
 
 def reader(path         :  str,
            group        :  str,
            dataset      :  str,
-           file_access  :  Optional[str] = 'r') -> Generator:
+           file_access  :  Optional[str]     = 'r',
+           session      :  Optional[Session] = None) -> Generator:
     '''
     A lazy h5 reader that will iteratively read from a dataset, with the formatting:
 
@@ -286,13 +1179,13 @@ def reader(path         :  str,
     file_access (str)  :  Defines what sort of access available to provided file.
                           Useful for reading out events, processing them and then
                           writing them back in with writer()
+    session (Session)  :  Session to borrow the open file from (OPTIONAL)
     Returns
     -------
     row (generator)  :  Generator object that returns the next row from the dataset upon being called.
     '''
 
-    with h5py.File(path, file_access) as h5f:
-        gr = h5f[group]
+    with _open_group(path, group, file_access, session) as gr:
         dset = gr[dataset]
 
         for row in dset:
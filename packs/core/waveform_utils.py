@@ -12,12 +12,17 @@ from matplotlib.pyplot import cm
 
 
 import h5py
+from functools import lru_cache
+from scipy.signal import lfilter
+from scipy.fft import rfft, irfft, next_fast_len
 
 from typing import BinaryIO
 from typing import Generic
 from typing import Optional
 from typing import Union
 from typing import Tuple
+from typing import Dict
+from typing import Iterable
 
 from packs.core.io import writer, reader, check_chunking, check_rows
 from packs.types import types
@@ -115,3 +120,216 @@ def collect_index(time  : np.ndarray,
         return index[0]
     else:
         raise Exception("Index collection found more than one value with the same value entered.\nAre you sure you entered the right array?")
+
+
+def collect_indices(time    :  np.ndarray,
+                    values  :  np.ndarray) -> np.ndarray:
+    '''
+    Collects the array indices corresponding to many time values at once,
+    matching `collect_index()` for each value. The time array must be non-decreasing.
+
+    Parameters
+    ----------
+
+    time    (np.array)  :  Time array
+    values  (np.array)  :  Values that you wish to locate the indices of
+
+    Returns
+    -------
+
+    (np.array)          :  Indices matching values
+
+    '''
+    values = np.asarray(values)
+    idx    = np.searchsorted(time, values, side = "left")
+    below  = np.clip(idx - 1, 0, len(time) - 1)
+    above  = np.clip(idx,     0, len(time) - 1)
+    # take the value below when it's strictly closer, as find_nearest() does
+    closer = (idx > 0) & ((idx == len(time)) | (np.abs(values - time[below]) < np.abs(values - time[above])))
+    val    = np.where(closer, time[below], time[above])
+    # first occurrence of the nearest value
+    return np.searchsorted(time, val, side = "left")
+
+
+def _filter_key(filter_spec  :  Dict) -> Tuple:
+    '''
+    Hashable form of a filter description, so filters can be cached by value
+    '''
+    return tuple(sorted(filter_spec.items()))
+
+
+@lru_cache(maxsize = None)
+def filter_coefficients(samples          :  int,
+                        sampling_period  :  float,
+                        key              :  Tuple) -> Tuple[str, Tuple[np.ndarray, ...]]:
+    '''
+    Builds (once per number of samples and filter) what is needed to apply a filter
+    to a block of waveforms: the frequency response of an FIR kernel to convolve
+    with by FFT, or the recursive coefficients of an IIR filter for `lfilter()`.
+
+    The filter is described by its type and parameters (times in ns):
+        moving_average  :  width (samples), trailing average over width samples
+        high_pass       :  tau, CR differentiator
+        low_pass        :  tau, RC integrator
+        cr_rc           :  tau, order (default 1), CR differentiator followed by `order` RC integrators
+
+    Parameters
+    ----------
+
+    samples          (int)    :  Number of samples per waveform
+    sampling_period  (float)  :  Time between samples (ns)
+    key              (tuple)  :  Filter description, as given by `_filter_key()`
+
+    Returns
+    -------
+
+    (str, tuple)              :  'fft' with (frequency response, FFT length),
+                                 or 'lfilter' with (b, a) coefficients
+    '''
+    params = dict(key)
+    match params.get('type'):
+        case 'moving_average':
+            width = int(params['width'])
+            if width < 1:
+                raise ValueError(f'Moving average width must be at least 1, not {width}')
+            # pad to a fast length that avoids wrapping around the end of the waveform
+            n_fft = next_fast_len(samples + width - 1, real = True)
+            return 'fft', (rfft(np.full(width, 1 / width), n = n_fft), n_fft)
+
+        case 'high_pass' | 'low_pass' | 'cr_rc':
+            tau = params['tau']
+            if tau <= 0:
+                raise ValueError(f'Filter time constant must be positive, not {tau}')
+            alpha = tau / (tau + sampling_period)
+            # y[n] = alpha * (y[n-1] + x[n] - x[n-1])
+            cr    = (np.array([alpha, -alpha]), np.array([1, -alpha]))
+            # y[n] = alpha * y[n-1] + (1 - alpha) * x[n]
+            rc    = (np.array([1 - alpha]),     np.array([1, -alpha]))
+            match params['type']:
+                case 'high_pass':
+                    stages = [cr]
+                case 'low_pass':
+                    stages = [rc]
+                case 'cr_rc':
+                    stages = [cr] + [rc] * int(params.get('order', 1))
+            b, a = np.array([1.]), np.array([1.])
+            for stage_b, stage_a in stages:
+                b, a = np.convolve(b, stage_b), np.convolve(a, stage_a)
+            return 'lfilter', (b, a)
+
+        case other:
+            raise ValueError(
+                f"Invalid filter type '{other}'. Expected 'moving_average', 'high_pass', 'low_pass' or 'cr_rc'."
+            )
+
+
+def filter_block(wfs              :  np.ndarray,
+                 filters          :  Optional[Iterable[Dict]],
+                 sampling_period  :  float) -> np.ndarray:
+    '''
+    Applies a chain of filters to a block of waveforms along the sample axis,
+    in the order given. FIR filters are convolved by FFT and IIR filters are
+    run through `lfilter()`, with coefficients cached per (samples, filter).
+
+    Parameters
+    ----------
+
+    wfs              (np.ndarray)  :  (N, samples) array of (baseline subtracted) waveforms
+    filters          (iterable)    :  Filter descriptions, see `filter_coefficients()`.
+                                      None or empty leaves the waveforms untouched
+    sampling_period  (float)       :  Time between samples (ns)
+
+    Returns
+    -------
+
+    (np.ndarray)                   :  Filtered waveforms
+    '''
+    if not filters:
+        return wfs
+
+    samples = wfs.shape[1]
+    for filter_spec in filters:
+        kind, coefficients = filter_coefficients(samples, float(sampling_period), _filter_key(filter_spec))
+        match kind:
+            case 'fft':
+                response, n_fft = coefficients
+                wfs = irfft(rfft(wfs, n = n_fft, axis = 1) * response, n = n_fft, axis = 1)[:, :samples]
+            case 'lfilter':
+                b, a = coefficients
+                wfs  = lfilter(b, a, wfs, axis = 1)
+    return wfs
+
+
+@lru_cache(maxsize = None)
+def shift_phases(samples  :  int) -> Tuple[np.ndarray, int]:
+    '''
+    Frequencies (in cycles per sample) of the zero padded FFT used by `shift_block()`.
+    Padding to twice the samples moves what is shifted off one end into the padding,
+    rather than wrapping it round onto the other end.
+
+    Parameters
+    ----------
+
+    samples  (int)  :  Number of samples per waveform
+
+    Returns
+    -------
+
+    (np.ndarray, int)  :  rfft frequencies and FFT length
+    '''
+    n_fft = next_fast_len(2 * samples, real = True)
+    return np.fft.rfftfreq(n_fft), n_fft
+
+
+def shift_block(wfs     :  np.ndarray,
+                shifts  :  np.ndarray,
+                method  :  Optional[str] = 'fft') -> np.ndarray:
+    '''
+    Delays each waveform of a block by its own, possibly fractional, number of samples
+    in one batched step (negative shifts move the waveform earlier). Samples shifted in
+    from outside the waveform are zero.
+
+    Methods:
+        fft     -  phase shift of the zero padded spectrum, exact for band limited waveforms
+                   but rings around sharp edges
+        linear  -  linear interpolation between neighbouring samples, smooths slightly
+
+    Parameters
+    ----------
+
+    wfs     (np.ndarray)  :  (N, samples) array of waveforms
+    shifts  (np.ndarray)  :  Delay of each waveform, in samples
+    method  (str)         :  Shifting method, fft or linear
+
+    Returns
+    -------
+
+    (np.ndarray)          :  Shifted waveforms
+    '''
+    samples = wfs.shape[1]
+    shifts  = np.asarray(shifts, dtype = np.float64)[:, np.newaxis]
+    match method:
+        case 'fft':
+            freqs, n_fft = shift_phases(samples)
+            # the phase ramp exp(-2 pi i f shift) is built as successive powers of its first step,
+            # several times cheaper than a complex exponential per element
+            ramp         = np.empty((len(wfs), len(freqs)), dtype = np.complex128)
+            ramp[:, 0]   = 1
+            ramp[:, 1:]  = np.exp(-2j * np.pi * freqs[1] * shifts)
+            np.cumprod(ramp, axis = 1, out = ramp)
+            spectrum     = rfft(wfs, n = n_fft, axis = 1) * ramp
+            return irfft(spectrum, n = n_fft, axis = 1)[:, :samples]
+
+        case 'linear':
+            # value at (n - shift) of each waveform, interpolated between its neighbours
+            position = np.arange(samples) - shifts
+            below    = np.floor(position).astype(np.intp)
+            fraction = position - below
+            padded   = np.pad(wfs, ((0, 0), (1, 1)))
+            rows     = np.arange(len(wfs))[:, np.newaxis]
+            lower    = padded[rows, np.clip(below, -1, samples) + 1]
+            upper    = padded[rows, np.clip(below + 1, -1, samples) + 1]
+            return (1 - fraction) * lower + fraction * upper
+
+        case other:
+            raise ValueError(f"Invalid shift method '{other}'. Expected 'fft' or 'linear'.")
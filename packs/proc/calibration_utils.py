@@ -6,6 +6,10 @@ import numpy  as np
 import tables as tb
 import pandas as pd
 import warnings
+from contextlib import nullcontext
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 import matplotlib.pyplot as plt
 from matplotlib.pyplot import cm
 
@@ -19,12 +23,19 @@ from typing import Union
 from typing import Tuple
 from typing import Dict
 from typing import List
+from typing import NamedTuple
+from typing import Iterable
+from typing import Generator
 
-from packs.core.io import writer, reader, check_chunking, check_rows
+from packs.core.io import writer, reader, block_reader, check_rows, load_metadata, Session
+from packs.core.io import load_constants, to_photoelectrons
 from packs.types import types
-from packs.core.waveform_utils import collect_index, subtract_baseline
+from packs.core.waveform_utils import collect_index, collect_indices, subtract_baseline, filter_block
 
 from tqdm import tqdm
+from iminuit import Minuit
+from iminuit.cost import ExtendedBinnedNLL
+from scipy.stats import norm, poisson
 
 from packs.core.core_utils import PeakRangeError
 
@@ -68,15 +79,35 @@ def extract_peak(y_data  :  np.ndarray) -> Tuple[(int | float), int] :
     ((int | float), int)  :  Tuple of the max value and its index
     '''
     if y_data.size == 0:
-        raise ValueError(f"y_data provided to extract_peak() is empty")
+        raise ValueError("y_data provided to extract_peak() is empty")
     else:
         return (np.max(y_data), np.argmax(y_data))
 
 
+class CalibrationPlan(NamedTuple):
+    '''
+    Everything calibration needs that only depends on the time axis and the
+    calibration parameters, built once per file with `calibration_plan()`.
+
+    time_steps     (np.array)  :  Unique, validated time steps of the time axis
+    sidebands      (np.array)  :  Sideband indices, in the order their values are averaged
+    sideband_mask  (np.array)  :  Boolean mask of the sideband samples
+    windows        (np.array)  :  (samples, 2) start and end index of the integration window
+                                  for each peak index, a single repeated window for 'manual'.
+                                  None when the parameters hold no integration method.
+    '''
+    time_steps     :  np.ndarray
+    sidebands      :  np.ndarray
+    sideband_mask  :  np.ndarray
+    windows        :  np.ndarray
+
+
 def visualise_waveforms(file         :  str,
                         cali_params  :  Dict,
                         time         :  np.ndarray,
-                        key          :  str):
+                        key          :  str,
+                        group        :  Optional[str]     = 'rwf',
+                        session      :  Optional[Session] = None):
     '''
     Visualise waveforms and ask the user if the sidebands
     and integration window are acceptable.
@@ -89,9 +120,11 @@ def visualise_waveforms(file         :  str,
                                passed through `calibrate()`
     time        (np.array)  :  Time array
     key         (str)       :  Key for accessing the raw waveforms (chunking component, obsolete soon)
+    group       (str)       :  Group holding the raw waveforms
+    session     (Session)   :  Session to borrow the open file from
 
     '''
-    for i, waveform in enumerate(reader(file, 'rwf', key, 'r+')):
+    for i, waveform in enumerate(reader(file, group, key, 'r', session)):
         plt.plot(time, waveform['rwf'], alpha = 0.2, zorder = 1)
         if i > 100: # ensures minimal plotting
             break
@@ -114,7 +147,8 @@ def visualise_waveforms(file         :  str,
 
 def collect_sidebands(wf           :  List[float | int],
                       time         :  np.ndarray,
-                      cali_params  :  Dict) -> List:
+                      cali_params  :  Dict,
+                      plan         :  Optional[CalibrationPlan] = None) -> List:
     '''
     extract the sideband components of the waveform
 
@@ -125,12 +159,39 @@ def collect_sidebands(wf           :  List[float | int],
     time        (np.ndarray)         :  time values
     cali_params (dict)               :  calibration parameter dictionary
                                         generally passed through `calibrate()`
+    plan        (CalibrationPlan)    :  precomputed indices from `calibration_plan()` (OPTIONAL)
 
     Returns
     -------
 
     (list)                           :  List of sideband values
     '''
+    if plan is None:
+        indices = sideband_indices(time, cali_params)
+    else:
+        indices = plan.sidebands
+    wf = np.array(wf)
+    sideband_values = wf[indices]
+    return sideband_values
+
+
+def sideband_indices(time         :  np.ndarray,
+                     cali_params  :  Dict) -> np.ndarray:
+    '''
+    extract the indices of the sideband components, shared by every waveform
+
+    Parameters
+    ----------
+
+    time        (np.ndarray)  :  time values
+    cali_params (dict)        :  calibration parameter dictionary
+                                 generally passed through `calibrate()`
+
+    Returns
+    -------
+
+    (np.ndarray)              :  Array of sideband indices
+    '''
     # catch for if sidebands is a non-nested tuple
     if type(cali_params['sidebands'][0]) == int:
         cali_params['sidebands'] = (cali_params['sidebands'],)
@@ -142,17 +203,16 @@ def collect_sidebands(wf           :  List[float | int],
         bl_range = [collect_index(time, band[0]), collect_index(time, band[1])]
         baseline_ranges.update(np.arange(bl_range[0], bl_range[1], 1))
 
+    # the order is kept as is, so that mean baselines sum in the same order
+    return np.array(list(baseline_ranges), dtype = int)
 
-    wf = np.array(wf)
-    sideband_values = wf[list(baseline_ranges)]
-    return sideband_values
 
-
-def collect_integration_window(time         :  np.array,
-                               cali_params  :  dict,
-                               H_index      :  int) -> Tuple[int, int]:
+def integration_windows(time         :  np.ndarray,
+                        cali_params  :  Dict,
+                        H_indices    :  np.ndarray) -> np.ndarray:
     '''
-    Extract the integration window index of the waveform.
+    Extract the integration window indices for many peak indices at once,
+    without checking that each window is ordered.
     Depends on the method, currently there are two:
         manual : use explicit window values for the integration waveform
         height : use the highest peak in the waveform and pads around it
@@ -163,12 +223,12 @@ def collect_integration_window(time         :  np.array,
 
     time        (np.array)        :     Time array
     cali_params (dict)            :     Dictionary of calibration parameters
-    H_index     (int)             :     Index of highest point (only relevant for 'height' method)
+    H_indices   (np.array)        :     Indices of highest point (only relevant for 'height' method)
 
     Returns
     -------
 
-    (int, int)                    :     Start and end index values
+    (np.array)                    :     (N, 2) array of start and end index values
     '''
 
     time_check = np.unique(np.diff(time))
@@ -176,29 +236,508 @@ def collect_integration_window(time         :  np.array,
     if np.any(time_check < 0):
         raise ValueError(f'Time bins are not increasing')
 
+    H_indices = np.asarray(H_indices, dtype = int)
     match cali_params['method']:
         case 'manual':
-            start_index = collect_index(time, cali_params['window'][0])
-            end_index   = collect_index(time, cali_params['window'][1])
+            start_index = np.full(len(H_indices), collect_index(time, cali_params['window'][0]))
+            end_index   = np.full(len(H_indices), collect_index(time, cali_params['window'][1]))
         case 'height':
-            start_index = collect_index(time, time[H_index] - cali_params['window'][0])
-            end_index = collect_index(time, time[H_index] + cali_params['window'][1])
+            start_index = collect_indices(time, time[H_indices] - cali_params['window'][0])
+            end_index   = collect_indices(time, time[H_indices] + cali_params['window'][1])
         case _:
             raise ValueError(f"{cali_params['method']} is not a valid integration method.")
 
-    # ensure start and end index are ordered correctly
-    if start_index >= end_index:
+    return np.stack([start_index, end_index], axis = 1)
+
+
+def check_windows(windows  :  np.ndarray) -> None:
+    '''
+    Ensure start and end indices of integration windows are ordered correctly
+
+    Parameters
+    ----------
+
+    windows  (np.array)  :  (N, 2) array of start and end index values
+    '''
+    misordered = windows[:, 0] >= windows[:, 1]
+    if np.any(misordered):
+        start_index, end_index = windows[np.argmax(misordered)]
         raise ValueError(f'Start and end indices are out of order: [{start_index}, {end_index}]\nSelect window values to ensure linear indices.')
 
+
+def collect_integration_window(time         :  np.array,
+                               cali_params  :  dict,
+                               H_index      :  int,
+                               plan         :  Optional[CalibrationPlan] = None) -> Tuple[int, int]:
+    '''
+    Extract the integration window index of the waveform.
+    Depends on the method, currently there are two:
+        manual : use explicit window values for the integration waveform
+        height : use the highest peak in the waveform and pads around it
+                 with the window parameters
+
+    Parameters
+    ----------
+
+    time        (np.array)        :     Time array
+    cali_params (dict)            :     Dictionary of calibration parameters
+    H_index     (int)             :     Index of highest point (only relevant for 'height' method)
+    plan        (CalibrationPlan) :     Precomputed windows from `calibration_plan()` (OPTIONAL)
+
+    Returns
+    -------
+
+    (int, int)                    :     Start and end index values
+    '''
+    if plan is None:
+        windows = integration_windows(time, cali_params, [H_index])
+    else:
+        windows = plan.windows[[H_index]]
+
+    check_windows(windows)
+    start_index, end_index = windows[0]
+
     return (start_index, end_index)
 
 
+def calibration_plan(time         :  np.ndarray,
+                     cali_params  :  Dict) -> CalibrationPlan:
+    '''
+    Compiles the calibration parameters against the time axis, so that the sidebands
+    and integration windows aren't searched for again for every waveform.
+
+    Parameters
+    ----------
+
+    time        (np.array)  :  Time array
+    cali_params (dict)      :  Dictionary of calibration parameters
+                               passed through `calibrate()`
+
+    Returns
+    -------
+
+    (CalibrationPlan)       :  Plan for `calibrate_block()`, `collect_sidebands()`
+                               and `collect_integration_window()`
+    '''
+    time_steps = np.unique(np.diff(time))
+    # check that time is increasing
+    if np.any(time_steps < 0):
+        raise ValueError(f'Time bins are not increasing')
+
+    if cali_params['baseline_sub'] is not None:
+        sidebands = sideband_indices(time, cali_params)
+    else:
+        sidebands = np.array([], dtype = int)
+    sideband_mask = np.zeros(len(time), dtype = bool)
+    sideband_mask[sidebands] = True
+
+    # window for every possible peak index, a fixed window is checked up front.
+    # stages that don't integrate (such as pulse finding) have no method
+    if 'method' in cali_params:
+        windows = integration_windows(time, cali_params, np.arange(len(time)))
+        if cali_params['method'] == 'manual':
+            check_windows(windows[:1])
+    else:
+        windows = None
+
+    return CalibrationPlan(time_steps, sidebands, sideband_mask, windows)
+
+
+def subtract_block_baseline(wfs          :  np.ndarray,
+                            cali_params  :  Dict,
+                            plan         :  CalibrationPlan) -> np.ndarray:
+    '''
+    Flips (if negative) and baseline subtracts a block of waveforms at once,
+    giving the same values as `collect_sidebands()` and `subtract_baseline()` per waveform.
+
+    Parameters
+    ----------
+
+    wfs         (np.ndarray)       :  (N, samples) array of waveforms
+    cali_params (dict)             :  Dictionary of calibration parameters
+    plan        (CalibrationPlan)  :  Plan from `calibration_plan()`
+
+    Returns
+    -------
+
+    (np.ndarray)                   :  Subtracted waveforms
+    '''
+    # flip the waveforms
+    if cali_params['negative']:
+        wfs = -wfs
+
+    # baseline subtraction
+    if cali_params['baseline_sub'] is not None:
+        match cali_params['baseline_sub']:
+            case 'mean':
+                # contiguous rows reduce pairwise, summing in the same order as a single waveform
+                sideband_values = np.ascontiguousarray(wfs[:, plan.sidebands])
+                wfs = wfs - np.mean(sideband_values, axis = 1)[:, np.newaxis]
+            case 'median':
+                # the median doesn't depend on order, so the mask can be used
+                wfs = wfs - np.median(wfs[:, plan.sideband_mask], axis = 1)[:, np.newaxis]
+            case other:
+                wfs = wfs - subtract_baseline(wfs[:, plan.sidebands], sub_type = other)
+
+    return wfs
+
+
+def time_step(time  :  np.ndarray) -> float:
+    '''
+    Time between samples of the time array, for filters that need it
+    '''
+    return float(time[1] - time[0]) if len(time) > 1 else 1.
+
+
+def calibrate_block(wfs          :  np.ndarray,
+                    time         :  np.ndarray,
+                    cali_params  :  Dict,
+                    plan         :  Optional[CalibrationPlan] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Calibrates a block of waveforms at once, operating along the sample axis.
+    Each waveform gives the same values as a pass through `collect_sidebands()`,
+    `subtract_baseline()`, `extract_peak()` and `integrate()` would.
+    Any filters in cali_params are applied after baseline subtraction.
+
+    Parameters
+    ----------
+
+    wfs         (np.ndarray)  :  (N, samples) array of waveforms
+    time        (np.ndarray)  :  Time array
+    cali_params (dict)        :  Dictionary of calibration parameters
+                                 passed through `calibrate()`
+    plan   (CalibrationPlan)  :  Plan from `calibration_plan()`, built if not provided
+
+    Returns
+    -------
+
+    (np.ndarray, np.ndarray, np.ndarray) : Subtracted waveforms, integrals and heights
+    '''
+    if wfs.shape[1] == 0:
+        raise ValueError("calibrate_block() received an empty block of waveforms")
+
+    if plan is None:
+        plan = calibration_plan(time, cali_params)
+
+    wfs = subtract_block_baseline(wfs, cali_params, plan)
+    wfs = filter_block(wfs, cali_params.get('filters'), time_step(time))
+
+    # extract heights and their indices
+    H_vals    = np.max(wfs, axis = 1)
+    H_indices = np.argmax(wfs, axis = 1)
+
+    # the integration window only depends on the peak index
+    windows = plan.windows[H_indices]
+    check_windows(windows)
+
+    # integrate rows sharing a window together
+    Q_vals = np.empty(len(wfs), dtype = np.float64)
+    unique_windows, groups = np.unique(windows, axis = 0, return_inverse = True)
+    groups = groups.reshape(-1)
+    for k, (start_index, end_index) in enumerate(unique_windows):
+        rows         = np.flatnonzero(groups == k)
+        Q_vals[rows] = np.sum(np.ascontiguousarray(wfs[rows, start_index:end_index]), axis = 1)
+
+    return wfs, Q_vals, H_vals
+
+
+def _calibrate_shared_block(names        :  Tuple[str, str],
+                            shape        :  Tuple[int, int],
+                            dtypes       :  Tuple[np.dtype, np.dtype],
+                            time         :  np.ndarray,
+                            cali_params  :  Dict,
+                            plan         :  CalibrationPlan) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Worker side of `calibrate_blocks()`, calibrating the block held in shared memory
+    and writing the subtracted waveforms back into shared memory.
+    Only the integrals and heights are sent back through the pool.
+    '''
+    in_shm, out_shm = SharedMemory(name = names[0]), SharedMemory(name = names[1])
+    try:
+        wfs                  = np.ndarray(shape, dtype = dtypes[0], buffer = in_shm.buf)
+        sub_wfs, Q, H        = calibrate_block(wfs, time, cali_params, plan)
+        out                  = np.ndarray(shape, dtype = dtypes[1], buffer = out_shm.buf)
+        out[:]               = sub_wfs
+        del wfs, out
+    finally:
+        in_shm.close()
+        out_shm.close()
+    return Q, H
+
+
+def calibrate_blocks(blocks       :  Iterable[Tuple[int, np.ndarray]],
+                     time         :  np.ndarray,
+                     cali_params  :  Dict,
+                     plan         :  CalibrationPlan,
+                     workers      :  Optional[int] = 1) -> Generator:
+    '''
+    Calibrates blocks of raw waveform rows, such as those from `block_reader()`,
+    across a pool of worker processes. Blocks are handed over through shared memory
+    and the results are returned in the order the blocks were read, so the output
+    doesn't depend on the number of workers.
+
+    Parameters
+    ----------
+
+    blocks      (iterable)         :  (first row number, block of raw waveform rows)
+    time        (np.ndarray)       :  Time array
+    cali_params (dict)             :  Dictionary of calibration parameters
+    plan        (CalibrationPlan)  :  Plan from `calibration_plan()`
+    workers     (int)              :  Number of worker processes, 1 calibrates in this process
+
+    Returns
+    -------
+
+    (generator)  :  Generator returning (first row number, block, subtracted waveforms, integrals, heights)
+    '''
+    if workers is None or workers <= 1:
+        for start, block in blocks:
+            yield (start, block) + calibrate_block(block['rwf'], time, cali_params, plan)
+        return
+
+    def submit(executor, start, block):
+        wfs = block['rwf']
+        # the output data-type follows the input and baseline subtraction, probe it on one row
+        out_dtype = calibrate_block(wfs[:1], time, cali_params, plan)[0].dtype
+        in_shm    = SharedMemory(create = True, size = max(wfs.nbytes, 1))
+        out_shm   = SharedMemory(create = True, size = max(wfs.size * out_dtype.itemsize, 1))
+        np.ndarray(wfs.shape, dtype = wfs.dtype, buffer = in_shm.buf)[:] = wfs
+        future    = executor.submit(_calibrate_shared_block, (in_shm.name, out_shm.name), wfs.shape,
+                                    (wfs.dtype, out_dtype), time, cali_params, plan)
+        return (start, block, in_shm, out_shm, out_dtype, future)
+
+    def collect(start, block, in_shm, out_shm, out_dtype, future):
+        try:
+            Q, H = future.result()
+            wfs  = np.ndarray(block['rwf'].shape, dtype = out_dtype, buffer = out_shm.buf).copy()
+        finally:
+            for shm in (in_shm, out_shm):
+                shm.close()
+                shm.unlink()
+        return (start, block, wfs, Q, H)
+
+    # keep a couple of blocks queued per worker, collecting them in order
+    pending = deque()
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        try:
+            for start, block in blocks:
+                pending.append(submit(executor, start, block))
+                if len(pending) >= 2 * workers:
+                    yield collect(*pending.popleft())
+            while pending:
+                yield collect(*pending.popleft())
+        finally:
+            # release the shared memory of blocks abandoned on error
+            while pending:
+                *_, in_shm, out_shm, _, future = pending.popleft()
+                future.cancel()
+                for shm in (in_shm, out_shm):
+                    shm.close()
+                    shm.unlink()
+
+
+def subwf_layout(subwf     :  Dict,
+                 num_rows  :  int,
+                 samples   :  int,
+                 plan      :  CalibrationPlan) -> Optional[Tuple[np.dtype, int]]:
+    '''
+    Data-type and number of rows of the subtracted waveform output for the
+    chosen mode, see `calibrate()`.
+
+    Parameters
+    ----------
+
+    subwf     (dict)             :  Subtracted waveform output parameters
+    num_rows  (int)              :  Number of raw waveforms
+    samples   (int)              :  Number of samples per waveform
+    plan      (CalibrationPlan)  :  Plan from `calibration_plan()`
+
+    Returns
+    -------
+
+    (np.dtype, int)              :  Data-type and number of rows, None if nothing is stored
+    '''
+    match subwf['mode']:
+        case 'full':
+            return types.rwf_type(samples), num_rows
+        case 'none':
+            return None
+        case 'prescale':
+            return types.rwf_type(samples), -(-num_rows // subwf['factor'])
+        case 'rebin':
+            return types.rwf_type(samples // subwf['factor']), num_rows
+        case 'window':
+            longest = int(np.max(plan.windows[:, 1] - plan.windows[:, 0]))
+            return types.subwf_window_type(max(longest, 1)), num_rows
+        case other:
+            raise ValueError(f"{other} is not a valid subtracted waveform output mode.")
+
+
+def format_subwf(subwf   :  Dict,
+                 start   :  int,
+                 block   :  np.ndarray,
+                 wfs     :  np.ndarray,
+                 dtype   :  np.dtype,
+                 plan    :  CalibrationPlan) -> Tuple[np.ndarray, int]:
+    '''
+    Formats a block of subtracted waveforms for the chosen output mode, see `calibrate()`.
+
+    Parameters
+    ----------
+
+    subwf  (dict)             :  Subtracted waveform output parameters
+    start  (int)              :  Row number of the first waveform in the block
+    block  (np.ndarray)       :  Raw waveform rows of the block
+    wfs    (np.ndarray)       :  Subtracted waveforms of the block
+    dtype  (np.dtype)         :  Output data-type from `subwf_layout()`
+    plan   (CalibrationPlan)  :  Plan from `calibration_plan()`
+
+    Returns
+    -------
+
+    (np.ndarray, int)         :  Output rows, and the output row to write them from
+    '''
+    index = start
+    match subwf['mode']:
+        case 'prescale':
+            # keep rows whose number is a multiple of the factor
+            factor = subwf['factor']
+            first  = -start % factor
+            block  = block[first::factor]
+            wfs    = wfs[first::factor]
+            index  = (start + first) // factor
+        case 'rebin':
+            factor = subwf['factor']
+            bins   = wfs.shape[1] // factor
+            wfs    = wfs[:, :bins * factor].reshape(len(wfs), bins, factor).sum(axis = 2)
+        case 'window':
+            # gather each waveform's window, zero padded to the longest window
+            windows = plan.windows[np.argmax(wfs, axis = 1)]
+            length  = dtype['rwf'].shape[0]
+            offsets = np.arange(length)
+            columns = np.minimum(windows[:, :1] + offsets, wfs.shape[1] - 1)
+            inside  = offsets < (windows[:, 1:] - windows[:, :1])
+            wfs     = np.where(inside, np.take_along_axis(wfs, columns, axis = 1), 0)
+
+    swf = np.empty(len(block), dtype = dtype)
+    swf['event_number'] = block['event_number']
+    swf['channels']     = block['channels']
+    swf['rwf']          = wfs
+    if subwf['mode'] == 'window':
+        swf['start'] = windows[:, 0]
+        swf['end']   = windows[:, 1]
+
+    return swf, index
+
+
+def bin_indices(values  :  np.ndarray,
+                edges   :  np.ndarray) -> np.ndarray:
+    '''
+    Bins values as `np.histogram()` does, with the last bin closed on the right.
+    Values below the binning are given bin 0, those above (or NaN) the last bin + 1,
+    so the bins within the range run from 1 to len(edges) - 1.
+
+    Parameters
+    ----------
+
+    values  (np.ndarray)  :  Values to bin
+    edges   (np.ndarray)  :  Monotonically increasing bin edges
+
+    Returns
+    -------
+
+    (np.ndarray)          :  Bin of each value, including under and overflow
+    '''
+    bins = np.searchsorted(edges, values, side = 'right')
+    # the upper edge belongs to the last bin
+    bins[values == edges[-1]] = len(edges) - 1
+    return bins
+
+
+def histogram_block(values    :  Tuple[np.ndarray, ...],
+                    edges     :  Tuple[np.ndarray, ...],
+                    channels  :  np.ndarray,
+                    n_chan    :  int) -> np.ndarray:
+    '''
+    Histograms a block of values per channel with a single `np.bincount()`
+    over a flattened (channel, bin, ...) index, so that blocks can be summed as they pass.
+
+    Parameters
+    ----------
+
+    values    (tuple)       :  One array of values per histogram dimension
+    edges     (tuple)       :  Bin edges for each dimension
+    channels  (np.ndarray)  :  Channel of each value
+    n_chan    (int)         :  Number of channels
+
+    Returns
+    -------
+
+    (np.ndarray)            :  (n_chan, bins + 2, ...) counts, including under and overflow bins
+    '''
+    shape = (n_chan,) + tuple(len(edge) + 1 for edge in edges)
+    index = np.ravel_multi_index((np.asarray(channels, dtype = np.intp),)
+                                 + tuple(bin_indices(value, edge) for value, edge in zip(values, edges)), shape)
+    return np.bincount(index, minlength = np.prod(shape)).reshape(shape)
+
+
+def histogram_edges(hist  :  Dict) -> Dict[str, Tuple[np.ndarray, ...]]:
+    '''
+    Collects the bin edges of the histograms requested from `calibrate()`.
+
+    Parameters
+    ----------
+
+    hist  (dict)  :  Histogram parameters, see `calibrate()`
+
+    Returns
+    -------
+
+    (dict)        :  Edges of each histogram along each of its dimensions
+    '''
+    edges = {}
+    for name in ('Q', 'height'):
+        if name in hist:
+            low, high, bins = hist[name]
+            edges[name] = (np.linspace(low, high, bins + 1),)
+    if hist.get('Q_height', False):
+        if ('Q' not in edges) or ('height' not in edges):
+            raise ValueError('A Q_height histogram needs both the Q and height binning.')
+        edges['Q_height'] = edges['Q'] + edges['height']
+    return edges
+
+
+def write_histograms(scribe  :  callable,
+                     counts  :  Dict[str, np.ndarray]) -> None:
+    '''
+    Writes the accumulated histograms, one row per channel, removing the under and
+    overflow bins into the `outside` count.
+
+    Parameters
+    ----------
+
+    scribe  (func)  :  Write function from `writer()`
+    counts  (dict)  :  Accumulated counts from `histogram_block()`
+    '''
+    for name, count in counts.items():
+        inside = tuple(slice(1, -1) for _ in range(count.ndim - 1))
+        rows   = np.empty(count.shape[0], dtype = types.hist_type(tuple(n - 2 for n in count.shape[1:])))
+        rows['channels'] = np.arange(count.shape[0])
+        rows['counts']   = count[(slice(None),) + inside]
+        rows['outside']  = count.reshape(count.shape[0], -1).sum(axis = 1) - rows['counts'].reshape(count.shape[0], -1).sum(axis = 1)
+        scribe(name, rows)
+
 
 def calibrate(file_path     :  str,
               cali_params   :  dict,
               save_path     :  Optional[Union[str, None]]                                     = None,
               overwrite     :  Optional[bool]                                                 = False,
-              visualise     :  Optional[bool]                                                 = True):
+              visualise     :  Optional[bool]                                                 = True,
+              session       :  Optional[Session]                                              = None,
+              block_size    :  Optional[int]                                                  = 10000,
+              workers       :  Optional[int]                                                  = 1,
+              subwf         :  Optional[Dict]                                                 = None,
+              hist          :  Optional[Dict]                                                 = None):
 
     '''
     Writes relevant charge output for each channel, allowing for simple
@@ -207,8 +746,8 @@ def calibrate(file_path     :  str,
     Initially, the charge, height and subtracted waveforms are returned.
     More may be added later.
 
-    WARNING: This function wont work if you chunked the file in decoding.
-             Chunking will be removed soon.
+    Older files chunked in decoding are read as a single table through `legacy_view()`,
+    use `migrate_legacy()` to avoid rebuilding the view on every read.
 
     Parameters
     ----------
@@ -228,72 +767,298 @@ def calibrate(file_path     :  str,
                                                         sidebands    ((int, int),
                                                                       (int, int))  :  windows to extract a baseline over (ns)
                                                         negative     (bool)        :  flag for flipping the waveform
+                                                        filters      (tuple)       :  optional filters applied in order after
+                                                                                      baseline subtraction, see `filter_block()`:
+                                                            {'type' : 'moving_average', 'width' : samples}
+                                                            {'type' : 'high_pass', 'tau' : ns}
+                                                            {'type' : 'low_pass',  'tau' : ns}
+                                                            {'type' : 'cr_rc',     'tau' : ns, 'order' : RC stages}
         save_path     (str)                     :  Path to save to if desired
         overwrite     (bool)                    :  Boolean for overwriting pre-existing datasets
         visualise     (bool)                    :  visualiser for the and signal extraction area
+        session       (Session)                 :  Session of open files to share, one is created
+                                                   for the duration of the calibration if not provided
+        block_size    (int)                     :  Number of waveforms calibrated at once
+        workers       (int)                     :  Number of processes calibrating blocks in parallel,
+                                                   the output is the same for any number of workers
+        subwf         (dict)                    :  Dictionary describing how subtracted waveforms are stored in subwf-1:
+                                                        mode    (str)              :  output mode:
+                                                            full     - every waveform (default)
+                                                            none     - no waveforms, only wf_info is written
+                                                            prescale - every `factor`th waveform
+                                                            rebin    - every waveform, summing each `factor` samples
+                                                            window   - only the integration window of every waveform,
+                                                                       with its start and end sample
+                                                        factor  (int)              :  prescale or rebinning factor
+        hist          (dict)                    :  Dictionary describing the per channel histograms filled as the
+                                                   waveforms are calibrated, written to CALI/hist:
+                                                        Q         (float, float, int)  :  charge range and number of bins
+                                                        height    (float, float, int)  :  height range and number of bins
+                                                        Q_height  (bool)               :  also fill a 2D charge vs height histogram
 
     '''
-    # check if chunked for backwards compatibility
-    chunked, keys, l_keys, e_keys = check_chunking(file_path)
+    # ensure correct file path output
+    if save_path is None:
+        file = file_path
+    else:
+        file = save_path
 
-    # check the number of rows for fixed_size calculations
-    num_rows = 0
-    if chunked:
-        for key in keys:
-            num_rows += check_rows(file_path, 'rwf', key)
+    # share one handle per file between every read and write of the calibration,
+    # a session provided by the caller is left open for them
+    if session is None:
+        pool = Session(modes = {file : 'a'})
     else:
-        num_rows = check_rows(file_path, 'rwf', keys[0])
+        pool = nullcontext(session)
+    with pool as session:
+        # older chunked files are read through a virtual /RAW/rwf, so every file is a single table
+        num_rows = check_rows(file_path, 'RAW', 'rwf', session)
+
+        # run constants, stored once per file rather than per row
+        metadata        = load_metadata(file_path, session)
+        samples         = metadata['samples']
+        sampling_period = metadata['sampling_period']
+        channels        = metadata['channels']
+
+        calibration_info_type = types.calibration_info_type
+
+        print(f'file: {file_path}\nsamples: {samples}\nsampling_period: {sampling_period}\nchannels: {channels}')
+
+        time = np.linspace(0,samples * sampling_period, num = samples)
+        plan = calibration_plan(time, cali_params)
+
+        if subwf is None:
+            subwf = {'mode' : 'full'}
+        layout = subwf_layout(subwf, num_rows, samples, plan)
+
+        # visualise the first 100 waveforms to ensure the sidebands are correct
+        if visualise:
+            visualise_waveforms(file_path, cali_params, time, 'rwf', 'RAW', session)
+
+        # histograms are accumulated per channel as the blocks pass
+        edges  = histogram_edges(hist) if hist is not None else {}
+        counts = {name : np.zeros((channels,) + tuple(len(edge) + 1 for edge in edge_set), dtype = np.int64)
+                  for name, edge_set in edges.items()}
+
+        # calibrate blocks of waveforms at once, writing each block as a slice
+        subwf_attrs = {'subwf_mode' : subwf['mode'], 'subwf_factor' : subwf.get('factor', 1)}
+        with writer(file, 'CALI', overwrite = True, metadata = subwf_attrs, session = session) as scribe:
+            with tqdm(total = num_rows) as progress:
+                blocks = block_reader(file_path, 'RAW', 'rwf', block_size, session = session)
+                for start, block, wfs, Q_vals, H_vals in calibrate_blocks(blocks, time, cali_params, plan, workers):
+
+                    # write with correct format
+                    info = np.empty(len(block), dtype = calibration_info_type)
+                    info['event_number'] = block['event_number']
+                    info['channels']     = block['channels']
+                    info['integrated_Q'] = Q_vals
+                    info['height']       = H_vals
+                    scribe('wf_info', info, (True, num_rows, start))
+
+                    values = {'Q' : (Q_vals,), 'height' : (H_vals,), 'Q_height' : (Q_vals, H_vals)}
+                    for name in counts:
+                        counts[name] += histogram_block(values[name], edges[name], block['channels'], channels)
+
+                    if layout is not None:
+                        swf, index = format_subwf(subwf, start, block, wfs, layout[0], plan)
+                        if len(swf) > 0:
+                            scribe('subwf-1', swf, (True, layout[1], index))
+                    progress.update(len(block))
+
+        if counts:
+            hist_attrs = {f'{name}_edges' : edges[name][0] for name in ('Q', 'height') if name in edges}
+            with writer(file, 'CALI/hist', overwrite = True, metadata = hist_attrs, session = session) as scribe:
+                write_histograms(scribe, counts)
+
+
+def spe_cdf(n_peaks  :  int) -> callable:
+    '''
+    Cumulative single photoelectron response model for binned fits: a pedestal
+    followed by Gaussian photoelectron peaks, weighted by a Poisson distribution.
+    The n-th peak sits at pedestal + n * gain with a width of sqrt(sigma_0^2 + n * sigma_1^2).
 
-    # extract relevant information from event info (assuming static)
-    scout                                    = reader(file_path, 'event_information', e_keys[0])
-    _, _, samples, sampling_period, channels = next(scout)
-    del scout
+    Parameters
+    ----------
 
-    calibration_info_type = types.calibration_info_type
-    wf_dtype              = types.rwf_type(samples)
+    n_peaks  (int)  :  Number of photoelectron peaks after the pedestal
 
-    print(f'file: {file_path}\nsamples: {samples}\nsampling_period: {sampling_period}\nchannels: {channels}')
+    Returns
+    -------
 
-    time = np.linspace(0,samples * sampling_period, num = samples)
+    (func)          :  cdf(edges, N, mu, pedestal, gain, sigma_0, sigma_1), scaled to N entries
+    '''
+    n_pe = np.arange(n_peaks + 1)
 
-    # visualise the first 100 waveforms to ensure the sidebands are correct
-    if visualise:
-        visualise_waveforms(file_path, cali_params, time, keys[0])
+    def cdf(edges, N, mu, pedestal, gain, sigma_0, sigma_1):
+        weights = poisson.pmf(n_pe, mu)
+        means   = pedestal + n_pe * gain
+        widths  = np.sqrt(sigma_0**2 + n_pe * sigma_1**2)
+        return N * np.sum(weights[:, np.newaxis] * norm.cdf(edges[np.newaxis, :], means[:, np.newaxis], widths[:, np.newaxis]), axis = 0)
+
+    return cdf
 
-    # ensure correct file path output
-    if save_path is None:
-        file = file_path
-    else:
-        file = save_path
 
-    # keep a track of the indices as you process the data
-    index_tracker = 0
-    with writer(file, 'CALI', overwrite = True) as scribe:
-        for key in tqdm(keys):
-            for waveform in reader(file_path, 'rwf', key, 'r+'):
-
-                evt_num  = waveform['event_number']
-                channels = waveform['channels']
-                wf       = waveform['rwf']
-
-                # flip the waveform
-                if cali_params['negative']:
-                    wf = -wf
-
-                # baseline subtraction
-                if cali_params['baseline_sub'] is not None:
-                    sideband_values = collect_sidebands(wf, time, cali_params)
-                    wf = wf - subtract_baseline(sideband_values, sub_type = cali_params['baseline_sub'])
-
-                # extract height and its index
-                H_val, H_index = extract_peak(wf)
-
-                start_index, end_index = collect_integration_window(time, cali_params, H_index)
-                Q_val = integrate(wf[start_index:end_index])
-
-                # write with correct format
-                info = np.array([(evt_num, channels, Q_val, H_val)], dtype = calibration_info_type)
-                swf  = np.array((evt_num, channels, wf), dtype = wf_dtype)
-                scribe('wf_info', info, (True, num_rows, index_tracker))
-                scribe('subwf-1', swf, (True, num_rows, index_tracker))
-                index_tracker += 1
+def fit_channel_gain(counts   :  np.ndarray,
+                     edges    :  np.ndarray,
+                     n_peaks  :  Optional[int]   = 5,
+                     gain     :  Optional[float] = None) -> np.ndarray:
+    '''
+    Fits the single photoelectron response model of `spe_cdf()` to one channel's
+    charge histogram with a binned extended likelihood.
+
+    Initial values come from the histogram: the pedestal from its highest bin, the pedestal
+    width from the bins below it, and the gain (unless provided) from the mean and variance
+    of the charge, as expected for a Poisson number of photoelectrons.
+
+    Parameters
+    ----------
+
+    counts   (np.ndarray)  :  Histogram counts
+    edges    (np.ndarray)  :  Histogram bin edges
+    n_peaks  (int)         :  Number of photoelectron peaks in the model
+    gain     (float)       :  Initial gain, estimated if not provided
+
+    Returns
+    -------
+
+    (np.ndarray)           :  Row of `types.gain_constants_type`, without the channel set
+    '''
+    result = np.zeros(1, dtype = types.gain_constants_type)[0]
+    total  = counts.sum()
+    if total == 0:
+        for field in ('gain', 'gain_error', 'pedestal', 'pedestal_error', 'resolution', 'resolution_error', 'mu'):
+            result[field] = np.nan
+        return result
+
+    centres  = (edges[1:] + edges[:-1]) / 2
+    width    = np.diff(edges).mean()
+    pedestal = centres[np.argmax(counts)]
+    below    = centres <= pedestal
+    sigma_0  = max(np.sqrt(np.sum(counts[below] * (centres[below] - pedestal)**2) / counts[below].sum()), width)
+    mean     = np.sum(counts * centres) / total - pedestal
+    variance = np.sum(counts * (centres - pedestal - mean)**2) / total
+    if gain is None:
+        gain = (variance - sigma_0**2) / mean if mean > 0 else 0
+        gain = gain if gain > sigma_0 else 3 * sigma_0
+    mu       = min(max(mean / gain, 0.05), n_peaks)
+
+    cost = ExtendedBinnedNLL(counts, edges, spe_cdf(n_peaks))
+    fit  = Minuit(cost, N = total, mu = mu, pedestal = pedestal, gain = gain, sigma_0 = sigma_0, sigma_1 = 0.3 * gain)
+    fit.limits['N']       = (0, None)
+    fit.limits['mu']      = (0, n_peaks)
+    fit.limits['gain']    = (width, None)
+    fit.limits['sigma_0'] = (width / 10, None)
+    fit.limits['sigma_1'] = (width / 10, None)
+    fit.migrad()
+    fit.hesse()
+
+    values, errors = fit.values, fit.errors
+    result['gain']             = values['gain']
+    result['gain_error']       = errors['gain']
+    result['pedestal']         = values['pedestal']
+    result['pedestal_error']   = errors['pedestal']
+    result['resolution']       = values['sigma_1'] / values['gain']
+    # uncorrelated propagation is good enough for the resolution
+    result['resolution_error'] = result['resolution'] * np.hypot(errors['sigma_1'] / values['sigma_1'], errors['gain'] / values['gain'])
+    result['mu']               = values['mu']
+    result['valid']            = fit.valid
+    return result
+
+
+def fit_gain(file_path     :  str,
+             n_peaks       :  Optional[int]   = 5,
+             gain          :  Optional[float] = None,
+             fit_range     :  Optional[Tuple[float, float]] = None,
+             save_path     :  Optional[str]   = None) -> np.ndarray:
+    '''
+    Fits the gain, pedestal and resolution of every channel to the charge histograms
+    written by `calibrate()` (with the `hist` option), and writes them to CALI/gain/constants.
+    Fitting the histograms rather than each event's charge keeps the fit fast for any
+    number of events.
+
+    Parameters
+    ----------
+
+        file_path  (str)           :  Path to the calibrated file
+        n_peaks    (int)           :  Number of photoelectron peaks in the model
+        gain       (float)         :  Initial gain for every channel, estimated per channel if not provided
+        fit_range  (float, float)  :  Charge range to fit over, the whole histogram by default
+        save_path  (str)           :  Path to also save the constants to as a .npy file
+
+    Returns
+    -------
+
+        (np.ndarray)               :  Fitted constants, of `types.gain_constants_type`
+
+    Raises
+    ------
+
+        ValueError                 :  If the file has no charge histograms, or fit_range holds none of their bins
+    '''
+    with h5py.File(file_path, 'r') as h5f:
+        if 'CALI/hist/Q' not in h5f:
+            raise ValueError(f"{file_path} has no charge histograms, calibrate it with the 'hist' option first.")
+        hists = h5f['CALI/hist/Q'][:]
+        edges = h5f['CALI/hist'].attrs['Q_edges']
+
+    # restrict to the bins within the fit range
+    bins = slice(None)
+    if fit_range is not None:
+        inside = np.flatnonzero((edges[:-1] >= fit_range[0]) & (edges[1:] <= fit_range[1]))
+        if len(inside) == 0:
+            raise ValueError(f'fit_range {tuple(fit_range)} holds no complete bin of the charge histograms, '
+                             f'which span {edges[0]:.4g} to {edges[-1]:.4g} in bins of {edges[1] - edges[0]:.4g}.')
+        bins   = slice(inside[0], inside[-1] + 1)
+    fit_edges = edges[bins.start : None if bins.stop is None else bins.stop + 1]
+
+    constants = np.zeros(len(hists), dtype = types.gain_constants_type)
+    for i, hist in enumerate(hists):
+        constants[i]             = fit_channel_gain(hist['counts'][bins], fit_edges, n_peaks, gain)
+        constants[i]['channels'] = hist['channels']
+        print(f"channel {hist['channels']}: gain {constants[i]['gain']:.4g} +- {constants[i]['gain_error']:.2g}, "
+              f"pedestal {constants[i]['pedestal']:.4g}, resolution {constants[i]['resolution']:.3g}"
+              f"{'' if constants[i]['valid'] else ' (FIT INVALID)'}")
+
+    with writer(file_path, 'CALI/gain', overwrite = True, metadata = {'n_peaks' : n_peaks}) as scribe:
+        scribe('constants', constants)
+    if save_path is not None:
+        np.save(save_path, constants)
+
+    return constants
+
+
+def apply_gain(file_path   :  str,
+               constants   :  Optional[Union[str, np.ndarray]] = None,
+               block_size  :  Optional[int]                    = 100000) -> None:
+    '''
+    Converts the charge of every calibrated waveform to photoelectrons, block by block,
+    writing them to CALI/pe/wf_info row for row with CALI/wf_info. The constants used
+    are stored as attributes of CALI/pe.
+
+    To convert with other constants without rewriting the file, pass them to `load_cali_info()`.
+
+    Parameters
+    ----------
+
+        file_path   (str)            :  Path to the calibrated file
+        constants   (str | ndarray)  :  Constants to apply, see `load_constants()`.
+                                        Defaults to those fitted to the file by `fit_gain()`.
+        block_size  (int)            :  Number of rows converted at once
+    '''
+    constants = load_constants(file_path if constants is None else constants)
+    for row in constants[~constants['valid']]:
+        warnings.warn(f"The gain fit of channel {row['channels']} is invalid, its photoelectrons may be wrong.")
+
+    attrs     = {'gain'     : constants['gain'],
+                 'pedestal' : constants['pedestal'],
+                 'channels' : constants['channels']}
+
+    # one handle for reading wf_info and writing alongside it
+    with Session(modes = {file_path : 'a'}) as session:
+        num_rows = check_rows(file_path, 'CALI', 'wf_info', session)
+        with writer(file_path, 'CALI/pe', overwrite = True, metadata = attrs, session = session) as scribe:
+            for start, block in block_reader(file_path, 'CALI', 'wf_info', block_size, session = session):
+                pe = np.empty(len(block), dtype = types.pe_info_type)
+                pe['event_number']  = block['event_number']
+                pe['channels']      = block['channels']
+                pe['integrated_PE'] = to_photoelectrons(block['integrated_Q'], block['channels'], constants)
+                scribe('wf_info', pe, (True, num_rows, start))
@@ -0,0 +1,124 @@
+import os
+import numpy  as np
+import heapq
+
+from typing import Optional
+from typing import List
+from typing import Generator
+
+from packs.core.io import writer, sorted_timestamps, Session
+from packs.types import types
+
+"""
+Coincidence utilities
+
+This file holds relevant functions for matching events across files by timestamp.
+"""
+
+
+def merge_coincidences(streams    :  List[Generator],
+                       window     :  int,
+                       min_files  :  Optional[int] = 2) -> Generator:
+    '''
+    k-way merges time ordered (timestamp, row) streams of several files, grouping
+    events with a sliding window in a single pass. A coincidence is opened by the
+    earliest unmatched event and holds every event within `window` of it, it is kept
+    if its events come from at least `min_files` different files.
+
+    Parameters
+    ----------
+
+    streams    (list)  :  Time ordered (timestamp, row) iterators, one per file
+    window     (int)   :  Coincidence window, in timestamp units
+    min_files  (int)   :  Minimum number of files taking part in a coincidence
+
+    Returns
+    -------
+
+    (generator)        :  Generator returning each coincidence as a list of
+                          (timestamp, file, row), ordered by timestamp then file
+    '''
+    def tag(file, stream):
+        for timestamp, row in stream:
+            yield (timestamp, file, row)
+
+    current = []
+    tagged  = [tag(file, stream) for file, stream in enumerate(streams)]
+    for event in heapq.merge(*tagged):
+        if current and event[0] - current[0][0] > window:
+            if len({file for _, file, _ in current}) >= min_files:
+                yield current
+            current = []
+        current.append(event)
+    if current and len({file for _, file, _ in current}) >= min_files:
+        yield current
+
+
+def find_coincidences(files       :  List[str],
+                      save_path   :  str,
+                      window      :  int,
+                      min_files   :  Optional[int] = 2,
+                      overwrite   :  Optional[bool] = True,
+                      block_size  :  Optional[int] = 100000) -> int:
+    '''
+    Finds events whose timestamps fall within a coincidence window across several
+    files (boards, digitisers or runs sharing a clock), streaming the sorted timestamps
+    of each file rather than loading them all.
+
+    The coincidences are written to COIN/coincidences in save_path as an index table,
+    one row per matched event holding the coincidence number, the file (its position in `files`,
+    whose absolute paths are stored in the `files` attribute of COIN), its /RAW/event_info row
+    and timestamp. Without overwrite, a previous COIN group is only appended to if it was
+    found with the same files, window and min_files.
+    The rows of a coincidence are contiguous, so matched events can be read with
+    `rows_to_ranges()` and `block_reader()` without loading the full files.
+
+    Parameters
+    ----------
+
+        files       (list)  :  Paths of the processed files to match
+        save_path   (str)   :  Path of the .h5 file to write the coincidences to
+        window      (int)   :  Coincidence window, in timestamp units
+        min_files   (int)   :  Minimum number of files taking part in a coincidence
+        overwrite   (bool)  :  Boolean for overwriting a previous COIN group
+        block_size  (int)   :  Number of timestamps read, and coincidence rows written, at once
+
+    Returns
+    -------
+
+        (int)               :  Number of coincidences found
+    '''
+    if len(files) < min_files:
+        raise ValueError(f'{len(files)} files provided, at least min_files ({min_files}) are needed for a coincidence.')
+
+    # absolute paths, so the files can be found again from anywhere
+    files = [os.path.abspath(file) for file in files]
+    attrs = {'files' : files, 'window' : window, 'min_files' : min_files}
+    # the coincidences may be written into one of the files being matched
+    modes = {file : 'r' for file in files}
+    modes[save_path] = 'a'
+    with Session(modes = modes) as session:
+        if not overwrite and os.path.exists(save_path):
+            h5f = session.open(save_path, 'a')
+            if 'COIN' in h5f:
+                previous = h5f['COIN'].attrs
+                if (list(previous.get('files', [])) != files or
+                    any(previous.get(key) != attrs[key] for key in ('window', 'min_files'))):
+                    raise ValueError(f'{save_path} already holds coincidences of other files or settings '
+                                     f'({list(previous.get("files", []))}), set overwrite to replace them.')
+
+        streams = [sorted_timestamps(file, block_size, session) for file in files]
+
+        with writer(save_path, 'COIN', overwrite = overwrite, metadata = attrs, session = session) as scribe:
+            rows, number, written = [], 0, False
+            for number, coincidence in enumerate(merge_coincidences(streams, window, min_files), start = 1):
+                rows.extend((number - 1, file, row, timestamp) for timestamp, file, row in coincidence)
+                if len(rows) >= block_size:
+                    scribe('coincidences', np.array(rows, dtype = types.coincidence_type))
+                    rows, written = [], True
+            # the table is written even if no coincidences were found
+            if rows or not written:
+                scribe('coincidences', np.array(rows, dtype = types.coincidence_type))
+
+    print(f'{number} coincidences found')
+    return number
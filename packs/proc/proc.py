@@ -3,10 +3,16 @@ import sys
 import traceback
 
 from packs.core.io                import read_config_file
+from packs.core.io                import migrate_legacy
 from packs.proc.processing_utils  import process_csv_lecroy
 from packs.proc.processing_utils  import process_bin_WD2_lazy
 from packs.proc.processing_utils  import process_bin_WD1
 from packs.proc.calibration_utils    import calibrate
+from packs.proc.calibration_utils    import fit_gain
+from packs.proc.calibration_utils    import apply_gain
+from packs.proc.pulse_utils          import find_pulses
+from packs.proc.pulse_utils          import extract_timing
+from packs.proc.coincidence_utils    import find_coincidences
 from packs.core.core_utils        import check_test
 
 def proc(config_file):
@@ -43,6 +49,18 @@ def proc(config_file):
                     raise RuntimeError('No valid decoding method selected.')
             case 'calibrate':
                 calibrate(**conf_dict)
+            case 'fit_gain':
+                fit_gain(**conf_dict)
+            case 'apply_gain':
+                apply_gain(**conf_dict)
+            case 'find_pulses':
+                find_pulses(**conf_dict)
+            case 'extract_timing':
+                extract_timing(**conf_dict)
+            case 'coincidence':
+                find_coincidences(**conf_dict)
+            case 'migrate':
+                migrate_legacy(**conf_dict)
             case other:
                 raise RuntimeError(f"process {other} not currently implemented.")
     except KeyError as e:
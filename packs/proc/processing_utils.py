@@ -23,6 +23,7 @@ from datetime import datetime
 from packs.core.core_utils import flatten
 from packs.core.core_utils import MalformedHeaderError
 from packs.core.io         import writer
+from packs.core.io         import write_index
 from packs.types           import types
 
 """
@@ -301,9 +302,61 @@ def number_of_events_WD2(file_path    :  str,
                          samples      :  int,
                          channels     :  int,
                          header_size  :  int) -> int:
+    '''
+    Number of complete events in a WD2 binary file. Every event has the same size,
+    so a truncated final event is dropped, as it is by `read_binary_lazy()`.
+    '''
     file_size     = os.path.getsize(file_path)
-    waveform_size = ((samples * channels * 4 ) + header_size) # can't remember why *2, will need to test this
-    num_of_events = int(file_size / waveform_size)
+    waveform_size = ((samples * channels * 4 ) + header_size)
+    num_of_events = file_size // waveform_size
+
+    return num_of_events
+
+
+def number_of_events_WD1(file_object  :  BinaryIO) -> int:
+    '''
+    Number of complete events in an opened WD1 binary file. Events usually share
+    the size of the first one, in which case the count is the file size over the
+    event size (24 header bytes and 2 bytes per sample), once the header of the
+    last event agrees. Otherwise it is found by walking the headers and seeking
+    over each waveform. The file is returned to where it was.
+
+    Parameters
+    ----------
+        file_object  (obj)  :  Opened file object
+
+    Returns
+    -------
+        num_of_events  (int)  :  Number of events whose waveform is fully present
+    '''
+    start         = file_object.tell()
+    file_size     = os.fstat(file_object.fileno()).st_size
+
+    # fixed size events, check the first and last headers agree
+    first = np.fromfile(file_object, dtype = '<i', count = 6)
+    if len(first) == 6 and first[0] > 24:
+        num_of_events = (file_size - start) // int(first[0])
+        file_object.seek(start + (num_of_events - 1) * int(first[0]))
+        last  = np.fromfile(file_object, dtype = '<i', count = 6)
+        file_object.seek(start)
+        # the event counter is 24 bits
+        if (num_of_events > 0 and len(last) == 6 and last[0] == first[0] and
+            (int(last[4]) - int(first[4])) % 2**24 == (num_of_events - 1) % 2**24):
+            return num_of_events
+    file_object.seek(start)
+
+    # variable size events, walk the headers
+    num_of_events = 0
+    position      = start
+    while position + 24 <= file_size:
+        header     = np.fromfile(file_object, dtype = '<i', count = 6)
+        # event size in bytes includes the header, stop at broken or truncated events
+        if (len(header) < 6) or (header[0] <= 24) or (position + header[0] > file_size):
+            break
+        position      += int(header[0])
+        num_of_events += 1
+        file_object.seek(position)
+    file_object.seek(start)
 
     return num_of_events
 
@@ -394,6 +447,118 @@ def save_data(event_information  :  np.ndarray,
 
 
 
+def run_metadata(file_path         :  str,
+                 decoder           :  str,
+                 byte_order        :  Optional[str],
+                 samples           :  int,
+                 sampling_period   :  (int | float),
+                 channels          :  int,
+                 compact           :  Optional[bool] = False,
+                 timestamp_origin  :  Optional[int]  = 0,
+                 timestamp_wrap    :  Optional[int]  = None) -> dict:
+    '''
+    Collects the run constants of a decoded file, written once as attributes
+    on the RAW group rather than repeated in every event_info row.
+
+    Parameters
+    ----------
+
+        file_path        (str)          :  Path to the source file
+        decoder          (str)          :  Decoder used (WD1, WD2, LeCroy model)
+        byte_order       (str)          :  Byte order the source file was read with, None for text sources
+        samples          (int)          :  Number of samples per waveform
+        sampling_period  (int | float)  :  The time value of 1 sample in ns
+        channels         (int)          :  Number of channels in the data
+        compact          (bool)         :  Flag for the compact schema
+        timestamp_origin (int)          :  Timestamp the compact deltas are taken from
+        timestamp_wrap   (int)          :  Period of a wrapping timestamp counter, its compact deltas
+                                           are taken modulo it (compact schema only)
+
+    Returns
+    -------
+
+        metadata  (dict)  :  Attributes for the RAW group
+    '''
+    metadata = {'schema_version'  : types.SCHEMA_VERSION,
+                'compact'         : compact,
+                'timestamp_origin': timestamp_origin,
+                'samples'         : samples,
+                'sampling_period' : sampling_period,
+                'channels'        : channels,
+                'source_file'     : os.path.abspath(file_path),
+                'decoder'         : decoder,
+                'decoder_version' : types.MULE_VERSION}
+    if byte_order is not None:
+        metadata['byte_order'] = byte_order
+    if compact and timestamp_wrap is not None:
+        metadata['timestamp_wrap'] = timestamp_wrap
+    return metadata
+
+
+def index_output(save_path  :  str,
+                 swmr       :  bool):
+    '''
+    Writes the range query indices of a decoded file. Live SWMR readers may
+    still hold the file once decoding finishes, in which case the indices are
+    left to be written later with `write_index()`.
+
+    Parameters
+    ----------
+
+        save_path  (str)   :  Path to decoded file
+        swmr       (bool)  :  Flag for files written in SWMR mode
+    '''
+    try:
+        write_index(save_path)
+    except OSError:
+        if not swmr:
+            raise
+        warnings.warn(f"Unable to index {save_path} while it is held by SWMR readers, run write_index() on it once they're done.")
+
+
+def format_event_row(event_number  :  int,
+                     timestamp     :  int,
+                     previous      :  int,
+                     compact       :  bool,
+                     wrap          :  Optional[int] = None) -> np.ndarray:
+    '''
+    Produces the event_info row written by the decoders.
+    In the compact schema the timestamp is stored as the difference to the
+    previous event, so consecutive events must be in order and less than
+    2^32 ticks apart. Timestamps from a counter that wraps every `wrap` ticks
+    have their difference taken modulo `wrap` instead, so rollovers are kept.
+
+    Parameters
+    ----------
+
+        event_number  (int)   :  Event number
+        timestamp     (int)   :  Timestamp of the event
+        previous      (int)   :  Timestamp of the previous event (or timestamp origin)
+        compact       (bool)  :  Flag for the compact schema
+        wrap          (int)   :  Period of a wrapping timestamp counter (OPTIONAL)
+
+    Returns
+    -------
+
+        (ndarray)  :  Event row
+
+    Raises
+    ------
+
+        ValueError  :  If the compact timestamp delta doesn't fit in 32 bits
+    '''
+    if compact:
+        delta = int(timestamp) - int(previous)
+        if wrap is not None:
+            delta %= wrap
+        if not 0 <= delta < 2**32:
+            raise ValueError(f'Event {event_number} is {delta} ticks after the previous event, the compact schema '
+                             f'only holds gaps from 0 to 2^32 - 1 ticks. Write this file without compact.')
+        return np.array((event_number, delta), dtype = types.event_row_compact_type)
+    else:
+        return np.array((event_number, timestamp), dtype = types.event_row_type)
+
+
 def check_save_path(save_path: str,
                     overwrite: bool,
                     max_iterations : Optional[int] = 100) -> str:
@@ -460,7 +625,7 @@ def process_event_lazy_WD1(file_object  :  BinaryIO):
     '''
 
     # read first header
-    header = np.fromfile(file_object, dtype = 'i', count = 6)
+    header = np.fromfile(file_object, dtype = '<i', count = 6)
 
     # header to check against
     sanity_header = header.copy()
@@ -471,10 +636,14 @@ def process_event_lazy_WD1(file_object  :  BinaryIO):
         header[0] = header[0] - 24
         event_size = header[0] // 2 # number of samples in the event, as each sample is 2 bytes and header is 24 bytes
 
-        # collect waveform, no of samples and timestamp
-        yield (np.fromfile(file_object, dtype = np.dtype('<H'), count = event_size), event_size, header[-1])
+        # collect waveform, no of samples and timestamp, a truncated final event is dropped
+        waveform = np.fromfile(file_object, dtype = np.dtype('<H'), count = event_size)
+        if len(waveform) < event_size:
+            warnings.warn(f"Final event is truncated ({len(waveform)} of {event_size} samples), dropping it.")
+            break
+        yield (waveform, event_size, header[-1])
         # collect next header
-        header = np.fromfile(file_object, dtype = 'i', count = 6)
+        header = np.fromfile(file_object, dtype = '<i', count = 6)
         # check if header has correct number of elements and correct information ONCE.
         if sanity_header is not None:
             if len(header) == 6:
@@ -494,7 +663,9 @@ def process_bin_WD1(file_path    :  str,
                     save_path    :  str,
                     sample_size  :  float,
                     overwrite    :  Optional[bool] = False,
-                    print_mod    :  Optional[int] = -1):
+                    print_mod    :  Optional[int] = -1,
+                    compact      :  Optional[bool] = False,
+                    swmr         :  Optional[bool] = False):
 
     '''
     WAVEDUMP 1: Takes a binary file and outputs the containing information in a h5 file.
@@ -517,6 +688,8 @@ def process_bin_WD1(file_path    :  str,
         sample_size  (float)   :  Size of each sample in an event (default 2 ns in the case of V1730B digitiser)
         overwrite    (bool)  :  Boolean for overwriting pre-existing files
         print_mod    (int)   :  Readout frequency for number of events, -1 implies no readout
+        compact      (bool)  :  Write with the compact schema (narrow types, delta-encoded timestamps)
+        swmr         (bool)  :  Write in SWMR mode, so the output can be read while decoding
     Returns
     -------
         None
@@ -533,36 +706,51 @@ def process_bin_WD1(file_path    :  str,
     # open file for reading
     with open(file_path, 'rb') as file:
 
+        # peek at the first header for the run constants, then rewind
+        header  = np.fromfile(file, dtype = '<i', count = 6)
+        file.seek(0)
+        num_of_events = number_of_events_WD1(file)
+        metadata = run_metadata(file_path, 'WD1', 'little',
+                                samples          = (int(header[0]) - 24) // 2 if len(header) == 6 else 0,
+                                sampling_period  = sample_size,
+                                channels         = 1,
+                                compact          = compact,
+                                timestamp_origin = int(header[5]) if len(header) == 6 else 0,
+                                timestamp_wrap   = types.WD1_TIMESTAMP_WRAP)
+        previous = metadata['timestamp_origin']
+
         # open writer object
-        with writer(save_path, 'RAW', overwrite) as write:
+        with writer(save_path, 'RAW', overwrite, metadata, swmr = swmr) as write:
 
             for i, (waveform, samples, timestamp) in enumerate(process_event_lazy_WD1(file)):
 
                 if (i % print_mod == 0) and (print_mod != -1):
                     print(f"Event {i}")
                 # enforce stucture upon data
-                e_dtype  = types.event_info_type
-                wf_dtype = types.rwf_type_WD1(samples)
+                if compact:
+                    wf_dtype = types.rwf_type_compact(samples, np.uint16)
+                else:
+                    wf_dtype = types.rwf_type_WD1(samples)
 
-                event_info = np.array((i, timestamp, samples, sample_size, 1), dtype = e_dtype)
+                event_info = format_event_row(i, timestamp, previous, compact, types.WD1_TIMESTAMP_WRAP)
                 waveforms  = np.array((i, 0, waveform), dtype = wf_dtype)
-
-                # first run-through, collect the header information to extract table size
-                if i == 0:
-                    file_size     = os.path.getsize(file_path)
-                    waveform_size = (samples * 2) + (4*6)
-                    num_of_events = int(file_size / waveform_size)
+                previous   = timestamp
 
                 # add data to df lazily
                 write('event_info', event_info, (True, num_of_events, i))
                 write('rwf', waveforms, (True, num_of_events, i))
 
+    # sorted timestamp and event number lookups for range queries
+    index_output(save_path, swmr)
+
 
 
 def process_bin_WD2_lazy(file_path  :  str,
                     save_path  :  str,
                     overwrite  :  Optional[bool] = False,
-                    print_mod  :  Optional[int]  = -1):
+                    print_mod  :  Optional[int]  = -1,
+                    compact    :  Optional[bool] = False,
+                    swmr       :  Optional[bool] = False):
 
     '''
     WAVEDUMP 2: Takes a binary file and outputs the containing waveform information in a h5 file.
@@ -574,6 +762,8 @@ def process_bin_WD2_lazy(file_path  :  str,
         save_path  (str)   :  Path to saved file
         overwrite  (bool)  :  Boolean for overwriting pre-existing files
         print_mod  (int)   :  Readout frequency for number of events, -1 implies no readout
+        compact    (bool)  :  Write with the compact schema (narrow types, delta-encoded timestamps)
+        swmr       (bool)  :  Write in SWMR mode, so the output can be read while decoding
 
     Returns
     -------
@@ -600,8 +790,23 @@ def process_bin_WD2_lazy(file_path  :  str,
         else:
             header_size = 28
 
+        # first timestamp for the compact deltas
+        _, timestamp_origin, _, _ = read_defaults_WD2(file, sys.byteorder)
+        file.seek(0)
+
+        metadata = run_metadata(file_path, 'WD2', sys.byteorder,
+                                samples          = samples,
+                                sampling_period  = sampling_period,
+                                channels         = channels,
+                                compact          = compact,
+                                timestamp_origin = timestamp_origin)
+        previous = timestamp_origin
+        if compact:
+            wf_dtype = types.rwf_type_compact(samples, np.float32)
+        num_of_events = number_of_events_WD2(file_path, samples, channels, header_size)
+
         # open the lazy writer object `write'
-        with writer(save_path, 'RAW', overwrite) as write:
+        with writer(save_path, 'RAW', overwrite, metadata, swmr = swmr) as write:
             # read event lazily from the binary file object
             for i, (flag, array) in enumerate(read_binary_lazy(file, wdtype)):
 
@@ -612,18 +817,21 @@ def process_bin_WD2_lazy(file_path  :  str,
                 if flag:
 
                     evt_info, rwf = format_wfs(array, wdtype, samples, channels)
+                    if compact:
+                        rwf = rwf.astype(wf_dtype)
 
 
-                    # first run-through, collect the header information to extract table size
-                    if i == 0:
-                        num_of_events = number_of_events_WD2(file_path, samples, channels, header_size)
-
-                    # write each event to the file
-                    write('event_info', evt_info, (True, num_of_events, i))
+                    # write each event to the file, the run constants live in the metadata
+                    evt_row  = format_event_row(evt_info['event_number'][0], evt_info['timestamp'][0], previous, compact)
+                    previous = evt_info['timestamp'][0]
+                    write('event_info', evt_row, (True, num_of_events, i))
                     # writer only takes one row at a time, can't broadcast all three at once
                     for j, wfs in enumerate(rwf):
                         write('rwf',        wfs,      (True, num_of_events * channels, i + ((channels-1)*i) + j))
 
+    # sorted timestamp and event number lookups for range queries
+    index_output(save_path, swmr)
+
 def process_bin_WD2(file_path  :  str,
                     save_path  :  str,
                     overwrite  :  Optional[bool] = False,
@@ -804,6 +1012,10 @@ def process_event_lazy_lecroy(file_obj  :   io.TextIOWrapper):
     wf_num = 0
     while batch := get_batch(reader, segment_size):
 
+        # a truncated final waveform is dropped
+        if len(batch) < segment_size:
+            warnings.warn(f"Final waveform is truncated ({len(batch)} of {segment_size} samples), dropping it.")
+            break
         yield (batch, evt_info_times[wf_num])
         wf_num += 1
     # end of data
@@ -813,7 +1025,9 @@ def process_event_lazy_lecroy(file_obj  :   io.TextIOWrapper):
 def process_csv_lecroy(file_path    :  str,
                 save_path           :  str,
                 overwrite           :  Optional[bool] = False,
-                print_mod           :  Optional[int] = -1):
+                print_mod           :  Optional[int] = -1,
+                compact             :  Optional[bool] = False,
+                swmr                :  Optional[bool] = False):
     """
     Process a Lecroy CSV waveform file and write the parsed events to a structured output file.
     This only works for individual channels at the moment, as Lecroy oscilloscopes save one file per channel.
@@ -826,6 +1040,8 @@ def process_csv_lecroy(file_path    :  str,
         save_path  (str) : Path to the output file where processed waveform data will be saved.
         overwrite  (bool) : If True, overwrite the output file if it already exists. Defaults to False.
         print_mod  (int) : Print progress every N events. Set to -1 to disable printing. Defaults to -1.
+        compact    (bool) : Write with the compact schema (narrow types, delta-encoded timestamps). Defaults to False.
+        swmr       (bool) : Write in SWMR mode, so the output can be read while decoding. Defaults to False.
     Returns
     -------
         None
@@ -833,11 +1049,22 @@ def process_csv_lecroy(file_path    :  str,
 
     with open(file_path, 'r') as file_object:
 
-        (sample_size, num_of_events, samples) = read_header_lecroy(file_object)
-        print('wfs: ', num_of_events, '; samples: ', samples, '; sample size: ', sample_size)
+        (sample_size, segments, samples) = read_header_lecroy(file_object)
         file_object.seek(0)
+        # the header states the number of waveforms, a truncated final waveform is
+        # dropped while decoding and the row preallocated for it trimmed by the writer
+        num_of_events = segments
+        print('wfs: ', num_of_events, '; samples: ', samples, '; sample size: ', sample_size)
+
+        metadata = run_metadata(file_path, 'LECROYWS4054HD', None,
+                                samples         = samples,
+                                sampling_period = sample_size,
+                                channels        = 1,
+                                compact         = compact)
+        # timestamps are relative to the first segment, so the origin is zero
+        previous = 0
 
-        with writer(save_path, 'RAW', overwrite) as write:
+        with writer(save_path, 'RAW', overwrite, metadata, swmr = swmr) as write:
 
             for i, (waveform, timestamp) in enumerate(process_event_lazy_lecroy(file_object)):
 
@@ -845,12 +1072,18 @@ def process_csv_lecroy(file_path    :  str,
                     print(f"Event {i}")
 
                 # enforce stucture upon data
-                e_dtype  = types.event_info_type
-                wf_dtype = types.rwf_type(samples)
+                if compact:
+                    wf_dtype = types.rwf_type_compact(samples, np.float32)
+                else:
+                    wf_dtype = types.rwf_type(samples)
 
-                event_info = np.array((i, timestamp, samples, sample_size, 1), dtype = e_dtype)
+                event_info = format_event_row(i, timestamp, previous, compact)
                 waveforms  = np.array((i, 0, waveform), dtype = wf_dtype)
+                previous   = timestamp
 
                 # add data to df
                 write('event_info', event_info, (True, num_of_events, i))
                 write('rwf', waveforms, (True, num_of_events, i))
+
+    # sorted timestamp and event number lookups for range queries
+    index_output(save_path, swmr)
@@ -0,0 +1,295 @@
+import numpy  as np
+from contextlib import nullcontext
+
+from typing import Optional
+from typing import Tuple
+from typing import Dict
+
+from packs.core.io import writer, block_reader, check_rows, load_metadata, Session
+from packs.types import types
+from packs.proc.calibration_utils import calibration_plan, subtract_block_baseline, time_step
+from packs.core.waveform_utils import filter_block
+
+from tqdm import tqdm
+
+"""
+Pulse utilities
+
+This file holds relevant functions for finding every pulse within waveforms,
+and the arrival time of their leading pulse.
+"""
+
+
+def find_pulses_block(wfs        :  np.ndarray,
+                      threshold  :  float,
+                      min_width  :  Optional[int] = 1) -> Tuple[np.ndarray, ...]:
+    '''
+    Finds every pulse crossing the threshold in a block of (baseline subtracted) waveforms
+    with array operations over the whole block, rather than looping over samples.
+
+    A pulse runs from the first sample above threshold to the first sample back below it.
+
+    Parameters
+    ----------
+
+    wfs        (np.ndarray)  :  (N, samples) array of waveforms
+    threshold  (float)       :  Value a sample must exceed to be part of a pulse
+    min_width  (int)         :  Minimum number of samples above threshold for a pulse
+
+    Returns
+    -------
+
+    (np.ndarray, ...)        :  Waveform (row of the block), start, peak index, width,
+                                amplitude and charge of each pulse, ordered by waveform then start
+    '''
+    n_wfs, samples = wfs.shape
+    above = wfs > threshold
+
+    # rising and falling edges, padded so pulses at either end of a waveform are closed
+    edges        = np.diff(above.astype(np.int8), axis = 1, prepend = 0, append = 0)
+    rows, starts = np.nonzero(edges == 1)
+    _,    ends   = np.nonzero(edges == -1)
+
+    keep = (ends - starts) >= min_width
+    rows, starts, ends = rows[keep], starts[keep], ends[keep]
+    widths = ends - starts
+
+    if len(rows) == 0:
+        empty = np.array([], dtype = np.intp)
+        return empty, empty, empty, empty, np.array([], dtype = wfs.dtype), np.array([], dtype = np.float64)
+
+    # reduce over [start, end) of each pulse in the flattened block, the reductions
+    # between one pulse's end and the next pulse's start are discarded
+    flat       = np.append(wfs.ravel(), 0)
+    bounds     = np.empty(2 * len(rows), dtype = np.intp)
+    bounds[0::2] = rows * samples + starts
+    bounds[1::2] = rows * samples + ends
+    amplitudes = np.maximum.reduceat(flat, bounds)[0::2]
+    charges    = np.add.reduceat(flat.astype(np.float64), bounds)[0::2]
+
+    # first sample of each pulse reaching its amplitude
+    label  = np.repeat(np.arange(len(rows)), widths)
+    offset = np.arange(len(label)) - np.repeat(np.cumsum(widths) - widths, widths)
+    values = flat[np.repeat(bounds[0::2], widths) + offset]
+    at_max = np.flatnonzero(values == amplitudes[label])
+    _, first = np.unique(label[at_max], return_index = True)
+    peaks  = starts + offset[at_max[first]]
+
+    return rows, starts, peaks, widths, amplitudes, charges
+
+
+def find_pulses(file_path     :  str,
+                cali_params   :  Dict,
+                threshold     :  float,
+                save_path     :  Optional[str]  = None,
+                min_width     :  Optional[int]  = 1,
+                block_size    :  Optional[int]  = 10000,
+                session       :  Optional[Session] = None) -> None:
+    '''
+    Finds every pulse crossing the threshold in every waveform, streaming over the file
+    in blocks. Pulses are written to the ragged table PULSES/pulses, with PULSES/offsets
+    holding the first pulse row and pulse count of each waveform, row for row with /RAW/rwf.
+
+    Parameters
+    ----------
+
+        file_path     (str)     :  Path to the decoded file
+        cali_params   (dict)    :  Dictionary describing the baseline subtraction, as in `calibrate()`:
+                                        baseline_sub (str)         :  baseline subtraction method
+                                        sidebands    ((int, int),
+                                                      (int, int))  :  windows to extract a baseline over (ns)
+                                        negative     (bool)        :  flag for flipping the waveform
+                                        filters      (tuple)       :  optional filters applied after subtraction
+        threshold     (float)   :  Value a subtracted sample must exceed to be part of a pulse
+        save_path     (str)     :  Path to save to if desired
+        min_width     (int)     :  Minimum number of samples above threshold for a pulse
+        block_size    (int)     :  Number of waveforms searched at once
+        session       (Session) :  Session of open files to share, one is created
+                                   for the duration of the search if not provided
+    '''
+    file = file_path if save_path is None else save_path
+
+    if session is None:
+        pool = Session(modes = {file : 'a'})
+    else:
+        pool = nullcontext(session)
+    with pool as session:
+        num_rows = check_rows(file_path, 'RAW', 'rwf', session)
+        metadata = load_metadata(file_path, session)
+        samples  = metadata['samples']
+        time     = np.linspace(0, samples * metadata['sampling_period'], num = samples)
+        plan     = calibration_plan(time, cali_params)
+
+        attrs = {'threshold' : threshold, 'min_width' : min_width, 'sampling_period' : metadata['sampling_period']}
+        first = 0
+        with writer(file, 'PULSES', overwrite = True, metadata = attrs, session = session) as scribe:
+            for start, block in tqdm(block_reader(file_path, 'RAW', 'rwf', block_size, session = session),
+                                     total = -(-num_rows // block_size)):
+
+                wfs = subtract_block_baseline(block['rwf'], cali_params, plan)
+                wfs = filter_block(wfs, cali_params.get('filters'), time_step(time))
+                rows, starts, peaks, widths, amplitudes, charges = find_pulses_block(wfs, threshold, min_width)
+
+                pulses = np.empty(len(rows), dtype = types.pulse_type)
+                pulses['event_number'] = block['event_number'][rows]
+                pulses['channels']     = block['channels'][rows]
+                pulses['start']        = starts
+                pulses['peak']         = peaks
+                pulses['width']        = widths
+                pulses['amplitude']    = amplitudes
+                pulses['charge']       = charges
+
+                counts  = np.bincount(rows, minlength = len(block))
+                offsets = np.empty(len(block), dtype = types.pulse_offset_type)
+                offsets['event_number'] = block['event_number']
+                offsets['channels']     = block['channels']
+                offsets['first']        = first + np.cumsum(counts) - counts
+                offsets['count']        = counts
+                first += len(pulses)
+
+                # the table is created by the first block even if it holds no pulses
+                if (len(pulses) > 0) or (start == 0):
+                    scribe('pulses', pulses)
+                scribe('offsets', offsets, (True, num_rows, start))
+
+
+def interpolate_crossings(wfs      :  np.ndarray,
+                          time     :  np.ndarray,
+                          levels   :  np.ndarray,
+                          indices  :  np.ndarray) -> np.ndarray:
+    '''
+    Linearly interpolates the time at which each waveform crosses its level
+    between sample `index` (below) and sample `index + 1` (at or above).
+
+    Parameters
+    ----------
+
+    wfs      (np.ndarray)  :  (N, samples) array of waveforms
+    time     (np.ndarray)  :  Time array
+    levels   (np.ndarray)  :  Level crossed by each waveform
+    indices  (np.ndarray)  :  Sample before each crossing, -1 where there is none
+
+    Returns
+    -------
+
+    (np.ndarray)           :  Crossing times, NaN where there is no crossing
+    '''
+    valid = indices >= 0
+    i     = np.where(valid, indices, 0)
+    rows  = np.arange(len(wfs))
+    y0    = wfs[rows, i].astype(np.float64)
+    # y0 < level <= y1 for valid crossings, so the slope is positive
+    y1    = wfs[rows, np.minimum(i + 1, wfs.shape[1] - 1)].astype(np.float64)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        times = time[i] + (levels - y0) / (y1 - y0) * (time[np.minimum(i + 1, len(time) - 1)] - time[i])
+    return np.where(valid, times, np.nan)
+
+
+def timing_block(wfs        :  np.ndarray,
+                 time       :  np.ndarray,
+                 fraction   :  Optional[float] = 0.2,
+                 threshold  :  Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Extracts the arrival time of a block of (baseline subtracted) waveforms at once,
+    with linear interpolation between the samples either side of the crossing.
+
+    The constant fraction time is where the rising edge of the highest peak (as found by
+    `extract_peak()`) crosses `fraction` of its height. The leading edge time is where the
+    waveform first rises through a fixed threshold.
+
+    Parameters
+    ----------
+
+    wfs        (np.ndarray)  :  (N, samples) array of waveforms
+    time       (np.ndarray)  :  Time array
+    fraction   (float)       :  Fraction of the peak height for constant fraction timing
+    threshold  (float)       :  Level for leading edge timing, None skips it
+
+    Returns
+    -------
+
+    (np.ndarray, np.ndarray) :  Constant fraction and leading edge times,
+                                NaN where the waveform doesn't cross
+    '''
+    n_wfs, samples = wfs.shape
+    if samples == 0:
+        raise ValueError("timing_block() received an empty block of waveforms")
+    sample_index = np.arange(samples)
+
+    # last sample below the fraction before the peak, every sample after it up to the peak is above
+    H_vals    = np.max(wfs, axis = 1)
+    H_indices = np.argmax(wfs, axis = 1)
+    levels    = fraction * H_vals.astype(np.float64)
+    below     = (wfs < levels[:, np.newaxis]) & (sample_index < H_indices[:, np.newaxis])
+    last      = samples - 1 - np.argmax(below[:, ::-1], axis = 1)
+    last      = np.where(below.any(axis = 1) & (H_vals > 0), last, -1)
+    cfd_times = interpolate_crossings(wfs, time, levels, last)
+
+    if threshold is None:
+        return cfd_times, np.full(n_wfs, np.nan)
+
+    # first sample at or above threshold, the crossing is from the sample before it
+    above    = wfs >= threshold
+    first    = np.argmax(above, axis = 1)
+    first    = np.where(above.any(axis = 1) & (first > 0), first - 1, -1)
+    le_times = interpolate_crossings(wfs, time, np.full(n_wfs, threshold, dtype = np.float64), first)
+
+    return cfd_times, le_times
+
+
+def extract_timing(file_path     :  str,
+                   cali_params   :  Dict,
+                   fraction      :  Optional[float] = 0.2,
+                   threshold     :  Optional[float] = None,
+                   save_path     :  Optional[str]   = None,
+                   block_size    :  Optional[int]   = 10000,
+                   session       :  Optional[Session] = None) -> None:
+    '''
+    Extracts the constant fraction and leading edge arrival time of every waveform,
+    streaming over the file in blocks, and writes them to CALI/timing/wf_info,
+    row for row with CALI/wf_info (and /RAW/rwf).
+
+    Parameters
+    ----------
+
+        file_path     (str)     :  Path to the decoded file
+        cali_params   (dict)    :  Dictionary describing the baseline subtraction, as in `calibrate()`:
+                                        baseline_sub (str)         :  baseline subtraction method
+                                        sidebands    ((int, int),
+                                                      (int, int))  :  windows to extract a baseline over (ns)
+                                        negative     (bool)        :  flag for flipping the waveform
+                                        filters      (tuple)       :  optional filters applied after subtraction
+        fraction      (float)   :  Fraction of the peak height for constant fraction timing
+        threshold     (float)   :  Level for leading edge timing, left as NaN if not provided
+        save_path     (str)     :  Path to save to if desired
+        block_size    (int)     :  Number of waveforms timed at once
+        session       (Session) :  Session of open files to share, one is created
+                                   for the duration of the timing if not provided
+    '''
+    file = file_path if save_path is None else save_path
+
+    if session is None:
+        pool = Session(modes = {file : 'a'})
+    else:
+        pool = nullcontext(session)
+    with pool as session:
+        num_rows = check_rows(file_path, 'RAW', 'rwf', session)
+        metadata = load_metadata(file_path, session)
+        samples  = metadata['samples']
+        time     = np.linspace(0, samples * metadata['sampling_period'], num = samples)
+        plan     = calibration_plan(time, cali_params)
+
+        attrs = {'fraction' : fraction, 'threshold' : np.nan if threshold is None else threshold}
+        with writer(file, 'CALI/timing', overwrite = True, metadata = attrs, session = session) as scribe:
+            for start, block in tqdm(block_reader(file_path, 'RAW', 'rwf', block_size, session = session),
+                                     total = -(-num_rows // block_size)):
+
+                wfs = subtract_block_baseline(block['rwf'], cali_params, plan)
+                wfs = filter_block(wfs, cali_params.get('filters'), time_step(time))
+
+                timing = np.empty(len(block), dtype = types.timing_type)
+                timing['event_number'] = block['event_number']
+                timing['channels']     = block['channels']
+                timing['cfd_time'], timing['le_time'] = timing_block(wfs, time, fraction, threshold)
+
+                scribe('wf_info', timing, (True, num_rows, start))
@@ -1,7 +1,17 @@
 from packs.ana.analysis_utils import cook_data, suppress_baseline, average_waveforms, remove_secondaries, window_overlap_check
+from packs.ana.analysis_utils import reject_secondaries, cook_block, window_wf_check, budget_chunk_size
+from packs.ana.analysis_utils import partial_average, merge_partials, load_partial, accumulate_waveforms
+from packs.ana.analysis_utils import waveform_statistics, sample_histograms, histogram_quantiles
+from packs.ana.analysis_utils import align_block, reference_samples
+from packs.ana import analysis_utils
+from packs.core import io
+from packs.core.io import writer
+from packs.types import types
+from packs.core.waveform_utils import filter_block
 from packs.core.waveform_utils import collect_index, subtract_baseline, find_nearest
 from packs.ana.ana import ana
 import numpy as np
+import os
 import h5py
 import pytest
 import pandas as pd
@@ -135,6 +145,132 @@ def test_cook_data(): # Tests that the output shape of cook data matches the sha
         assert wf.shape == (20,)
         np.testing.assert_array_equal(wf, np.zeros(20))
 
+def test_cook_data_filters_subtracted_waveforms(): # Tests that filters act on the baseline subtracted waveform
+    data = np.zeros((1, 20), dtype=float)
+    data[0, 4] = 10
+
+    window_args = {
+        "WINDOW_START": 0,
+        "WINDOW_END": 8,
+        "BASELINE_POINT_1": 10,
+        "BASELINE_POINT_2": 15,
+        "BASELINE_RANGE_1": 2,
+        "BASELINE_RANGE_2": 2,
+    }
+
+    result = cook_data(
+        data=data,
+        bin_size=1,
+        window_args=window_args,
+        chunk_size=1,
+        chunk_number=0,
+        verbose=0,
+        peak_threshold=1000,
+        suppression_threshold=0,
+        filters=({'type': 'moving_average', 'width': 2},),
+    )
+
+    # the single spike is spread over two samples
+    expected = np.zeros(20)
+    expected[4:6] = 5
+    np.testing.assert_allclose(result[0], expected, atol=1e-12)
+
+def cook_data_loop(data, bin_size, window_args, negative, baseline_mode, peak_threshold, suppression_threshold, filters = None):
+    """
+    Reference cook_data, processing each waveform on its own
+    """
+    time    = np.linspace(0, len(data[0]), num=len(data[0]), dtype=int) * bin_size
+    wf_data = []
+    for i, wf in enumerate(data):
+        if negative:
+            wf = -wf
+        if not window_wf_check(wf, window_args):
+            continue
+        bl_range_1 = [collect_index(time, window_args['BASELINE_POINT_1'] - window_args['BASELINE_RANGE_1']),
+                      collect_index(time, window_args['BASELINE_POINT_1'] + window_args['BASELINE_RANGE_1'])]
+        bl_range_2 = [collect_index(time, window_args['BASELINE_POINT_2'] - window_args['BASELINE_RANGE_2']),
+                      collect_index(time, window_args['BASELINE_POINT_2'] + window_args['BASELINE_RANGE_2'])]
+        y_sideband = list(wf[bl_range_1[0]:bl_range_1[1]]) + list(wf[bl_range_2[0]:bl_range_2[1]])
+        sub_wf = wf - subtract_baseline(y_sideband, sub_type=baseline_mode)
+        if filters:
+            sub_wf = filter_block(sub_wf[np.newaxis, :], filters, bin_size)[0]
+        sup_wf = suppress_baseline(sub_wf, suppression_threshold)
+        final_wf = remove_secondaries(sup_wf, peak_threshold, time, i, 0, window_args['WINDOW_END'])
+        if final_wf is not None:
+            wf_data.append(final_wf)
+    return wf_data
+
+
+def test_reject_secondaries_flags_peaks_after_window(): # Tests that only peaks after WINDOW_END above the threshold are flagged
+    time = np.arange(20)
+    wfs  = np.zeros((3, 20))
+    wfs[0, 2]  = 50 # first signal, kept
+    wfs[1, 15] = 50 # secondary peak
+    wfs[2, 15] = 5  # below threshold
+
+    np.testing.assert_array_equal(reject_secondaries(wfs, 10, time, 8), [False, True, False])
+    np.testing.assert_array_equal(reject_secondaries(wfs, 10, time, 30), [False, False, False]) # nothing after the window
+
+
+def test_remove_secondaries_filters_without_printing(capsys): # Tests that remove_secondaries keeps or drops a single waveform silently
+    time = np.arange(20)
+    kept = np.zeros(20)
+    kept[2] = 50
+    rejected = kept.copy()
+    rejected[15] = 50
+
+    assert remove_secondaries(kept, 10, time, 0, 2, 8) is kept
+    assert remove_secondaries(rejected, 10, time, 1, 2, 8) is None
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.parametrize("baseline_mode", ("median", "mean", "none"))
+@pytest.mark.parametrize("negative", (True, False))
+@pytest.mark.parametrize("filters", (None, ({'type': 'moving_average', 'width': 3}, {'type': 'cr_rc', 'tau': 20})))
+def test_cook_data_matches_single_waveforms(baseline_mode, negative, filters): # Tests that the block path gives identical waveforms to the loop over waveforms
+    rng  = np.random.default_rng(10)
+    data = rng.normal(0, 2, size=(40, 60))
+    data[::7, 45:55] = 100 # secondary peaks, some rejected
+    if negative:
+        data = -data
+
+    window_args = {
+        "WINDOW_START": 0,
+        "WINDOW_END": 40,
+        "BASELINE_POINT_1": 20,
+        "BASELINE_POINT_2": 30,
+        "BASELINE_RANGE_1": 5,
+        "BASELINE_RANGE_2": 4,
+    }
+    args = dict(bin_size=1, window_args=window_args, negative=negative, baseline_mode=baseline_mode,
+                peak_threshold=20, suppression_threshold=2, filters=filters)
+
+    expected = cook_data_loop(data, **args)
+    result   = cook_data(data=data, chunk_size=40, chunk_number=0, verbose=0, **args)
+    accepted, rejected = cook_block(data, **args)
+
+    assert 0 < len(expected) < len(data)
+    assert len(result) == len(expected)
+    for wf, exp in zip(result, expected):
+        assert wf.tobytes() == exp.tobytes()
+    assert accepted.tobytes() == np.array(expected).tobytes()
+    assert len(rejected) == len(data) - len(expected)
+
+
+def test_cook_block_rejects_mismatched_windows(): # Tests that a block shorter than the windows is rejected entirely
+    window_args = {
+        "WINDOW_START": 0,
+        "WINDOW_END": 5,
+        "BASELINE_POINT_1": 10,
+        "BASELINE_POINT_2": 15,
+        "BASELINE_RANGE_1": 2,
+        "BASELINE_RANGE_2": 2,
+    }
+    accepted, rejected = cook_block(np.zeros((3, 10)), 1, window_args)
+
+    assert accepted.shape == (0, 10)
+    np.testing.assert_array_equal(rejected, [0, 1, 2])
+
 def test_cook_data_negative_flip(): # Tests that negatives are flipped
     data = np.ones((2, 10), dtype=float)
 
@@ -282,6 +418,258 @@ def test_negative_polarity(tmp_path): #Tests when wfs are negative
         # After polarity correction, average should be positive
     assert np.all(avg >= 0)
 
+def make_raw_h5(tmp_path, waveforms, name="test_raw.h5"):
+    """
+    Writes a test HDF5 file in the current /RAW layout
+    """
+    n_waveforms, n_samples = waveforms.shape
+    filepath = str(tmp_path / name)
+    rwf = np.zeros(n_waveforms, dtype=types.rwf_type(n_samples))
+    rwf['event_number'] = np.arange(n_waveforms)
+    rwf['rwf'] = waveforms
+    metadata = {'schema_version': types.SCHEMA_VERSION, 'samples': n_samples, 'sampling_period': 1, 'channels': 1}
+    with writer(filepath, 'RAW', overwrite=True, metadata=metadata) as scribe:
+        scribe('rwf', rwf)
+    return filepath
+
+
+@pytest.mark.parametrize("chunk_size, memory_budget", [(None, 1), (None, 10**9), (7, None)])
+def test_average_waveforms_streams_raw_blocks(tmp_path, monkeypatch, chunk_size, memory_budget): # Tests that RAW/rwf is streamed in chunks rather than loaded whole
+    rng = np.random.default_rng(11)
+    waveforms = rng.normal(0, 3, size=(30, 50)).astype(np.float32)
+    waveforms[::4, 40] = 500 # some rejected
+    filepath = make_raw_h5(tmp_path, waveforms)
+
+    # the whole file should never be loaded through pandas
+    def no_load(*args, **kwargs):
+        raise AssertionError("load_rwf_info shouldn't be used")
+    monkeypatch.setattr(io, "load_rwf_info", no_load)
+
+    window_args = {"WINDOW_START": 1, "WINDOW_END": 30, "BASELINE_POINT_1": 10, "BASELINE_POINT_2": 20, "BASELINE_RANGE_1": 3, "BASELINE_RANGE_2": 3}
+    args = dict(bin_size=1, window_args=window_args, negative=False, baseline_mode='median',
+                peak_threshold=100, suppression_threshold=1)
+
+    avg = average_waveforms(files=[filepath], chunk_size=chunk_size, memory_budget=memory_budget, verbose=0, **args)
+
+    accepted, _ = cook_block(waveforms, **args)
+    np.testing.assert_allclose(avg, accepted.mean(axis=0, dtype=np.float64), rtol=1e-6)
+
+
+def test_budget_chunk_size(tmp_path): # Tests that the chunk size scales with the memory budget
+    filepath = make_raw_h5(tmp_path, np.zeros((10, 100), dtype=np.float32))
+    row_bytes = types.rwf_type(100).itemsize + 4 * 100 * 8
+
+    assert budget_chunk_size(filepath, 1) == 1
+    assert budget_chunk_size(filepath, 50 * row_bytes) == 50
+    assert budget_chunk_size(filepath, 50 * row_bytes + row_bytes - 1) == 50
+
+
+AVERAGE_ARGS = dict(bin_size=1, negative=False, baseline_mode='median', peak_threshold=100, suppression_threshold=1, verbose=0,
+                    window_args={"WINDOW_START": 1, "WINDOW_END": 30, "BASELINE_POINT_1": 10, "BASELINE_POINT_2": 20, "BASELINE_RANGE_1": 3, "BASELINE_RANGE_2": 3})
+
+
+def make_raw_files(tmp_path, n_files):
+    rng = np.random.default_rng(12)
+    return [make_raw_h5(tmp_path, rng.normal(i, 3, size=(25 + i, 50)).astype(np.float32), f"raw_{i}.h5") for i in range(n_files)]
+
+
+@pytest.mark.parametrize("n_files, workers", [(3, 2), (1, 3)])
+def test_average_waveforms_workers_match_sequential(tmp_path, n_files, workers): # Tests that averaging files or row ranges across processes gives the sequential average
+    files = make_raw_files(tmp_path, n_files)
+
+    sequential = average_waveforms(files=files, chunk_size=4, **AVERAGE_ARGS)
+    parallel   = average_waveforms(files=files, chunk_size=4, workers=workers, **AVERAGE_ARGS)
+
+    np.testing.assert_allclose(parallel, sequential, rtol=1e-12)
+
+
+def test_average_waveforms_reuses_saved_partials(tmp_path, monkeypatch): # Tests that saved partials are merged in and their files skipped
+    files = make_raw_files(tmp_path, 3)
+    saved = str(tmp_path / "partial.h5")
+
+    average_waveforms(files=files[:2], save_partial_path=saved, **AVERAGE_ARGS)
+    expected = average_waveforms(files=files, **AVERAGE_ARGS)
+
+    averaged = []
+    def counting_partial_average(filepath, *args):
+        averaged.append(filepath)
+        return partial_average(filepath, *args)
+    monkeypatch.setattr(analysis_utils, "partial_average", counting_partial_average)
+
+    extended = average_waveforms(files=files, partials=[saved], **AVERAGE_ARGS)
+
+    assert averaged == [files[2]]
+    np.testing.assert_allclose(extended, expected, rtol=1e-12)
+    assert load_partial(saved).files == tuple(os.path.abspath(file) for file in files[:2])
+    assert np.sum(load_partial(saved).reasons) == 25 + 26
+
+
+def test_merge_partials_combines_variance_and_histograms(tmp_path): # Tests that merged partials match the moments and histograms of all the waveforms at once
+    files      = make_raw_files(tmp_path, 2)
+    hist_range = (-10, 10, 40)
+    partials   = [partial_average(file, AVERAGE_ARGS, chunk_size=4, variance=True, hist_range=hist_range) for file in files]
+    merged     = merge_partials(partials)
+
+    block_args = {key: value for key, value in AVERAGE_ARGS.items() if key != 'verbose'}
+    accepted   = np.concatenate([cook_block(io.load_rwf_info(file, 50).rwf.values, **block_args)[0] for file in files]).astype(np.float64)
+    expected_hist = np.array([np.histogram(np.clip(column, -10.1, 10.1), bins=[-np.inf] + list(np.linspace(-10, 10, 41)) + [np.inf])[0]
+                              for column in accepted.T])
+
+    assert merged.count == len(accepted)
+    np.testing.assert_allclose(merged.sum, accepted.sum(axis=0), rtol=1e-10)
+    np.testing.assert_allclose(merged.m2,  accepted.var(axis=0) * len(accepted), rtol=1e-10)
+    np.testing.assert_array_equal(merged.hist, expected_hist)
+
+
+def test_histogram_quantiles_within_a_bin(): # Tests that histogram quantiles are within a bin width of the exact quantiles
+    data       = np.random.default_rng(13).normal(0, 2, size=(5000, 6))
+    hist_range = (-10, 10, 200)
+    quantiles  = (0.05, 0.5, 0.84)
+
+    approx = histogram_quantiles(sample_histograms(data, hist_range), hist_range, quantiles)
+
+    assert approx.shape == (3, 6)
+    assert np.all(np.abs(approx - np.quantile(data, quantiles, axis=0)) <= 20 / 200)
+
+
+def test_waveform_statistics_single_pass(tmp_path): # Tests the spread statistics against numpy on every accepted waveform
+    files = make_raw_files(tmp_path, 3)
+
+    statistics = waveform_statistics(files=files, chunk_size=5, workers=2, quantiles=(0.5,), quantile_range=(-20, 20, 400), **AVERAGE_ARGS)
+
+    block_args = {key: value for key, value in AVERAGE_ARGS.items() if key != 'verbose'}
+    accepted   = np.concatenate([cook_block(io.load_rwf_info(file, 50).rwf.values, **block_args)[0] for file in files]).astype(np.float64)
+    np.testing.assert_allclose(statistics['Average_waveform'], accepted.mean(axis=0), rtol=1e-10)
+    np.testing.assert_allclose(statistics['Std_waveform'], accepted.std(axis=0), rtol=1e-10)
+    np.testing.assert_allclose(statistics['RMS_waveform'], np.sqrt((accepted**2).mean(axis=0)), rtol=1e-10)
+    assert np.all(np.abs(statistics['Quantile_waveforms'][0] - np.median(accepted, axis=0)) <= 40 / 400)
+
+    with pytest.raises(ValueError):
+        waveform_statistics(files=files, quantiles=(0.5,), **AVERAGE_ARGS)
+
+
+def jittered_pulses(n_waveforms, samples=200, width=6, jitter=8, seed=15):
+    rng     = np.random.default_rng(seed)
+    centres = 80 + rng.uniform(-jitter, jitter, size=n_waveforms)
+    time    = np.arange(samples)
+    return 100 * np.exp(-0.5 * ((time - centres[:, np.newaxis]) / width)**2), centres
+
+
+@pytest.mark.parametrize("align", [{'method': 'peak', 'reference': 240},
+                                   {'method': 'cfd', 'fraction': 0.5, 'reference': 240, 'shift': 'linear'}])
+def test_align_block_moves_references_together(align): # Tests that aligned waveforms share their reference time
+    wfs, centres = jittered_pulses(20)
+
+    aligned, found = align_block(wfs, 4, align)
+
+    assert found.all()
+    np.testing.assert_allclose(reference_samples(aligned, align), 240 / 4, atol=0.05)
+
+
+def test_aligned_average_recovers_pulse(tmp_path): # Tests that aligning removes the smearing of jitter from the average
+    wfs, _   = jittered_pulses(40)
+    filepath = make_raw_h5(tmp_path, wfs.astype(np.float32))
+    args     = dict(bin_size=1, negative=False, baseline_mode='median', peak_threshold=1000, suppression_threshold=-1, verbose=0,
+                    window_args={"WINDOW_START": 1, "WINDOW_END": 150, "BASELINE_POINT_1": 20, "BASELINE_POINT_2": 170, "BASELINE_RANGE_1": 5, "BASELINE_RANGE_2": 5})
+
+    smeared = average_waveforms(files=[filepath], **args)
+    aligned = average_waveforms(files=[filepath], chunk_size=7, align={'method': 'peak', 'reference': 100}, **args)
+
+    expected = 100 * np.exp(-0.5 * ((np.arange(200) - 100) / 6)**2)
+    assert smeared.max() < 90
+    np.testing.assert_allclose(aligned, expected, atol=0.5)
+
+
+def test_cook_data_summarises_rejections(capsys): # Tests that a chunk's rejections are summarised in one line rather than per event
+    waveforms = np.random.default_rng(16).normal(0, 3, size=(20, 50))
+    waveforms[::5, 40] = 500
+
+    result = cook_data(waveforms, chunk_size=20, chunk_number=1, verbose=1, **{key: value for key, value in AVERAGE_ARGS.items() if key != 'verbose'})
+
+    assert len(result) == 16
+    assert capsys.readouterr().out == "Waveforms 20 to 39: 20 waveforms, 16 accepted, 4 secondary_peak\n"
+
+
+@pytest.mark.parametrize("workers", (1, 3))
+def test_accumulate_waveforms_writes_selection(tmp_path, workers): # Tests that the reason of every waveform is written, row for row, and counted
+    wfs, _ = jittered_pulses(30)
+    wfs[::6, 180] = 2000 # secondary peaks
+    wfs[1::6] = 0        # no pulse to align on
+    files  = [make_raw_h5(tmp_path, wfs.astype(np.float32), "pulses.h5"),
+              make_raw_h5(tmp_path, np.zeros((4, 10), dtype=np.float32), "short.h5")]
+    args   = dict(bin_size=1, negative=False, baseline_mode='median', peak_threshold=1000, suppression_threshold=1, verbose=0,
+                  window_args={"WINDOW_START": 1, "WINDOW_END": 150, "BASELINE_POINT_1": 20, "BASELINE_POINT_2": 170, "BASELINE_RANGE_1": 5, "BASELINE_RANGE_2": 5})
+    saved  = str(tmp_path / "selection.h5")
+
+    merged = accumulate_waveforms(files, args, chunk_size=7, workers=workers, align={'method': 'cfd', 'reference': 100}, selection_path=saved)
+
+    expected = np.full(30, types.ACCEPTED)
+    expected[::6]  = types.SECONDARY_PEAK
+    expected[1::6] = types.NO_REFERENCE
+    with h5py.File(saved, 'r') as f:
+        selection = f['ANA/selection'][:]
+        assert tuple(f['ANA'].attrs['files']) == tuple(os.path.abspath(file) for file in files)
+    np.testing.assert_array_equal(selection['file'], np.repeat([0, 1], [30, 4]))
+    np.testing.assert_array_equal(selection['row'], np.r_[np.arange(30), np.arange(4)])
+    np.testing.assert_array_equal(selection['reason'], np.r_[expected, np.full(4, types.WINDOW_MISMATCH)])
+    np.testing.assert_array_equal(merged.reasons, np.bincount(selection['reason'], minlength=len(types.selection_reasons)))
+    assert merged.count == np.sum(expected == types.ACCEPTED)
+
+
+def test_merge_partials_keeps_examples(tmp_path): # Tests that merged examples keep pointing at their files
+    files    = [make_raw_h5(tmp_path, np.zeros((4, 10), dtype=np.float32), "short.h5")] + make_raw_files(tmp_path, 1)
+    partials = [partial_average(file, AVERAGE_ARGS, chunk_size=3, plot_sample=2) for file in files]
+
+    merged = merge_partials(partials[::-1])
+
+    assert [(merged.files[file], row, reason) for file, row, reason, _ in merged.examples] == \
+           [(os.path.abspath(files[0]), row, types.WINDOW_MISMATCH) for row in range(2)]
+    np.testing.assert_array_equal(merged.reasons, partials[0].reasons + partials[1].reasons)
+
+
+def test_ana_writes_selection_and_plots(tmp_path, capsys): # Tests that ana writes ANA/selection, a summary and a plot of rejected waveforms
+    waveforms = np.random.default_rng(17).normal(0, 3, size=(12, 50)).astype(np.float32)
+    waveforms[::3, 40] = 500
+    fake_input = make_raw_h5(tmp_path, waveforms)
+    plots      = tmp_path / "rejected.png"
+
+    config_text = f"""
+    [required]
+
+    files = [r'{fake_input}']
+
+    window_args = {{'WINDOW_START': 1, 'WINDOW_END': 5, 'BASELINE_POINT_1': 10, 'BASELINE_POINT_2': 20, 'BASELINE_RANGE_1': 3, 'BASELINE_RANGE_2': 3}}
+
+    bin_size = 1
+    chunk_size = 5
+    negative = False
+    baseline_mode = 'median'
+    verbose = 1
+    peak_threshold = 100
+    suppression_threshold = 1
+    rejection_plots = r'{plots}'
+    plot_sample = 2
+
+    overwrite = True
+    save_path = r'{tmp_path / "ana.h5"}'
+    """
+    config_file = tmp_path / "config.conf"
+    config_file.write_text(config_text)
+
+    ana(str(config_file))
+
+    assert "Selection: 12 waveforms, 8 accepted, 4 secondary_peak" in capsys.readouterr().out
+    assert plots.exists()
+    with h5py.File(tmp_path / "ana.h5", "r") as f:
+        selection = f['ANA/selection'][:]
+        assert list(f['ANA'].attrs['files']) == [os.path.abspath(fake_input)]
+        assert tuple(f['ANA'].attrs['reasons']) == types.selection_reasons
+        assert 'selection' not in f
+        assert list(f.keys()) == ['ANA', 'Average_waveform']
+    np.testing.assert_array_equal(selection['row'], np.arange(12))
+    np.testing.assert_array_equal(selection['reason'] == types.SECONDARY_PEAK, np.arange(12) % 3 == 0)
+
+
 def test_window_args_neg(): # Tests for a negative window arg input
     window_args={"WINDOW_START": -1, "WINDOW_END": 5, "BASELINE_POINT_1": 10, "BASELINE_POINT_2" :15, "BASELINE_RANGE_1":1, "BASELINE_RANGE_2":1}
     with pytest.raises(ValueError):
@@ -370,6 +758,7 @@ def test_ana_integration_conf_file(tmp_path):
     verbose = 1
     peak_threshold = 1000
     suppression_threshold = 0
+    variance = True
 
     overwrite = True
     save_path = r'{tmp_path / "tmp" / "test.h5"}'
@@ -391,6 +780,8 @@ def test_ana_integration_conf_file(tmp_path):
 
     with h5py.File(out_file, "r") as f:
         assert "Average_waveform" in f
+        np.testing.assert_allclose(f["Std_waveform"][:], np.zeros(100))
+        np.testing.assert_allclose(f["RMS_waveform"][:], expected)
 
         data = f["Average_waveform"][:]
 
@@ -1,7 +1,9 @@
 import os
 import sys
+import subprocess
 
 import numpy as np
+import h5py
 import pandas as pd
 
 from pytest                        import mark
@@ -16,6 +18,25 @@ from packs.core.io import writer
 
 from packs.core.io import load_evt_info
 from packs.core.io import load_rwf_info
+from packs.core.io import write_index
+from packs.core.io import query_rows
+from packs.core.io import rows_to_ranges
+from packs.core.io import event_to_rwf_ranges
+from packs.core.io import block_reader
+from packs.core.io import build_run_set
+from packs.core.io import run_set_ranges
+from packs.core.io import load_metadata
+from packs.core.io import check_rows
+from packs.core.io import Session
+from packs.core.io import swmr_reader
+from packs.core.io import migrate_legacy
+from packs.core.io import legacy_view
+from packs.core.io import sorted_timestamps
+from packs.core    import io
+
+from packs.proc.coincidence_utils import find_coincidences
+
+from packs.types   import types
 
 def test_missing_config(tmp_path, MULE_dir):
     '''
@@ -216,6 +237,22 @@ def test_writer_fixed_size_provided_incorrectly(tmp_path):
                 scribe('rwf', data, (True, len(test_data)-1, i))
 
 
+def test_writer_fixed_size_trims_unwritten_rows(tmp_path):
+    '''
+    if fewer rows are written than the fixed size provided, the
+    dataset should be trimmed to the rows written rather than zero-filled
+    '''
+    file       = f'{tmp_path}/fixed_size_tester_3.h5'
+    test_dtype = np.dtype([('int', int), ('float', float)])
+
+    with writer(file, 'RAW', overwrite = True) as scribe:
+        for i in range(3):
+            scribe('rwf', np.array((i + 1, 1.0), dtype = test_dtype), (True, 10, i))
+
+    assert check_rows(file, 'RAW', 'rwf') == 3
+    assert [row['int'] for row in reader(file, 'RAW', 'rwf')] == [1, 2, 3]
+
+
 @mark.parametrize('over_input', (True, False))
 def test_writer_check_group_exists_no_overwrite(tmp_path, over_input):
     '''
@@ -273,3 +310,427 @@ def test_load_evt_info_and_rwf_for_chunked_and_unchunked_data(MULE_dir):
     assert samples_chuk and samples_unchuk is not None
     assert samples_chuk and samples_unchuk is not np.nan
 
+
+
+def make_indexed_file(path, timestamps, channels = 1, samples = 4):
+    '''
+    Writes a small schema 2 file with the provided timestamps
+    '''
+    metadata = {'schema_version' : types.SCHEMA_VERSION, 'samples' : samples,
+                'sampling_period' : 8, 'channels' : channels}
+    with writer(path, 'RAW', overwrite = True, metadata = metadata) as scribe:
+        for i, ts in enumerate(timestamps):
+            scribe('event_info', np.array((i, ts), dtype = types.event_row_type), (True, len(timestamps), i))
+            for j in range(channels):
+                rwf = np.array((i, j, np.full(samples, i)), dtype = types.rwf_type(samples))
+                scribe('rwf', rwf, (True, len(timestamps) * channels, i * channels + j))
+
+
+@mark.parametrize('key', types.metadata_keys[1:])
+def test_load_metadata_requires_run_constants(tmp_path, key):
+    '''
+    A schema 2 file missing any of the run constants should fail
+    clearly rather than later on a missing key.
+    '''
+    file = str(tmp_path / 'missing.h5')
+    make_indexed_file(file, [0, 10])
+    with h5py.File(file, 'a') as h5f:
+        del h5f['RAW'].attrs[key]
+
+    with raises(ValueError, match = key):
+        load_metadata(file)
+
+
+@mark.parametrize('indexed', (True, False))
+@mark.parametrize('key, low, high', [('timestamp', 25, 75),
+                                     ('timestamp', 0, 1000),
+                                     ('timestamp', 200, 300),
+                                     ('event_number', 3, 6)])
+def test_query_rows_matches_brute_force(tmp_path, indexed, key, low, high):
+    '''
+    range queries on the sorted index should return the same rows
+    as filtering the full table, including unsorted timestamps.
+    '''
+    file       = str(tmp_path / 'indexed.h5')
+    timestamps = [10, 20, 30, 90, 40, 50, 60, 70, 80, 100]
+    make_indexed_file(file, timestamps)
+    if indexed:
+        write_index(file)
+
+    evt_info = load_evt_info(file)
+    expected = np.flatnonzero((evt_info[key] >= low) & (evt_info[key] < high))
+
+    ranges = query_rows(file, key, low, high)
+    rows   = [row for start, stop in ranges for row in range(start, stop)]
+
+    assert rows == expected.tolist()
+
+
+@mark.parametrize('rows, ranges', [([4, 0, 1, 2, 7], [(0, 3), (4, 5), (7, 8)]),
+                                   ([],              []),
+                                   ([5],             [(5, 6)]),
+                                   ([1, 1, 2],       [(1, 3)])])
+def test_rows_to_ranges(rows, ranges):
+    assert rows_to_ranges(np.array(rows, dtype = int)) == ranges
+
+
+def test_block_reader_reads_queried_waveforms(tmp_path):
+    '''
+    The waveforms of queried events should be read in blocks,
+    with one waveform row per channel.
+    '''
+    file = str(tmp_path / 'indexed.h5')
+    make_indexed_file(file, np.arange(0, 100, 10), channels = 3)
+    write_index(file)
+
+    ranges = event_to_rwf_ranges(query_rows(file, 'timestamp', 20, 60), 3)
+    blocks = [block for _, block in block_reader(file, 'RAW', 'rwf', 5, ranges)]
+    rwf    = np.concatenate(blocks)
+
+    assert [len(block) for block in blocks] == [5, 5, 2]
+    assert np.array_equal(np.unique(rwf['event_number']), [2, 3, 4, 5])
+    assert np.array_equal(rwf['channels'], np.tile([0, 1, 2], 4))
+
+
+def test_run_set_concatenates_without_copying(tmp_path):
+    '''
+    A run set over several files should read as their concatenation,
+    with global row numbers and file-aware block ranges.
+    '''
+    files = [str(tmp_path / f'member_{i}.h5') for i in range(3)]
+    make_indexed_file(files[0], [0, 10, 20],      channels = 2)
+    make_indexed_file(files[1], [30, 40],         channels = 2)
+    make_indexed_file(files[2], [50, 60, 70, 80], channels = 2)
+    run_set = str(tmp_path / 'run_set.h5')
+
+    build_run_set(files, run_set)
+
+    expected_evt = pd.concat([load_evt_info(file) for file in files], ignore_index = True)
+    expected_rwf = pd.concat([load_rwf_info(file, 4) for file in files], ignore_index = True)
+    assert load_evt_info(run_set).equals(expected_evt)
+    assert load_rwf_info(run_set, 4).equals(expected_rwf)
+
+    # blocks never cross a file boundary
+    ranges = run_set_ranges(run_set, 'rwf')
+    assert ranges == [(0, 6), (6, 10), (10, 18)]
+    blocks = [(start, len(block)) for start, block in block_reader(run_set, 'RAW', 'rwf', 4, ranges)]
+    assert blocks == [(0, 4), (4, 2), (6, 4), (10, 4), (14, 4)]
+
+    # global indices over the whole run
+    assert query_rows(run_set, 'timestamp', 15, 55) == [(2, 6)]
+
+    # no waveform data copied
+    with h5py.File(run_set, 'r') as f:
+        assert f['RAW/rwf'].is_virtual
+        assert f['RAW/event_info'].is_virtual
+
+
+def test_run_set_widens_compact_timestamps_per_file(tmp_path):
+    '''
+    compact files restart their timestamp deltas at each file,
+    the run set should rebuild each from its own origin.
+    '''
+    files = []
+    for i, timestamps in enumerate([[100, 110, 130], [1000, 1005]]):
+        file     = str(tmp_path / f'compact_{i}.h5')
+        metadata = {'schema_version' : types.SCHEMA_VERSION, 'samples' : 4, 'sampling_period' : 8,
+                    'channels' : 1, 'compact' : True, 'timestamp_origin' : timestamps[0]}
+        deltas   = np.diff(timestamps, prepend = timestamps[0])
+        with writer(file, 'RAW', overwrite = True, metadata = metadata) as scribe:
+            for j, delta in enumerate(deltas):
+                scribe('event_info', np.array((j, delta), dtype = types.event_row_compact_type))
+                scribe('rwf', np.array((j, 0, np.zeros(4)), dtype = types.rwf_type_compact(4, np.float32)))
+        files.append(file)
+
+    run_set = str(tmp_path / 'run_set.h5')
+    build_run_set(files, run_set)
+
+    assert load_evt_info(run_set)['timestamp'].tolist() == [100, 110, 130, 1000, 1005]
+
+
+@mark.parametrize('indexed', (True, False))
+def test_sorted_timestamps_streams_in_time_order(tmp_path, indexed):
+    file       = str(tmp_path / 'unsorted.h5')
+    timestamps = [30, 10, 20, 10, 50]
+    make_indexed_file(file, timestamps)
+    if indexed:
+        write_index(file)
+
+    assert list(sorted_timestamps(file, block_size = 2)) == [(10, 1), (10, 3), (20, 2), (30, 0), (50, 4)]
+
+
+@mark.parametrize('block_size', (1, 100))
+def test_find_coincidences_matches_brute_force(tmp_path, block_size):
+    '''
+    streaming the files through a k-way merge should find the same coincidences
+    as grouping the concatenated, sorted timestamps of every file
+    '''
+    rng    = np.random.default_rng(9)
+    files  = [str(tmp_path / f'board_{i}.h5') for i in range(3)]
+    stamps = [np.sort(rng.integers(0, 2000, size = 40)) for _ in files]
+    for file, timestamps in zip(files, stamps):
+        make_indexed_file(file, rng.permutation(timestamps))
+    write_index(files[0])
+    save_path = str(tmp_path / 'coincidences.h5')
+
+    number = find_coincidences(files, save_path, window = 15, min_files = 2, block_size = block_size)
+
+    # brute force, opening a window at the earliest event not yet grouped
+    events   = sorted((ts, i, row) for i, file in enumerate(files)
+                      for row, ts in enumerate(load_evt_info(file)['timestamp']))
+    expected = []
+    group    = [events[0]]
+    for event in events[1:] + [(np.inf, -1, -1)]:
+        if event[0] - group[0][0] > 15:
+            if len({i for _, i, _ in group}) >= 2:
+                expected.append(group)
+            group = []
+        group.append(event)
+
+    with h5py.File(save_path, 'r') as f:
+        coin  = f['COIN/coincidences'][:]
+        attrs = dict(f['COIN'].attrs)
+
+    assert number == len(expected) > 0
+    assert list(attrs['files']) == files
+    assert coin.tolist() == [(n, i, row, ts) for n, group in enumerate(expected) for ts, i, row in group]
+
+
+def test_find_coincidences_writes_empty_table(tmp_path):
+    files = [str(tmp_path / 'a.h5'), str(tmp_path / 'b.h5')]
+    make_indexed_file(files[0], [0, 100])
+    make_indexed_file(files[1], [50, 150])
+
+    assert find_coincidences(files, files[0], window = 10) == 0
+    with h5py.File(files[0], 'r') as f:
+        assert len(f['COIN/coincidences']) == 0
+        assert 'RAW' in f
+
+
+def test_find_coincidences_records_absolute_paths(tmp_path, monkeypatch):
+    '''
+    relative paths are stored absolute, so the files can be found from elsewhere
+    '''
+    monkeypatch.chdir(tmp_path)
+    make_indexed_file('a.h5', [0, 100])
+    make_indexed_file('b.h5', [5, 105])
+
+    assert find_coincidences(['a.h5', 'b.h5'], 'coin.h5', window = 10) == 2
+    with h5py.File(tmp_path / 'coin.h5', 'r') as f:
+        assert list(f['COIN'].attrs['files']) == [str(tmp_path / 'a.h5'), str(tmp_path / 'b.h5')]
+
+
+def test_find_coincidences_refuses_to_append_other_files(tmp_path):
+    '''
+    without overwrite, coincidences are only appended to a table found from the same files
+    '''
+    files     = [str(tmp_path / f'{name}.h5') for name in 'abc']
+    save_path = str(tmp_path / 'coin.h5')
+    for file in files:
+        make_indexed_file(file, [0, 100])
+
+    find_coincidences(files[:2], save_path, window = 10)
+    find_coincidences(files[:2], save_path, window = 10, overwrite = False)
+    with h5py.File(save_path, 'r') as f:
+        assert len(f['COIN/coincidences']) == 8
+
+    with raises(ValueError):
+        find_coincidences(files[1:], save_path, window = 10, overwrite = False)
+    with raises(ValueError):
+        find_coincidences(files[:2], save_path, window = 20, overwrite = False)
+    with h5py.File(save_path, 'r') as f:
+        assert len(f['COIN/coincidences']) == 8
+        assert list(f['COIN'].attrs['files']) == files[:2]
+
+
+def test_run_set_rejects_mismatched_files(tmp_path):
+    files = [str(tmp_path / 'a.h5'), str(tmp_path / 'b.h5')]
+    make_indexed_file(files[0], [0, 10], samples = 4)
+    make_indexed_file(files[1], [0, 10], samples = 5)
+
+    with raises(ValueError):
+        build_run_set(files, str(tmp_path / 'run_set.h5'))
+
+
+def test_session_shares_handles(tmp_path):
+    '''
+    Within a session each file should be opened once, shared between
+    the reader, writer and loaders, and only closed with the session.
+    '''
+    file = str(tmp_path / 'session.h5')
+    make_indexed_file(file, [0, 10, 20])
+
+    with Session(rdcc_nbytes = 1024**2, rdcc_nslots = 521) as session:
+        h5f = session.open(file)
+        assert h5f.mode == 'r'
+
+        rows = [row for row in reader(file, 'RAW', 'rwf', session = session)]
+        assert load_metadata(file, session)['samples'] == 4
+        assert session.open(file) is h5f
+
+        # writing upgrades the read-only handle
+        with writer(file, 'OUT', session = session) as scribe:
+            for row in rows:
+                scribe('rwf', row)
+        h5f = session.open(file)
+        assert h5f.mode == 'r+'
+        assert h5f.id.valid
+        assert h5f.id.get_access_plist().get_cache()[2] == 1024**2
+
+        assert check_rows(file, 'OUT', 'rwf', session) == 3
+        assert load_evt_info(file, session = session).shape[0] == 3
+
+    assert not h5f.id.valid
+
+
+def test_session_reuses_legacy_views(MULE_dir, monkeypatch):
+    '''
+    within a session the virtual /RAW of a chunked file should be
+    built once for every loader, and removed when the session closes
+    '''
+    chunked_data = MULE_dir + '/packs/tests/data/one_channel_WD1.h5'
+    built        = []
+    def counting_view(file_path):
+        built.append(file_path)
+        return legacy_view(file_path)
+    monkeypatch.setattr(io, 'legacy_view', counting_view)
+
+    with Session() as session:
+        evt_info = load_evt_info(chunked_data, session = session)
+        rwf_info = load_rwf_info(chunked_data, int(evt_info['samples'][0]), session = session)
+        view     = session.view(chunked_data).filename
+        assert len(built) == 1
+        assert os.path.exists(view)
+
+    assert not os.path.exists(view)
+    assert evt_info.equals(load_evt_info(chunked_data))
+    assert rwf_info.equals(load_rwf_info(chunked_data, int(evt_info['samples'][0])))
+
+
+def test_load_evt_info_merge_is_deprecated(MULE_dir):
+    '''
+    the merge flag no longer does anything, passing it should warn
+    '''
+    with warns(DeprecationWarning, match = 'merge'):
+        load_evt_info(MULE_dir + '/packs/tests/data/one_channel_WD1.h5', True)
+
+
+def test_session_declared_modes(tmp_path):
+    '''
+    files declared with a mode up front are opened with it on first use
+    '''
+    file = str(tmp_path / 'session.h5')
+    make_indexed_file(file, [0, 10, 20])
+
+    with Session(modes = {file : 'a'}) as session:
+        h5f = session.open(file, 'r')
+        for _ in reader(file, 'RAW', 'rwf', session = session):
+            with writer(file, 'OUT', session = session) as scribe:
+                assert session.open(file) is h5f
+            break
+
+
+def test_swmr_reader_follows_live_writer(tmp_path, MULE_dir):
+    '''
+    A SWMR reader should follow a file while another process writes to it,
+    reading out every row exactly once.
+    '''
+    file   = str(tmp_path / 'swmr.h5')
+    script = f"""
+import sys, time
+import numpy as np
+sys.path.append({MULE_dir!r})
+from packs.core.io import writer
+with writer({file!r}, 'RAW', swmr = True, flush_every = 5) as scribe:
+    for i in range(40):
+        scribe('rwf', np.array((i, 2.0 * i), dtype = [('event_number', np.uint32), ('value', float)]), (True, 40, i))
+        time.sleep(0.01)
+"""
+    process = subprocess.Popen([sys.executable, '-c', script])
+    try:
+        rows = [row for row in swmr_reader(file, 'RAW', 'rwf', timeout = 5, poll_interval = 0.05)]
+    finally:
+        process.wait()
+
+    assert process.returncode == 0
+    assert [row['event_number'] for row in rows] == list(range(40))
+    assert [row['value'] for row in rows] == [2.0 * i for i in range(40)]
+
+
+def test_swmr_writer_respects_fixed_size(tmp_path):
+    '''
+    SWMR writing grows datasets rather than preallocating them,
+    but should still refuse rows beyond the provided size.
+    '''
+    file  = str(tmp_path / 'swmr.h5')
+    dtype = np.dtype([('int', int), ('float', float)])
+
+    with raises(IndexError):
+        with writer(file, 'RAW', swmr = True) as scribe:
+            for i in range(4):
+                scribe('rwf', np.array((i, 1.0), dtype = dtype), (True, 3, i))
+
+    assert check_rows(file, 'RAW', 'rwf') == 3
+
+
+def make_chunked_file(path, source, block_size = 9):
+    '''
+    Splits a single block legacy file into many blocks, numbered so that
+    alphabetical and event order differ (ei_18 sorts before ei_9)
+    '''
+    with h5py.File(source, 'r') as h5f:
+        evt_info = h5f['event_information/ei_-1'][:]
+        rwf      = h5f['rwf/rwf_-1'][:]
+    channels = len(rwf) // len(evt_info)
+    with h5py.File(path, 'w') as h5f:
+        for start in range(0, len(evt_info), block_size):
+            h5f[f'event_information/ei_{start}'] = evt_info[start:start + block_size]
+            h5f[f'rwf/rwf_{start}']              = rwf[start * channels:(start + block_size) * channels]
+    return evt_info, rwf
+
+
+def test_legacy_view_reads_chunked_blocks_in_order(tmp_path, data_dir):
+    '''
+    Chunked files should read as one table with their blocks in event order,
+    without modifying the file.
+    '''
+    file          = str(tmp_path / 'chunked.h5')
+    evt_info, rwf = make_chunked_file(file, data_dir + 'three_channels_WD2.h5')
+
+    with legacy_view(file) as view:
+        assert np.array_equal(view['RAW/event_info'][:], evt_info)
+        assert np.array_equal(view['RAW/rwf'][:], rwf)
+
+    with h5py.File(file, 'r') as h5f:
+        assert 'RAW' not in h5f
+
+    assert np.array_equal(load_evt_info(file)['event_number'], evt_info['event_number'])
+    assert np.array_equal(np.stack(load_rwf_info(file, 1000)['rwf']), rwf['rwf'])
+    assert load_metadata(file)['channels'] == 3
+    assert check_rows(file, 'RAW', 'rwf') == len(rwf)
+    assert [row['event_number'] for row in reader(file, 'RAW', 'event_info')] == list(evt_info['event_number'])
+
+    blocks = np.concatenate([block for _, block in block_reader(file, 'RAW', 'rwf', 50)])
+    assert np.array_equal(blocks, rwf)
+
+
+@mark.parametrize('in_place', (True, False))
+def test_migrate_legacy_matches_chunked_data(tmp_path, data_dir, in_place):
+    '''
+    Migrating should expose the same rows as a /RAW group, either in the
+    legacy file itself or in a separate file.
+    '''
+    file          = str(tmp_path / 'chunked.h5')
+    save_path     = None if in_place else str(tmp_path / 'migrated.h5')
+    evt_info, rwf = make_chunked_file(file, data_dir + 'three_channels_WD2.h5')
+
+    migrate_legacy(file, save_path)
+
+    with h5py.File(save_path or file, 'r') as h5f:
+        assert h5f['RAW/rwf'].is_virtual
+        assert np.array_equal(h5f['RAW/event_info'][:], evt_info)
+        assert np.array_equal(h5f['RAW/rwf'][:], rwf)
+
+    with raises(ValueError):
+        migrate_legacy(file, save_path)
+    migrate_legacy(file, save_path, overwrite = True)
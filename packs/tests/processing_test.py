@@ -8,6 +8,9 @@ import pandas as pd
 import subprocess
 
 import configparser
+import h5py
+
+from contextlib import nullcontext
 
 from pytest                        import mark
 from pytest                        import raises
@@ -25,6 +28,9 @@ from packs.proc.processing_utils   import format_wfs
 from packs.proc.processing_utils   import check_save_path
 from packs.proc.processing_utils   import save_data
 from packs.proc.processing_utils   import number_of_events_WD2
+from packs.proc.processing_utils   import number_of_events_WD1
+from packs.proc.processing_utils   import process_csv_lecroy
+from packs.proc.processing_utils   import format_event_row
 
 from packs.types.types             import generate_wfdtype
 from packs.types.types             import rwf_type
@@ -35,6 +41,7 @@ from packs.core.core_utils         import MalformedHeaderError
 from packs.core.io                 import load_rwf_info
 from packs.core.io                 import load_evt_info
 from packs.core.io                 import reader
+from packs.core.io                 import load_metadata
 
 from packs.types                   import types
 from hypothesis                    import given
@@ -248,9 +255,10 @@ def test_WD1_Lecroy_decode_produces_expected_output(config, inpt, output, compar
     run_pack = [sys.executable, MULE_dir + "/bin/mule", "proc", temp_config]
     subprocess.run(run_pack)
 
-    # load event info from both files for comparison
-    saved_event_info      = pd.read_hdf(save_path, 'RAW/event_info')
-    comparison_event_info = pd.read_hdf(comparison_path, 'RAW/event_info')
+    # load event info from both files for comparison, the run constants
+    # are stored as attributes in newer files so use the loader to widen them
+    saved_event_info      = load_evt_info(save_path)
+    comparison_event_info = load_evt_info(comparison_path)
 
     # compare integer columns exactly
     exact_cols = ['event_number', 'timestamp', 'samples', 'channels']
@@ -335,3 +343,183 @@ def test_lazy_eager_WD2_match(data_dir, inpt):
 
     for i in range(0,counts):
         assert data[i] == lazy_data[i]
+
+
+@mark.parametrize("config, inpt, decoder, byte_order", [("process_WD1_1channel.conf", "one_channel_WD1.dat", "WD1", 'little'),
+                                                        ("process_WD2_3channel.conf", "three_channels_WD2.bin", "WD2", sys.byteorder),
+                                                        ("process_lecroy_csv.conf", "one_channel_LECROYWS4054HD.csv", "LECROYWS4054HD", None)])
+def test_decoders_write_run_metadata(config, inpt, decoder, byte_order, MULE_dir, data_dir, tmp_path):
+    '''
+    The run constants should be written once as attributes on the RAW group,
+    matching those repeated per row in the older reference files.
+    '''
+    file_path       = data_dir + inpt
+    save_path       = tmp_path / 'metadata_tmp.h5'
+    comparison_path = data_dir + inpt.rsplit('.', 1)[0] + '.h5'
+    config_path     = data_dir + "configs/" + config
+    temp_config     = str(tmp_path / config)
+
+    cnfg = configparser.ConfigParser()
+    cnfg.read(config_path)
+    cnfg.set('required', 'file_path', f"'{file_path}'")
+    cnfg.set('required', 'save_path', f"'{save_path}'")
+    with open(temp_config, 'w') as cfgfile:
+        cnfg.write(cfgfile)
+
+    subprocess.run([sys.executable, MULE_dir + "/bin/mule", "proc", temp_config])
+
+    metadata  = load_metadata(save_path)
+    reference = load_metadata(comparison_path)
+
+    assert metadata['schema_version'] == types.SCHEMA_VERSION
+    assert reference['schema_version'] == 1
+    assert metadata['decoder']        == decoder
+    assert metadata['source_file']    == os.path.abspath(file_path)
+    # the byte order the source was read with, text sources have none
+    assert metadata.get('byte_order') == byte_order
+    for key in ['samples', 'channels']:
+        assert metadata[key] == reference[key]
+    assert np.isclose(metadata['sampling_period'], reference['sampling_period'])
+    # run constants are no longer stored per row
+    with h5py.File(save_path, 'r') as f:
+        assert f['RAW/event_info'].dtype == types.event_row_type
+
+
+@mark.parametrize("function, inpt, args", [(process_bin_WD1, "one_channel_WD1.dat", (2,)),
+                                           (process_bin_WD2_lazy, "three_channels_WD2.bin", ()),
+                                           (process_csv_lecroy, "one_channel_LECROYWS4054HD.csv", ())])
+def test_compact_decode_widens_to_default(function, inpt, args, data_dir, tmp_path):
+    '''
+    Files written with the compact schema should load identically
+    to the default schema once widened by the loaders, while being smaller.
+    '''
+    file_path    = data_dir + inpt
+    default_path = str(tmp_path / 'default.h5')
+    compact_path = str(tmp_path / 'compact.h5')
+
+    function(file_path, default_path, *args, overwrite = True)
+    function(file_path, compact_path, *args, overwrite = True, compact = True)
+
+    samples = load_metadata(default_path)['samples']
+
+    assert load_evt_info(compact_path).equals(load_evt_info(default_path))
+    assert load_rwf_info(compact_path, samples).equals(load_rwf_info(default_path, samples))
+
+    with h5py.File(default_path, 'r') as d, h5py.File(compact_path, 'r') as c:
+        assert c['RAW/event_info'].dtype.itemsize < d['RAW/event_info'].dtype.itemsize
+        assert c['RAW/rwf'].dtype.itemsize        < d['RAW/rwf'].dtype.itemsize
+
+
+@mark.parametrize("gap", (2**32, 2**32 + 5, -1))
+def test_compact_event_row_rejects_unrepresentable_gaps(gap):
+    '''
+    Gaps between events that don't fit the 32 bit compact delta
+    (or go backwards) should raise rather than wrap silently.
+    '''
+    assert format_event_row(1, 1000 + 2**32 - 1, 1000, True)['timestamp_delta'] == 2**32 - 1
+
+    with raises(ValueError, match = 'compact'):
+        format_event_row(1, 1000 + gap, 1000, True)
+
+    # the default schema keeps the full timestamp
+    assert format_event_row(1, 1000 + 2**32 + 5, 1000, False)['timestamp'] == 1000 + 2**32 + 5
+
+
+def make_WD1_file(path, samples, timestamps):
+    '''
+    Writes a synthetic WD1 binary file, with the samples and trigger time tag of each event
+    '''
+    with open(path, 'wb') as f:
+        for i, (n_samples, timestamp) in enumerate(zip(samples, timestamps)):
+            f.write(np.array([24 + 2 * n_samples, 0, 0, 0, i, timestamp], dtype = '<i').tobytes())
+            f.write(np.full(n_samples, i, dtype = '<H').tobytes())
+
+
+def test_compact_WD1_keeps_trigger_tag_rollovers(tmp_path):
+    '''
+    The WD1 trigger time tag wraps at 2^31, compact decoding should
+    carry on through the rollovers and load the same timestamps
+    as the default schema.
+    '''
+    timestamps = [2**31 - 300, 2**31 - 10, 40, 2**31 - 5, 100]
+    file_path  = str(tmp_path / 'wrapped.dat')
+    make_WD1_file(file_path, [8] * len(timestamps), timestamps)
+
+    default_path = str(tmp_path / 'default.h5')
+    compact_path = str(tmp_path / 'compact.h5')
+    process_bin_WD1(file_path, default_path, 8, overwrite = True)
+    process_bin_WD1(file_path, compact_path, 8, overwrite = True, compact = True)
+
+    assert list(load_evt_info(compact_path)['timestamp']) == timestamps
+    assert load_evt_info(compact_path).equals(load_evt_info(default_path))
+
+
+def test_swmr_decode_matches_default(data_dir, tmp_path):
+    '''
+    Decoding in SWMR mode should produce the same output as the default mode
+    '''
+    file_path    = data_dir + 'three_channels_WD2.bin'
+    default_path = str(tmp_path / 'default.h5')
+    swmr_path    = str(tmp_path / 'swmr.h5')
+
+    process_bin_WD2_lazy(file_path, default_path, overwrite = True)
+    process_bin_WD2_lazy(file_path, swmr_path, overwrite = True, swmr = True)
+
+    assert load_evt_info(swmr_path).equals(load_evt_info(default_path))
+    assert load_rwf_info(swmr_path, 1000).equals(load_rwf_info(default_path, 1000))
+    with h5py.File(swmr_path, 'r') as f:
+        assert 'timestamp_index' in f['RAW']
+
+
+@mark.parametrize("function, inpt, args, cut", [(process_bin_WD1, "one_channel_WD1.dat", (2,), 100),
+                                                (process_bin_WD2_lazy, "three_channels_WD2.bin", (), 100),
+                                                (process_csv_lecroy, "one_channel_LECROYWS4054HD.csv", (), 500)])
+def test_truncated_decode_has_no_empty_rows(function, inpt, args, cut, data_dir, tmp_path):
+    '''
+    Decoding a source cut short mid-event should write only the complete events,
+    rather than leaving zero-filled rows at the end of the output.
+    '''
+    full_path      = str(tmp_path / f'full_{inpt}')
+    truncated_path = str(tmp_path / f'truncated_{inpt}')
+    with open(data_dir + inpt, 'rb') as source:
+        data = source.read()
+    with open(truncated_path, 'wb') as f:
+        f.write(data[:-cut])
+
+    function(data_dir + inpt, str(tmp_path / 'full.h5'), *args, overwrite = True)
+    with warns(UserWarning) if function is not process_bin_WD2_lazy else nullcontext():
+        function(truncated_path, str(tmp_path / 'truncated.h5'), *args, overwrite = True)
+
+    full      = load_evt_info(str(tmp_path / 'full.h5'))
+    truncated = load_evt_info(str(tmp_path / 'truncated.h5'))
+    channels  = load_metadata(str(tmp_path / 'full.h5'))['channels']
+
+    assert len(truncated) == len(full) - 1
+    assert truncated.equals(full.iloc[:-1])
+    with h5py.File(str(tmp_path / 'truncated.h5'), 'r') as f:
+        assert f['RAW/rwf'].shape[0] == len(truncated) * channels
+
+
+@mark.parametrize("samples", ([8, 8, 8, 8], [8, 8, 12, 8], [8, 12, 12, 12, 12]))
+def test_number_of_events_WD1_fixed_and_variable_sizes(samples, tmp_path):
+    '''
+    Fixed size events are counted from the file size, files whose event
+    sizes vary should fall back to walking the headers, both leaving the
+    file where it was.
+    '''
+    file_path = str(tmp_path / 'events.dat')
+    make_WD1_file(file_path, samples, range(len(samples)))
+
+    with open(file_path, 'rb') as file:
+        assert number_of_events_WD1(file) == len(samples)
+        assert file.tell() == 0
+
+
+def test_number_of_events_WD1_walks_headers(data_dir):
+    '''
+    The header walk should count every event, and leave the file where it was.
+    '''
+    with open(data_dir + 'one_channel_WD1.dat', 'rb') as file:
+        num_of_events = number_of_events_WD1(file)
+        assert file.tell() == 0
+        assert num_of_events == sum(1 for _ in process_event_lazy_WD1(file))
@@ -0,0 +1,162 @@
+import numpy as np
+import h5py
+
+from pytest import mark, raises
+
+from hypothesis.extra.numpy import arrays
+from hypothesis import given, strategies as st
+
+from packs.proc.pulse_utils       import find_pulses_block, find_pulses
+from packs.proc.pulse_utils       import timing_block, extract_timing
+from packs.proc.calibration_utils import calibration_plan, subtract_block_baseline
+from packs.core.io                import load_metadata
+
+
+def find_pulses_loop(wf, threshold, min_width):
+    '''
+    Reference pulse finder, walking each waveform sample by sample
+    '''
+    pulses = []
+    start  = None
+    for i, value in enumerate(list(wf) + [-np.inf]):
+        if value > threshold and start is None:
+            start = i
+        elif value <= threshold and start is not None:
+            if i - start >= min_width:
+                peak = start + int(np.argmax(wf[start:i]))
+                pulses.append((start, peak, i - start, wf[peak], np.sum(wf[start:i], dtype = np.float64)))
+            start = None
+    return pulses
+
+
+@given(arrays(np.float32, (6, 40), elements = st.floats(-10, 10, width = 32)),
+       st.floats(-5, 5, width = 32), st.integers(1, 3))
+def test_find_pulses_block_matches_loop(wfs, threshold, min_width):
+    '''
+    the vectorised pulse finder should find the same pulses as walking
+    each waveform, including pulses at the edges of the waveform
+    '''
+    rows, starts, peaks, widths, amplitudes, charges = find_pulses_block(wfs, threshold, min_width)
+
+    expected = [(row,) + pulse for row, wf in enumerate(wfs) for pulse in find_pulses_loop(wf, threshold, min_width)]
+    output   = list(zip(rows, starts, peaks, widths, amplitudes, charges))
+
+    assert len(output) == len(expected)
+    for out, exp in zip(output, expected):
+        assert out[:5] == exp[:5]
+        assert np.isclose(out[5], exp[5])
+
+
+def test_find_pulses_offsets_index_pulse_table(tmp_path, data_dir):
+    '''
+    every waveform's offset should point at its own pulses,
+    matching a search over the whole file at once
+    '''
+    file        = data_dir + 'three_channels_WD2.h5'
+    save_path   = str(tmp_path / 'pulses.h5')
+    cali_params = {'baseline_sub' : 'median',
+                   'sidebands'    : ((100, 300), (2900, 3100)),
+                   'negative'     : True}
+
+    find_pulses(file, cali_params, 2, save_path, min_width = 2, block_size = 20)
+
+    with h5py.File(save_path, 'r') as f, h5py.File(file, 'r') as raw:
+        pulses  = f['PULSES/pulses'][:]
+        offsets = f['PULSES/offsets'][:]
+        rwf     = raw['rwf/rwf_-1'][:]
+
+    samples = load_metadata(file)['samples']
+    plan    = calibration_plan(np.linspace(0, samples * 8, num = samples), cali_params)
+    rows, starts, *_ = find_pulses_block(subtract_block_baseline(rwf['rwf'], cali_params, plan), 2, 2)
+
+    assert len(pulses) == len(rows) > 0
+    assert np.array_equal(offsets['count'], np.bincount(rows, minlength = len(rwf)))
+    assert np.array_equal(pulses['start'], starts)
+    for offset in offsets:
+        chunk = pulses[offset['first'] : offset['first'] + offset['count']]
+        assert np.all(chunk['event_number'] == offset['event_number'])
+        assert np.all(chunk['channels'] == offset['channels'])
+
+
+def test_timing_block_interpolates_linear_edge():
+    '''
+    a linear rising edge crosses each level at an exact time
+    '''
+    time = np.arange(20) * 4.
+    wf   = np.zeros(20)
+    wf[5:10] = np.arange(1, 6) * 20   # 20 per sample, peaking at 100 on sample 9
+    wf[10:]  = 50
+
+    cfd, le = timing_block(wf[np.newaxis], time, fraction = 0.5, threshold = 30)
+
+    # 50 is crossed 2.5 samples after sample 4, 30 is crossed 1.5 samples after it
+    assert np.allclose(cfd, 4 * 4 + 2.5 * 4)
+    assert np.allclose(le,  4 * 4 + 1.5 * 4)
+
+
+def test_timing_block_rejects_empty_block():
+    '''
+    waveforms without samples have no arrival time to find
+    '''
+    with raises(ValueError, match = 'timing_block'):
+        timing_block(np.zeros((3, 0)), np.zeros(0))
+
+
+def timing_loop(wf, time, fraction, threshold):
+    '''
+    Reference timing, walking back from the peak and forward from the start
+    '''
+    def crossing(i, level):
+        return time[i] + (level - wf[i]) / (wf[i+1] - wf[i]) * (time[i+1] - time[i])
+
+    cfd, le = np.nan, np.nan
+    peak  = int(np.argmax(wf))
+    level = fraction * wf[peak]
+    if wf[peak] > 0:
+        for i in range(peak - 1, -1, -1):
+            if wf[i] < level:
+                cfd = crossing(i, level)
+                break
+    for i in range(len(wf)):
+        if wf[i] >= threshold:
+            if i > 0:
+                le = crossing(i - 1, threshold)
+            break
+    return cfd, le
+
+
+@given(arrays(np.float64, (8, 30), elements = st.floats(-10, 10)),
+       st.floats(0.05, 0.95), st.floats(-5, 5))
+def test_timing_block_matches_loop(wfs, fraction, threshold):
+    time    = np.linspace(0, 240, num = 30)
+    cfd, le = timing_block(wfs, time, fraction, threshold)
+
+    expected = np.array([timing_loop(wf, time, fraction, threshold) for wf in wfs])
+    assert np.allclose(cfd, expected[:, 0], equal_nan = True)
+    assert np.allclose(le,  expected[:, 1], equal_nan = True)
+
+
+def test_extract_timing_is_row_for_row(tmp_path, data_dir):
+    '''
+    timing should be written for every waveform in order,
+    with every crossing timed within the waveform
+    '''
+    file        = data_dir + 'three_channels_WD2.h5'
+    save_path   = str(tmp_path / 'timing.h5')
+    cali_params = {'baseline_sub' : 'median',
+                   'sidebands'    : ((100, 300), (2900, 3100)),
+                   'negative'     : True}
+
+    extract_timing(file, cali_params, 0.3, 2, save_path, block_size = 50)
+
+    with h5py.File(save_path, 'r') as f, h5py.File(file, 'r') as raw:
+        timing = f['CALI/timing/wf_info'][:]
+        attrs  = dict(f['CALI/timing'].attrs)
+        rwf    = raw['rwf/rwf_-1'][:]
+
+    assert attrs['fraction'] == 0.3
+    assert np.array_equal(timing['event_number'], rwf['event_number'])
+    assert np.array_equal(timing['channels'],     rwf['channels'])
+    crossed = ~np.isnan(timing['le_time'])
+    assert crossed.any()
+    assert np.all((timing['cfd_time'][crossed] >= 0) & (timing['cfd_time'][crossed] <= 8 * 1000))
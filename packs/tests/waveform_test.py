@@ -2,6 +2,7 @@ import pytest
 from pytest import raises, mark
 
 import numpy as np
+import h5py
 
 from hypothesis.extra.numpy import arrays
 from hypothesis import given, strategies as st
@@ -9,6 +10,12 @@ from hypothesis import settings
 from hypothesis import Verbosity
 
 from packs.proc.calibration_utils import extract_peak, collect_sidebands, collect_integration_window, calibrate
+from packs.proc.calibration_utils import calibrate_block, integrate, calibration_plan
+from packs.proc.calibration_utils import histogram_block, fit_gain, apply_gain
+from packs.core.io             import load_cali_info
+from packs.core.io             import writer
+from packs.types               import types
+from packs.core.waveform_utils import subtract_baseline, collect_index, collect_indices, filter_block, shift_block
 from packs.core.io             import reader
 from packs.core.core_utils     import PeakRangeError
 
@@ -42,6 +49,20 @@ def test_empty_input_returns_none():
         extract_peak(y_peak_no_vals)
 
 
+def test_calibrate_block_rejects_empty_block():
+    '''
+    a block of waveforms without samples should raise a ValueError naming
+    calibrate_block, rather than fail while building the calibration plan
+    '''
+    cali_params = {'method'       : 'manual',
+                   'window'       : (0, 1),
+                   'baseline_sub' : None,
+                   'negative'     : False}
+
+    with raises(ValueError, match = 'calibrate_block'):
+        calibrate_block(np.zeros((3, 0)), np.zeros(0), cali_params)
+
+
 @mark.parametrize("sidebands, wf, times, output",
                   [((  1,  4), [1,2,3,4,5], [1,2,3,4,5], [1,2,3]),
                    ((  2,  5), [1,2,3,4,5], [1,2,3,4,5], [2,3,4]),
@@ -179,3 +200,382 @@ def test_calibrate_works_as_intended(tmp_path, data_dir):
         assert next(cross_check) == next(new_data)
 
 
+
+
+@mark.parametrize('method, window, baseline_sub', [('manual', (300, 500), 'median'),
+                                                   ('height', (40, 80),   'mean'),
+                                                   ('height', (40, 80),   None)])
+@mark.parametrize('dtype', (np.float32, np.uint16))
+def test_calibrate_block_matches_single_waveforms(method, window, baseline_sub, dtype):
+    '''
+    calibrating a block at once should give the exact values
+    of calibrating each waveform on its own
+    '''
+    rng         = np.random.default_rng(4)
+    time        = np.linspace(0, 800, num = 100)
+    wfs         = (rng.normal(1000, 50, size = (60, 100))).astype(dtype)
+    cali_params = {'method'       : method,
+                   'window'       : window,
+                   'baseline_sub' : baseline_sub,
+                   'sidebands'    : ((0, 120), (700, 790)),
+                   'negative'     : dtype is np.float32}
+
+    block_wfs, Q_vals, H_vals = calibrate_block(wfs, time, cali_params)
+
+    for wf, block_wf, Q, H in zip(wfs, block_wfs, Q_vals, H_vals):
+        if cali_params['negative']:
+            wf = -wf
+        if baseline_sub is not None:
+            wf = wf - subtract_baseline(collect_sidebands(wf, time, cali_params), sub_type = baseline_sub)
+        H_val, H_index         = extract_peak(wf)
+        start_index, end_index = collect_integration_window(time, cali_params, H_index)
+
+        assert block_wf.tobytes() == wf.tobytes()
+        assert H == H_val
+        assert Q == integrate(wf[start_index:end_index])
+
+
+@given(st.lists(st.floats(min_value = -50, max_value = 150, allow_nan = False), min_size = 1, max_size = 20))
+def test_collect_indices_matches_collect_index(values):
+    '''
+    the vectorised index collection should pick the same indices
+    as collecting each index on its own, including ties and out of range values
+    '''
+    time = np.array([0, 10, 10, 20, 30, 45, 60, 80, 100], dtype = float)
+    assert collect_indices(time, np.array(values)).tolist() == [collect_index(time, value) for value in values]
+
+
+@mark.parametrize('width', (1, 4, 25))
+def test_moving_average_filter_matches_convolution(width):
+    '''
+    the FFT moving average should match a direct trailing convolution of each waveform
+    '''
+    wfs      = np.random.default_rng(6).normal(0, 10, size = (5, 60))
+    filtered = filter_block(wfs, ({'type' : 'moving_average', 'width' : width},), 8)
+
+    for wf, filtered_wf in zip(wfs, filtered):
+        assert np.allclose(filtered_wf, np.convolve(wf, np.full(width, 1 / width))[:len(wf)])
+
+
+@mark.parametrize('order', (1, 2))
+def test_cr_rc_filter_matches_recursion(order):
+    '''
+    the CR-RC filter should match running the CR and RC stages sample by sample
+    '''
+    dt, tau  = 8, 40
+    wfs      = np.random.default_rng(7).normal(0, 10, size = (3, 50))
+    filtered = filter_block(wfs, ({'type' : 'cr_rc', 'tau' : tau, 'order' : order},), dt)
+
+    alpha = tau / (tau + dt)
+    for wf, filtered_wf in zip(wfs, filtered):
+        out = np.zeros_like(wf)
+        for i in range(len(wf)):
+            out[i] = alpha * ((out[i-1] if i else 0) + wf[i] - (wf[i-1] if i else 0))
+        for _ in range(order):
+            previous = out.copy()
+            for i in range(len(wf)):
+                out[i] = alpha * (out[i-1] if i else 0) + (1 - alpha) * previous[i]
+        assert np.allclose(filtered_wf, out)
+
+
+@mark.parametrize('method', ('fft', 'linear'))
+def test_shift_block_integer_shifts_move_samples(method):
+    '''
+    whole sample shifts should move every sample, filling with zeros rather than wrapping
+    '''
+    wfs      = np.random.default_rng(14).normal(0, 1, size = (3, 30))
+    shifted  = shift_block(wfs, [3, -2, 0], method)
+
+    expected = np.zeros_like(wfs)
+    expected[0, 3:]  = wfs[0, :-3]
+    expected[1, :-2] = wfs[1, 2:]
+    expected[2]      = wfs[2]
+    assert np.allclose(shifted, expected, atol = 1e-10)
+
+
+@mark.parametrize('method, atol', [('fft', 1e-6), ('linear', 1e-2)])
+def test_shift_block_fractional_shifts(method, atol):
+    '''
+    sub-sample shifts of a smooth pulse should match the pulse drawn at its new position
+    '''
+    samples  = np.arange(100)
+    pulse    = lambda centre: np.exp(-0.5 * ((samples - centre) / 6)**2)
+    shifts   = np.array([0.3, -4.75, 10.5])
+    shifted  = shift_block(np.tile(pulse(50), (3, 1)), shifts, method)
+
+    for wf, shift in zip(shifted, shifts):
+        assert np.allclose(wf, pulse(50 + shift), atol = atol)
+
+
+def test_filter_block_rejects_unknown_filter():
+    with raises(ValueError):
+        filter_block(np.zeros((2, 10)), ({'type' : 'band_stop'},), 8)
+
+
+def test_calibrate_block_filters_before_integration():
+    '''
+    filters in cali_params should act on the subtracted waveforms
+    that are then integrated and peak searched
+    '''
+    time        = np.linspace(0, 800, num = 100)
+    wfs         = np.random.default_rng(8).normal(1000, 50, size = (20, 100))
+    cali_params = {'method'       : 'manual',
+                   'window'       : (300, 500),
+                   'baseline_sub' : 'median',
+                   'sidebands'    : ((0, 120), (700, 790)),
+                   'negative'     : False}
+    filters     = ({'type' : 'moving_average', 'width' : 5}, {'type' : 'high_pass', 'tau' : 200})
+
+    plain_wfs, *_    = calibrate_block(wfs, time, cali_params)
+    block_wfs, Q, H  = calibrate_block(wfs, time, {**cali_params, 'filters' : filters})
+
+    expected = filter_block(plain_wfs, filters, time[1] - time[0])
+    start, end = collect_integration_window(time, cali_params, 0)
+    assert np.array_equal(block_wfs, expected)
+    assert np.array_equal(H, expected.max(axis = 1))
+    assert np.allclose(Q, expected[:, start:end].sum(axis = 1))
+
+
+@mark.parametrize('method, window', [('manual', (20, 60)),
+                                     ('height', (15, 25))])
+def test_calibration_plan_matches_per_waveform_search(method, window):
+    '''
+    the plan should hold the same sidebands and integration windows
+    as searching for them waveform by waveform
+    '''
+    time        = np.linspace(0, 99, num = 100)
+    cali_params = {'method'       : method,
+                   'window'       : window,
+                   'baseline_sub' : 'median',
+                   'sidebands'    : ((0, 10), (90, 95))}
+    plan        = calibration_plan(time, cali_params)
+    wf          = np.arange(100)
+
+    assert np.array_equal(collect_sidebands(wf, time, cali_params, plan), collect_sidebands(wf, time, cali_params))
+    assert np.array_equal(np.flatnonzero(plan.sideband_mask), np.sort(plan.sidebands))
+    assert np.array_equal(plan.time_steps, np.unique(np.diff(time)))
+    for H_index in range(len(time)):
+        try:
+            expected = collect_integration_window(time, cali_params, H_index)
+        except ValueError:
+            with raises(ValueError):
+                collect_integration_window(time, cali_params, H_index, plan)
+            continue
+        assert collect_integration_window(time, cali_params, H_index, plan) == expected
+
+
+def test_calibration_plan_rejects_misordered_manual_window():
+    '''
+    a fixed window is checked when the plan is built
+    '''
+    cali_params = {'method' : 'manual', 'window' : (4, 2), 'baseline_sub' : None}
+    with raises(ValueError):
+        calibration_plan(np.array([1, 2, 3, 4, 5]), cali_params)
+
+
+@mark.parametrize('workers, block_size', [(2, 50), (3, 7)])
+def test_calibrate_workers_match_single_process(tmp_path, data_dir, workers, block_size):
+    '''
+    calibrating across a pool of workers should write exactly
+    the same output as calibrating in a single process
+    '''
+    file        = data_dir + 'three_channels_WD2.h5'
+    cali_params = {'method'       : 'height',
+                   'window'       : (200, 400),
+                   'baseline_sub' : 'mean',
+                   'sidebands'    : ((100, 300), (2900, 3100)),
+                   'negative'     : True}
+
+    single   = str(tmp_path / 'single.h5')
+    parallel = str(tmp_path / 'parallel.h5')
+    calibrate(file, cali_params, single,   True, False)
+    calibrate(file, cali_params, parallel, True, False, block_size = block_size, workers = workers)
+
+    for dataset in ('wf_info', 'subwf-1'):
+        expected = np.concatenate([row[np.newaxis] for row in reader(single,   'CALI', dataset)])
+        output   = np.concatenate([row[np.newaxis] for row in reader(parallel, 'CALI', dataset)])
+        assert output.tobytes() == expected.tobytes()
+
+
+@mark.parametrize('subwf', [{'mode' : 'none'},
+                            {'mode' : 'prescale', 'factor' : 4},
+                            {'mode' : 'rebin',    'factor' : 8},
+                            {'mode' : 'window'}])
+@mark.parametrize('method, window', [('manual', (5000, 6000)), ('height', (200, 400))])
+def test_calibrate_subwf_modes_reduce_full_output(tmp_path, data_dir, subwf, method, window):
+    '''
+    each subtracted waveform output mode should hold a reduced form of the
+    full output, without changing wf_info
+    '''
+    file        = data_dir + 'three_channels_WD2.h5'
+    cali_params = {'method'       : method,
+                   'window'       : window,
+                   'baseline_sub' : 'median',
+                   'sidebands'    : ((100, 300), (2900, 3100)),
+                   'negative'     : True}
+
+    full_path    = str(tmp_path / 'full.h5')
+    reduced_path = str(tmp_path / 'reduced.h5')
+    calibrate(file, cali_params, full_path,    True, False)
+    calibrate(file, cali_params, reduced_path, True, False, block_size = 50, subwf = subwf)
+
+    with h5py.File(full_path, 'r') as f, h5py.File(reduced_path, 'r') as r:
+        assert np.array_equal(r['CALI/wf_info'][:], f['CALI/wf_info'][:])
+        assert r['CALI'].attrs['subwf_mode'] == subwf['mode']
+        full = f['CALI/subwf-1'][:]
+
+        match subwf['mode']:
+            case 'none':
+                assert 'subwf-1' not in r['CALI']
+            case 'prescale':
+                assert np.array_equal(r['CALI/subwf-1'][:], full[::4])
+            case 'rebin':
+                rebinned = r['CALI/subwf-1'][:]
+                assert rebinned['rwf'].shape == (len(full), 125)
+                assert np.allclose(rebinned['rwf'], full['rwf'].reshape(len(full), 125, 8).sum(axis = 2), rtol = 1e-5)
+            case 'window':
+                windowed = r['CALI/subwf-1'][:]
+                assert np.array_equal(windowed['event_number'], full['event_number'])
+                for row, full_row, info in zip(windowed, full, f['CALI/wf_info'][:]):
+                    start, end = row['start'], row['end']
+                    assert np.array_equal(row['rwf'][:end - start], full_row['rwf'][start:end])
+                    assert not np.any(row['rwf'][end - start:])
+                    assert np.isclose(row['rwf'].sum(dtype = np.float64), info['integrated_Q'], rtol = 1e-4, atol = 1e-2)
+
+
+@given(arrays(np.float64, 200, elements = st.floats(-20, 120)), st.integers(1, 3))
+def test_histogram_block_matches_numpy(values, n_chan):
+    '''
+    the single bincount histogram should match np.histogram for each channel,
+    with values outside of the binning held in the outer bins
+    '''
+    channels = np.arange(len(values)) % n_chan
+    edges    = np.linspace(0, 100, 11)
+    counts   = histogram_block((values,), (edges,), channels, n_chan)
+
+    for channel in range(n_chan):
+        expected, _ = np.histogram(values[channels == channel], bins = edges)
+        assert np.array_equal(counts[channel, 1:-1], expected)
+        assert counts[channel].sum() == np.sum(channels == channel)
+
+
+def test_calibrate_fills_histograms(tmp_path, data_dir):
+    '''
+    histograms written during calibration should match
+    histogramming wf_info afterwards
+    '''
+    file        = data_dir + 'three_channels_WD2.h5'
+    save_path   = str(tmp_path / 'hist.h5')
+    cali_params = {'method'       : 'manual',
+                   'window'       : (5000, 6000),
+                   'baseline_sub' : 'median',
+                   'sidebands'    : ((100, 300), (2900, 3100)),
+                   'negative'     : True}
+    hist        = {'Q' : (-2000, 20000, 50), 'height' : (0, 1000, 40), 'Q_height' : True}
+
+    calibrate(file, cali_params, save_path, True, False, block_size = 50, hist = hist)
+
+    with h5py.File(save_path, 'r') as f:
+        info   = f['CALI/wf_info'][:]
+        group  = f['CALI/hist']
+        for channel in range(3):
+            rows = info[info['channels'] == channel]
+            Q, _ = np.histogram(rows['integrated_Q'], bins = group.attrs['Q_edges'])
+            H, _ = np.histogram(rows['height'], bins = group.attrs['height_edges'])
+            QH, _, _ = np.histogram2d(rows['integrated_Q'], rows['height'],
+                                      bins = (group.attrs['Q_edges'], group.attrs['height_edges']))
+            assert np.array_equal(group['Q'][channel]['counts'], Q)
+            assert np.array_equal(group['height'][channel]['counts'], H)
+            assert np.array_equal(group['Q_height'][channel]['counts'], QH)
+            assert group['Q'][channel]['outside'] == len(rows) - Q.sum()
+
+
+def make_charge_histograms(path, gains, mus, entries = 100000):
+    '''
+    Writes simulated photoelectron charge spectra as calibration histograms
+    '''
+    rng   = np.random.default_rng(1)
+    edges = np.linspace(-50, 400, 226)
+    rows  = np.zeros(len(gains), dtype = types.hist_type(225))
+    for channel, (gain, mu) in enumerate(zip(gains, mus)):
+        n_pe = rng.poisson(mu, entries)
+        Q    = rng.normal(n_pe * gain, np.sqrt(5**2 + n_pe * (0.3 * gain)**2))
+        rows[channel]['channels'] = channel
+        rows[channel]['counts']   = np.histogram(Q, bins = edges)[0]
+    with writer(path, 'CALI/hist', metadata = {'Q_edges' : edges}) as scribe:
+        scribe('Q', rows)
+
+
+def test_fit_gain_recovers_simulated_constants(tmp_path):
+    '''
+    fitting simulated spectra should recover their gain and resolution,
+    writing the constants to the file and the .npy requested
+    '''
+    file      = str(tmp_path / 'hist.h5')
+    save_path = str(tmp_path / 'constants.npy')
+    gains     = (60, 80)
+    make_charge_histograms(file, gains, mus = (1.2, 0.6))
+
+    constants = fit_gain(file, save_path = save_path)
+
+    assert np.all(constants['valid'])
+    assert np.allclose(constants['gain'], gains, rtol = 0.02)
+    assert np.allclose(constants['resolution'], 0.3, atol = 0.02)
+    assert np.allclose(constants['pedestal'], 0, atol = 1)
+    assert np.array_equal(np.load(save_path), constants)
+    assert np.array_equal(next(reader(file, 'CALI/gain', 'constants')), constants[0])
+
+
+def test_fit_gain_needs_histograms(tmp_path, data_dir):
+    '''
+    fitting a file calibrated without histograms should fail clearly
+    '''
+    with raises(ValueError):
+        fit_gain(data_dir + 'three_channels_calib_WD2.h5')
+
+
+@mark.parametrize('fit_range', ((500, 600), (10, 11)))
+def test_fit_gain_rejects_empty_fit_range(tmp_path, fit_range):
+    '''
+    a fit range holding no complete bin (outside the histograms or
+    narrower than a bin) should name the range and histogram edges
+    '''
+    file = str(tmp_path / 'hist.h5')
+    make_charge_histograms(file, (60,), mus = (1,), entries = 1000)
+
+    with raises(ValueError, match = r'fit_range .* -50 to 400 in bins of 2'):
+        fit_gain(file, fit_range = fit_range)
+
+
+def test_apply_gain_matches_lazy_conversion(tmp_path, data_dir):
+    '''
+    photoelectrons written by apply_gain() should match those converted
+    on read, and conversion should use each row's channel
+    '''
+    file      = str(tmp_path / 'calib.h5')
+    constants = np.zeros(3, dtype = types.gain_constants_type)
+    constants['channels'] = [0, 1, 2]
+    constants['gain']     = [10., 20., 40.]
+    constants['pedestal'] = [1., 0., -1.]
+    constants['valid']    = True
+    with h5py.File(data_dir + 'three_channels_calib_WD2.h5', 'r') as source, h5py.File(file, 'w') as h5f:
+        source.copy('CALI', h5f)
+
+    apply_gain(file, constants, block_size = 50)
+    written = load_cali_info(file)
+    lazy    = load_cali_info(data_dir + 'three_channels_calib_WD2.h5', constants)
+
+    expected = (written['integrated_Q'] - constants['pedestal'][written['channels']]) / constants['gain'][written['channels']]
+    assert np.allclose(written['integrated_PE'], expected)
+    assert written.equals(lazy)
+
+
+def test_photoelectrons_without_constants_are_nan(tmp_path, data_dir):
+    '''
+    channels missing from the constants can't be converted
+    '''
+    constants = np.zeros(1, dtype = types.gain_constants_type)
+    constants['gain'] = 10.
+    cali = load_cali_info(data_dir + 'three_channels_calib_WD2.h5', constants)
+    assert not np.any(np.isnan(cali['integrated_PE'][cali['channels'] == 0]))
+    assert np.all(np.isnan(cali['integrated_PE'][cali['channels'] > 0]))
@@ -1,6 +1,35 @@
 import numpy as np
+import h5py
 
 
+# Version of the h5 layout written by the decoders, stored on the RAW group.
+#   1 - samples, sampling_period and channels repeated in every event_info row
+#   2 - run constants stored once as attributes on the RAW group,
+#       event_info rows only hold what changes per event
+SCHEMA_VERSION = 2
+MULE_VERSION   = '0.1.0'
+
+# the WD1 (CAEN) trigger time tag is a 31 bit counter, wrapping every ~17 s at 8 ns
+WD1_TIMESTAMP_WRAP = 2**31
+
+# attributes every schema 2 RAW group must hold, checked by `load_metadata()`.
+# The decoders also record source_file, decoder, decoder_version and, for
+# binary sources, the byte_order they were read with.
+metadata_keys = ('schema_version', 'samples', 'sampling_period', 'channels')
+
+event_row_type        = np.dtype([
+            ('event_number', np.uint32),
+            ('timestamp', np.uint64),
+            ])
+
+# compact schema, timestamps are stored as the difference to the previous event
+# (gaps must fit in 32 bits, or be taken modulo the `timestamp_wrap` of a wrapping
+# counter, see `format_event_row()`) and widened with the `timestamp_origin` attribute on read.
+event_row_compact_type = np.dtype([
+            ('event_number', np.uint32),
+            ('timestamp_delta', np.uint32),
+            ])
+
 event_info_type       = np.dtype([
             ('event_number', np.uint32), 
             ('timestamp', np.uint64), 
@@ -16,6 +45,84 @@ calibration_info_type = np.dtype([
             ('height',       np.float64),
             ])
 
+# fitted single photoelectron response of each channel
+gain_constants_type = np.dtype([
+            ('channels',          np.int32),
+            ('gain',              np.float64),
+            ('gain_error',        np.float64),
+            ('pedestal',          np.float64),
+            ('pedestal_error',    np.float64),
+            ('resolution',        np.float64),
+            ('resolution_error',  np.float64),
+            ('mu',                np.float64),
+            ('valid',             np.bool_),
+            ])
+
+# charges in photoelectrons, row for row with calibration_info_type
+pe_info_type = np.dtype([
+            ('event_number',  np.uint32),
+            ('channels',      np.uint32),
+            ('integrated_PE', np.float64),
+            ])
+
+# threshold crossing pulses, many per waveform
+pulse_type = np.dtype([
+            ('event_number', np.uint32),
+            ('channels',     np.uint32),
+            ('start',        np.uint32),
+            ('peak',         np.uint32),
+            ('width',        np.uint32),
+            ('amplitude',    np.float64),
+            ('charge',       np.float64),
+            ])
+
+# rows of each waveform's pulses in the pulse table, row for row with /RAW/rwf
+pulse_offset_type = np.dtype([
+            ('event_number', np.uint32),
+            ('channels',     np.uint32),
+            ('first',        np.uint64),
+            ('count',        np.uint32),
+            ])
+
+# arrival times of each waveform, row for row with calibration_info_type
+timing_type = np.dtype([
+            ('event_number', np.uint32),
+            ('channels',     np.uint32),
+            ('cfd_time',     np.float64),
+            ('le_time',      np.float64),
+            ])
+
+# events matched across files by `find_coincidences()`, one row per event
+coincidence_type = np.dtype([
+            ('coincidence', np.uint64),
+            ('file',        np.uint16),
+            ('row',         np.uint64),
+            ('timestamp',   np.uint64),
+            ])
+
+# reason each waveform of an analysis was kept or rejected, indexing `selection_reasons`
+ACCEPTED        = 0
+WINDOW_MISMATCH = 1
+SECONDARY_PEAK  = 2
+NO_REFERENCE    = 3
+selection_reasons = ('accepted', 'window_mismatch', 'secondary_peak', 'no_reference')
+
+# waveforms selected by the analysis, one row per /RAW/rwf row read
+selection_type = np.dtype([
+            ('file',   np.uint16),
+            ('row',    np.uint64),
+            ('reason', np.uint8),
+            ])
+
+# member files of a run set, with their row ranges in the virtual datasets
+run_set_file_type     = np.dtype([
+            ('path', h5py.string_dtype()),
+            ('event_start', np.uint64),
+            ('event_stop', np.uint64),
+            ('rwf_start', np.uint64),
+            ('rwf_stop', np.uint64),
+            ])
+
 def rwf_type(samples  :  int) -> np.dtype:
     """
     Generates the data-type for raw waveforms 
@@ -38,6 +145,29 @@ def rwf_type(samples  :  int) -> np.dtype:
             ('rwf', np.float32, (samples,))
         ])
 
+def subwf_window_type(samples  :  int) -> np.dtype:
+    """
+    Generates the data-type for the integration window of subtracted waveforms,
+    holding the window's start and end sample, padded with zeros to a fixed length
+
+    Parameters
+    ----------
+
+        samples  (int)  :  Length of the longest integration window
+
+    Returns
+    -------
+
+        (ndtype)  :  Desired data type for processing
+    """
+    return np.dtype([
+            ('event_number', np.uint32),
+            ('channels', np.int32),
+            ('start', np.uint32),
+            ('end', np.uint32),
+            ('rwf', np.float32, (samples,))
+        ])
+
 def rwf_type_WD1(samples  :  int) -> np.dtype:
     '''
     WAVEDUMP 1: Generates the data-type for raw waveforms
@@ -48,6 +178,73 @@ def rwf_type_WD1(samples  :  int) -> np.dtype:
                      ('rwf', np.uint16, (samples))])
                     
 
+def rwf_type_compact(samples      :  int,
+                     sample_type  :  np.dtype) -> np.dtype:
+    '''
+    Generates the compact data-type for raw waveforms, using the narrowest types
+    suitable for the event number and channel so that short waveforms aren't
+    dominated by their metadata.
+
+    Parameters
+    ----------
+
+        samples      (int)    :  Number of samples per waveform
+        sample_type  (dtype)  :  Data type of each sample (uint16 for WD1, float32 for WD2)
+
+    Returns
+    -------
+
+        (ndtype)  :  Desired data type for processing
+    '''
+    return np.dtype([
+            ('event_number', np.uint32),
+            ('channels', np.uint8),
+            ('rwf', sample_type, (samples,))
+        ])
+
+
+def hist_type(shape  :  int | tuple) -> np.dtype:
+    '''
+    Generates the data-type for the per channel histograms written during calibration,
+    with the entries falling outside of the binning
+
+    Parameters
+    ----------
+
+        shape  (int | tuple)  :  Number of bins, or (Q bins, height bins) for a 2D histogram
+
+    Returns
+    -------
+
+        (ndtype)  :  Desired data type for the histograms
+    '''
+    return np.dtype([
+            ('channels', np.int32),
+            ('counts', np.uint64, shape),
+            ('outside', np.uint64),
+        ])
+
+
+def index_type(key_type  :  np.dtype) -> np.dtype:
+    '''
+    Generates the data-type for a sorted lookup index over the event_info rows
+
+    Parameters
+    ----------
+
+        key_type  (dtype)  :  Data type of the indexed column
+
+    Returns
+    -------
+
+        (ndtype)  :  Desired data type for the index
+    '''
+    return np.dtype([
+            ('key', key_type),
+            ('row', np.uint64),
+        ])
+
+
 def generate_wfdtype(channels, samples):
     '''
     generates the dtype for collecting the binary data based on samples and number of